@@ -0,0 +1,62 @@
+"""
+Scaling benchmark for the label clustering engines.
+
+Times ScanEngine against BlockedEngine on synthetic label vocabularies of
+growing size and checks that both produce the same groups. ParallelEngine
+is timed against BlockedEngine on every core, and MatrixEngine too when
+numpy is installed. Run from the project root with:
+
+    python benchmarks/bench_cluster.py [size ...]
+"""
+import sys
+sys.path.append('./ttags/')
+import time
+import cluster
+from synthetic import vocabulary
+
+# ScanEngine is skipped above this many names, it takes too long.
+SCAN_LIMIT = 8000
+
+
+def timed(engine, names):
+    start = time.perf_counter()
+    groups = engine.leven(list(names))
+    return time.perf_counter() - start, groups
+
+
+def canonical(groups):
+    return sorted(sorted(group) for group in groups)
+
+
+def main(sizes):
+    print('{:>8} {:>10} {:>11} {:>8} {:>8} {:>12} {:>10}'.format(
+        'names', 'scan (s)', 'blocked (s)', 'speedup', 'groups',
+        'parallel (s)', 'matrix (s)'))
+    for size in sizes:
+        names = vocabulary(size)
+        blocked_time, blocked = timed(cluster.BlockedEngine(), names)
+        scan_time = speedup = '-'
+        if size <= SCAN_LIMIT:
+            scan_time, scan = timed(cluster.ScanEngine(), names)
+            if canonical(scan) != canonical(blocked):
+                raise SystemExit('Engines disagree at {} names'.format(size))
+            speedup = '{:.1f}x'.format(scan_time / blocked_time)
+            scan_time = '{:.2f}'.format(scan_time)
+        parallel_time, parallel = timed(
+            cluster.ParallelEngine(min_parallel=0), names)
+        if parallel != blocked:
+            raise SystemExit('Parallel groups differ at {} names'.format(
+                size))
+        # MatrixEngine groups connected components, so its groups differ
+        matrix_time = '-'
+        if cluster.np is not None:
+            matrix_time = '{:.2f}'.format(
+                timed(cluster.MatrixEngine(), names)[0])
+        print('{:>8} {:>10} {:>11.2f} {:>8} {:>8} {:>12.2f} {:>10}'.format(
+            size, scan_time, blocked_time, speedup, len(blocked),
+            parallel_time, matrix_time))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or
+         [500, 1000, 2000, 4000, 8000, 16000, 32000])
@@ -0,0 +1,63 @@
+"""
+Memory benchmark for the in-memory card model.
+
+Builds the same synthetic cards twice, once as the trimmed dicts cards
+used to be kept as and once as records.Card, and reports the memory
+each takes with tracemalloc. Run from the project root with:
+
+    python benchmarks/bench_model.py [cards ...]
+"""
+import sys
+sys.path.append('./ttags/')
+import random
+import tracemalloc
+import records
+
+
+def raw_cards(count, labels=200, seed=0):
+    """ count cards as trello sends them, with zero to three labels each. """
+    rng = random.Random(seed)
+    pool = [{'name': 'label{}'.format(i), 'id': '{:024x}'.format(i)}
+            for i in range(labels)]
+    return [{'name': 'card {}'.format(i), 'id': '{:024x}'.format(10**6 + i),
+             'idList': '{:024x}'.format(i % 50), 'desc': '',
+             'labels': [dict(label)
+                        for label in rng.sample(pool, rng.randint(0, 3))]}
+            for i in range(count)]
+
+
+def as_dicts(cards):
+    return [{'name': card.get('name'), 'id': card.get('id'),
+             'labels': [{'name': label.get('name'), 'id': label.get('id')}
+                        for label in card.get('labels')]}
+            for card in cards]
+
+
+def as_records(cards):
+    return [records.Card.from_json(card) for card in cards]
+
+
+def measure(build, cards):
+    """ Bytes still held by what build returns. """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    model = build(cards)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del model
+    return used
+
+
+def main(sizes):
+    print('{:>8} {:>12} {:>12} {:>8}'.format(
+        'cards', 'dicts (MB)', 'records (MB)', 'saving'))
+    for size in sizes:
+        cards = raw_cards(size)
+        dicts = measure(as_dicts, cards)
+        slotted = measure(as_records, cards)
+        print('{:>8} {:>12.1f} {:>12.1f} {:>7.0%}'.format(
+            size, dicts / 2**20, slotted / 2**20, 1 - slotted / dicts))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 500000])
@@ -0,0 +1,155 @@
+"""
+Benchmark of the in-memory pipeline on synthetic accounts.
+
+Runs every stage from parsing boards to suggesting groups on the
+accounts in synthetic.PRESETS and reports the time and peak memory of
+each. Every stage runs twice, once timed and once under tracemalloc,
+which would otherwise slow the timed run down. Run from the project root
+with:
+
+    python benchmarks/bench_pipeline.py [preset ...] [--save FILE]
+                                        [--compare FILE]
+
+--save stores the results as a baseline, --compare exits with an error
+when a stage got slower or bigger than the baseline by more than the
+tolerance. benchmarks/baseline.json holds results for the default presets
+from a development machine; save a baseline of your own before comparing
+against it on other hardware.
+"""
+import sys
+sys.path.append('./ttags/')
+import argparse
+import json
+import random
+import time
+import tracemalloc
+import app
+import cluster
+import index
+from synthetic import PRESETS, Account
+
+# Time regressions smaller than this many seconds are put down to noise.
+MIN_SECONDS = 0.05
+
+
+def extract_all(account):
+    """ extract_cards on every list, timing only the extraction. """
+    cards = []
+    spent = 0
+    for list_pos, raw in account.iter_lists():
+        start = time.perf_counter()
+        cards += app.TrelloApp.extract_cards(raw)
+        spent += time.perf_counter() - start
+    return cards, spent
+
+
+def stages(account):
+    """ (name, function of the previous results) for every stage. """
+    the_app = app.TrelloApp()
+    engine = cluster.BlockedEngine()
+
+    def simple(results):
+        # simple picks its seeds at random
+        random.seed(0)
+        return engine.simple(results['index'].names())
+
+    return [
+        ('parse_boards',
+         lambda results: app.TrelloApp.parse_boards_json(account.boards())),
+        ('extract_cards', lambda results: extract_all(account)),
+        ('index', lambda results: index.LabelIndex.from_cards(
+            results['extract_cards'])),
+        ('prepare_labels',
+         lambda results: the_app.prepare_labels(results['extract_cards'])),
+        ('leven', lambda results: engine.leven(results['index'].names())),
+        ('simple', simple)
+    ]
+
+
+def measure(account):
+    """ Stage name -> {'seconds', 'peak_mb'} for an account. """
+    results = dict()
+    measured = dict()
+    for name, stage in stages(account):
+        start = time.perf_counter()
+        result = stage(results)
+        seconds = time.perf_counter() - start
+        if name == 'extract_cards':
+            result, seconds = result
+        del result
+
+        tracemalloc.start()
+        result = stage(results)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if name == 'extract_cards':
+            result = result[0]
+
+        results[name] = result
+        measured[name] = {'seconds': round(seconds, 4),
+                          'peak_mb': round(peak / 2 ** 20, 2)}
+    return measured
+
+
+def compare(results, baseline, tolerance):
+    """ Lines describing every stage worse than the baseline. """
+    regressions = []
+    for preset, preset_stages in results.items():
+        for name, now in preset_stages.items():
+            before = baseline.get(preset, dict()).get(name)
+            if before is None:
+                continue
+            if (now['seconds'] > before['seconds'] * (1 + tolerance) and
+                    now['seconds'] - before['seconds'] > MIN_SECONDS):
+                regressions.append('{} {}: {:.3f}s, baseline {:.3f}s'.format(
+                    preset, name, now['seconds'], before['seconds']))
+            if now['peak_mb'] > before['peak_mb'] * (1 + tolerance):
+                regressions.append('{} {}: {:.1f}MB, baseline {:.1f}MB'.format(
+                    preset, name, now['peak_mb'], before['peak_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('presets', nargs='*', default=['1k', '10k', '100k'],
+                        help='any of {}'.format(', '.join(PRESETS)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='fail if worse than this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='allowed slowdown or growth, 0.3 is 30%%')
+    args = parser.parse_args(argv)
+    for preset in args.presets:
+        if preset not in PRESETS:
+            parser.error('unknown preset {}'.format(preset))
+
+    results = dict()
+    print('{:>6} {:>15} {:>10} {:>10}'.format(
+        'cards', 'stage', 'time (s)', 'peak (MB)'))
+    for preset in args.presets:
+        account = Account(seed=args.seed, **PRESETS[preset])
+        results[preset] = measure(account)
+        for name, stage in results[preset].items():
+            print('{:>6} {:>15} {:>10.3f} {:>10.1f}'.format(
+                preset, name, stage['seconds'], stage['peak_mb']))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.tolerance)
+        if regressions:
+            print('Worse than the baseline:')
+            for line in regressions:
+                print('  ' + line)
+            return 1
+        print('No regressions against the baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
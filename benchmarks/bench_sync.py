@@ -0,0 +1,122 @@
+"""
+End to end throughput of syncing and merging against a fake trello.
+
+Starts a FakeTrelloServer on a synthetic account, points a TrelloTool at
+it and measures how fast TrelloApp.initialize loads the account, in bulk
+and list by list, and how fast merges go through. Latency, jitter and
+injected 429 or 500 answers are set with the same options as
+fake_trello.py. Run from the project root with:
+
+    python benchmarks/bench_sync.py [--preset 10k] [--latency 0.05]
+                                    [--rate-limit-rate 0.01] [--merges 5]
+
+Requests are not paced unless --rate is given, so trello's own rate
+limits do not hide the client's throughput.
+"""
+import sys
+sys.path.append('./ttags/')
+import argparse
+import time
+import app
+import merge
+import model
+import scheduler
+from fake_trello import (FakeTrelloServer, add_fault_arguments,
+                         fake_from_arguments)
+
+# Requests per second allowed when --rate is not given.
+UNPACED = 10 ** 6
+
+
+def make_tool(args, server):
+    rate = args.rate or UNPACED
+    pacing = scheduler.Scheduler([scheduler.TokenBucket(rate, 1)],
+                                 workers=args.workers)
+    return model.TrelloTool({'key': 'key', 'token': 'token'},
+                            pool_size=args.workers, backoff=args.backoff,
+                            request_scheduler=pacing,
+                            base_url=server.base_url())
+
+
+def sync(args, server, bulk):
+    """ Time initialize and return the app it loaded. """
+    trello_app = app.TrelloApp(workers=args.workers, bulk=bulk)
+    trello_app.authenticated = True
+    trello_app.tool = make_tool(args, server)
+    start = time.perf_counter()
+    trello_app.initialize()
+    seconds = time.perf_counter() - start
+    report('initialize ({})'.format('bulk' if bulk else 'lists'),
+           seconds, len(trello_app.Cards), 'cards', trello_app.tool)
+    return trello_app
+
+
+def merge_labels(args, server, trello_app):
+    """ Merge the second label of the first boards into their first. """
+    account = server.fake.account
+    operations = 0
+    failed = 0
+    # the tool's counts include the requests initialize made
+    before = trello_app.tool.stats()
+    start = time.perf_counter()
+    for labels in account.board_labels[:args.merges]:
+        replacing, replaced = labels[0], labels[1]
+        plan = merge.compile_plan(trello_app.index, replacing['id'],
+                                  [replaced['id']], replacing['name'])
+        failures = merge.execute_plan(
+            trello_app.tool, plan, on_success=lambda update: trello_app.
+            record_update(update, replacing['name']))
+        operations += plan.operation_count()
+        failed += len(failures)
+    seconds = time.perf_counter() - start
+    report('merge', seconds, operations, 'operations', trello_app.tool,
+           before)
+    if failed:
+        print('  {} card updates failed'.format(failed))
+
+
+def report(stage, seconds, count, unit, tool, before=None):
+    """ Print a stage's throughput and the requests made since before. """
+    stats = tool.stats()
+    if before is not None:
+        stats = dict((name, value - before.get(name, 0))
+                     for name, value in stats.items())
+    print('{:<20} {:>8} {:<10} {:>8.2f}s {:>10.0f}/s  requests {} '
+          'retries {} failures {}'.format(
+              stage, count, unit, seconds, count / seconds if seconds else 0,
+              stats['requests'], stats['retries'], stats['failures']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    add_fault_arguments(parser)
+    parser.add_argument('--mode', choices=['bulk', 'lists', 'both'],
+                        default='both', help='how initialize fetches cards')
+    parser.add_argument('--merges', type=int, default=5,
+                        help='boards to merge two labels on')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='requests in flight at once')
+    parser.add_argument('--rate', type=float,
+                        help='requests per second to pace the client to')
+    parser.add_argument('--backoff', type=float, default=0.05,
+                        help='first retry delay when no Retry-After is sent')
+    args = parser.parse_args(argv)
+
+    server = FakeTrelloServer(fake_from_arguments(args)).start()
+    try:
+        trello_app = None
+        if args.mode in ('bulk', 'both'):
+            trello_app = sync(args, server, bulk=True)
+        if args.mode in ('lists', 'both'):
+            trello_app = sync(args, server, bulk=False)
+        if args.merges:
+            merge_labels(args, server, trello_app)
+    finally:
+        server.stop()
+    counts = server.fake.counts
+    print('server: {} requests, {} answered 429, {} answered 500'.format(
+        counts['requests'], counts['rate_limited'], counts['errors']))
+
+
+if __name__ == '__main__':
+    main()
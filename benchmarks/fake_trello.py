@@ -0,0 +1,293 @@
+"""
+A local stand-in for the trello API, serving a synthetic account.
+
+FakeTrello answers the requests TrelloTool makes: members/me/boards,
+lists/{id}/cards, boards/{id}/cards, batch, and adding or removing a
+card's labels. Label changes are kept, so a merge shows up in later
+reads. Every request can be delayed by a latency with some jitter, and a
+share of them answered with 429 or 500, to see how syncing and merging
+hold up against a slow or unreliable API. Run it on its own with:
+
+    python benchmarks/fake_trello.py [--preset 10k] [--port 8081]
+
+and point TrelloTool's base_url at http://localhost:8081/1.
+"""
+import sys
+sys.path.append('./ttags/')
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+from synthetic import CARD, PRESETS, Account
+
+
+class FakeTrello:
+    """
+    The state and behaviour of the fake API, apart from HTTP. Lists are
+    generated the first time they are read and kept from then on.
+    """
+
+    def __init__(self, account, latency=0, jitter=0, rate_limit_rate=0,
+                 error_rate=0, retry_after=1, seed=0):
+        self.account = account
+        # seconds every request takes, give or take up to jitter
+        self.latency = latency
+        self.jitter = jitter
+        # share of requests answered with 429 and with 500
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        # Retry-After sent with every 429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+
+        self.boards = account.boards()
+        # list id -> position, board id -> list positions
+        self.list_positions = dict()
+        self.board_lists = dict()
+        for board in self.boards:
+            positions = []
+            for _list in board['lists']:
+                self.list_positions[_list['id']] = len(self.list_positions)
+                positions.append(self.list_positions[_list['id']])
+            self.board_lists[board['id']] = positions
+        # label id -> label, across every board
+        self.labels = dict((label['id'], label)
+                           for labels in account.board_labels
+                           for label in labels)
+        # label id and list id -> id of the board they belong to
+        self.label_boards = dict(
+            (label['id'], board['id'])
+            for board, labels in zip(self.boards, account.board_labels)
+            for label in labels)
+        self.list_boards = dict((_list['id'], board['id'])
+                                for board in self.boards
+                                for _list in board['lists'])
+        # list position -> cards, for the lists read so far
+        self.lists = dict()
+        self.lock = Lock()
+        self.counts = {'requests': 0, 'rate_limited': 0, 'errors': 0}
+
+    def list_cards(self, list_pos):
+        with self.lock:
+            if list_pos not in self.lists:
+                self.lists[list_pos] = self.account.list_cards(list_pos)
+            return self.lists[list_pos]
+
+    def find_card(self, card_id):
+        """ The card with card_id, or None. """
+        try:
+            number = int(card_id, 16) - (CARD << 88)
+        except ValueError:
+            return None
+        if not 0 <= number < self.account.card_count:
+            return None
+        list_pos = self.account.list_of_card(number)
+        first = self.account.list_span(list_pos)[0]
+        return self.list_cards(list_pos)[number - first]
+
+    def fault(self):
+        """
+        Wait out the latency, then decide whether this request fails.
+        Returns None or the (status, headers, body) to fail with.
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            delay = self.latency + self.rng.uniform(-self.jitter,
+                                                    self.jitter)
+            draw = self.rng.random()
+        if delay > 0:
+            time.sleep(delay)
+        if draw < self.rate_limit_rate:
+            with self.lock:
+                self.counts['rate_limited'] += 1
+            return (429, {'Retry-After': str(self.retry_after)},
+                    {'message': 'API_TOKEN_LIMIT_EXCEEDED'})
+        if draw < self.rate_limit_rate + self.error_rate:
+            with self.lock:
+                self.counts['errors'] += 1
+            return 500, dict(), {'message': 'Internal Server Error'}
+        return None
+
+    def get(self, path):
+        """ (status, body) for a GET of an API path without its query. """
+        parts = path.strip('/').split('/')
+        if parts == ['members', 'me', 'boards']:
+            return 200, self.boards
+        if len(parts) == 3 and parts[0] == 'lists' and parts[2] == 'cards':
+            if parts[1] not in self.list_positions:
+                return 404, {'message': 'list not found'}
+            return 200, self.list_cards(self.list_positions[parts[1]])
+        if len(parts) == 3 and parts[0] == 'boards' and parts[2] == 'cards':
+            if parts[1] not in self.board_lists:
+                return 404, {'message': 'board not found'}
+            return 200, [card for pos in self.board_lists[parts[1]]
+                         for card in self.list_cards(pos)]
+        return 404, {'message': 'no route {}'.format(path)}
+
+    def batch(self, routes):
+        """ One entry per route, as trello's batch endpoint answers. """
+        entries = []
+        for route in routes:
+            status, body = self.get(urlsplit(route).path)
+            if status == 200:
+                entries.append({'200': body})
+            else:
+                entries.append({'name': 'NotFound', 'statusCode': status,
+                                'message': body['message']})
+        return entries
+
+    def add_label(self, card_id, label_id):
+        card = self.find_card(card_id)
+        if card is None or label_id not in self.labels:
+            return 404, {'message': 'not found'}
+        # as on trello, a card can only carry labels of its own board
+        if self.label_boards[label_id] != self.list_boards[card['idList']]:
+            return 400, {'message': 'invalid value for value'}
+        with self.lock:
+            if any(label['id'] == label_id for label in card['labels']):
+                return 400, {'message': 'that label is already on the card'}
+            card['labels'].append(dict(self.labels[label_id]))
+            return 200, [label['id'] for label in card['labels']]
+
+    def remove_label(self, card_id, label_id):
+        card = self.find_card(card_id)
+        if card is None:
+            return 404, {'message': 'not found'}
+        with self.lock:
+            kept = [label for label in card['labels']
+                    if label['id'] != label_id]
+            if len(kept) == len(card['labels']):
+                return 404, {'message': 'label not on card'}
+            card['labels'] = kept
+            return 200, {'_value': None}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        """ The path under /1 and the query of the request. """
+        url = urlsplit(self.path)
+        path = url.path
+        if path.startswith('/1/'):
+            path = path[2:]
+        return path, parse_qs(url.query)
+
+    def answer(self, method):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode()) if length else {}
+
+        failure = fake.fault()
+        if failure is not None:
+            status, headers, body = failure
+            return self.send(status, body, headers)
+
+        path, query = self.route()
+        parts = path.strip('/').split('/')
+        if method == 'GET' and parts == ['batch']:
+            routes = query.get('urls', [''])[0].split(',')
+            return self.send(200, fake.batch(routes))
+        if method == 'GET':
+            return self.send(*fake.get(path))
+        if (method == 'POST' and len(parts) == 3 and parts[0] == 'cards' and
+                parts[2] == 'idLabels'):
+            label_id = (form.get('value') or query.get('value') or [''])[0]
+            return self.send(*fake.add_label(parts[1], label_id))
+        if (method == 'DELETE' and len(parts) == 4 and
+                parts[0] == 'cards' and parts[2] == 'idLabels'):
+            return self.send(*fake.remove_label(parts[1], parts[3]))
+        return self.send(404, {'message': 'no route {}'.format(path)})
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def log_message(self, format, *args):
+        return
+
+
+class FakeTrelloServer(ThreadingHTTPServer):
+    """ Serves a FakeTrello over HTTP on localhost. """
+    daemon_threads = True
+
+    def __init__(self, fake, port=0):
+        super(FakeTrelloServer, self).__init__(('localhost', port), Handler)
+        self.fake = fake
+        self.thread = None
+
+    def base_url(self):
+        return 'http://localhost:{}/1'.format(self.server_port)
+
+    def start(self):
+        """ Serve on a background thread. """
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def add_fault_arguments(parser):
+    """ Options setting up a FakeTrello, shared with the harness. """
+    parser.add_argument('--preset', default='10k', choices=sorted(PRESETS),
+                        help='synthetic account to serve')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds every request takes')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='latency varies by up to this many seconds')
+    parser.add_argument('--rate-limit-rate', type=float, default=0,
+                        help='share of requests answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of requests answered with 500')
+    parser.add_argument('--retry-after', type=float, default=1,
+                        help='Retry-After seconds sent with a 429')
+
+
+def fake_from_arguments(args):
+    return FakeTrello(Account(seed=args.seed, **PRESETS[args.preset]),
+                      latency=args.latency, jitter=args.jitter,
+                      rate_limit_rate=args.rate_limit_rate,
+                      error_rate=args.error_rate,
+                      retry_after=args.retry_after, seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a fake trello API.')
+    add_fault_arguments(parser)
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args(argv)
+
+    server = FakeTrelloServer(fake_from_arguments(args), args.port)
+    print('Serving {} on {}'.format(args.preset, server.base_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Seeded generator of synthetic trello accounts.
+
+An Account has boards, lists and cards shaped like trello's JSON, with
+label names drawn from a vocabulary of random words and their typo or
+separator variants. Every board has its own labels, as on trello, so the
+same name shows up under different ids on different boards. Cards are
+generated list by list on demand, so even a million card account never
+has to be held in memory at once, and the same seed always gives the
+same account.
+"""
+import random
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+# Labels on each board, unless the vocabulary needs more to be covered.
+LABELS_PER_BOARD = 20
+
+
+def vocabulary(size, seed=0, variant_rate=0.3):
+    """
+    Build size distinct label names. Most are fresh random words, the
+    rest are variants of earlier ones with a typo or a separator added.
+    """
+    rng = random.Random(seed)
+    names = set()
+    words = []
+    while len(names) < size:
+        if words and rng.random() < variant_rate:
+            name = list(rng.choice(words))
+            pos = rng.randrange(len(name))
+            if rng.random() < 0.5:
+                name[pos] = rng.choice(ALPHABET)
+            else:
+                name.insert(pos, rng.choice('_- '))
+            name = ''.join(name)
+        else:
+            name = ''.join(rng.choice(ALPHABET)
+                           for _ in range(rng.randint(4, 14)))
+            words.append(name)
+        names.add(name)
+    return sorted(names)
+
+
+def trello_id(kind, number):
+    """ A 24 digit hex id like trello's, distinct for every kind. """
+    return '{:02x}{:022x}'.format(kind, number)
+
+
+BOARD, LIST, CARD, LABEL = range(4)
+
+
+class Account:
+    """ A synthetic account. Only the seed and sizes are stored. """
+
+    def __init__(self, boards=5, lists_per_board=5, cards=1000,
+                 vocabulary_size=200, variant_rate=0.3, seed=0):
+        self.board_count = boards
+        self.lists_per_board = lists_per_board
+        self.card_count = cards
+        self.seed = seed
+        self.names = vocabulary(vocabulary_size, seed, variant_rate)
+
+        per_board = min(max(LABELS_PER_BOARD,
+                            -(-len(self.names) // boards)), len(self.names))
+        # board position -> [{'name', 'id'}], walking through the
+        # vocabulary so every name is used
+        self.board_labels = [
+            [{'name': self.names[(board * per_board + pos) %
+                                 len(self.names)],
+              'id': trello_id(LABEL, board * per_board + pos)}
+             for pos in range(per_board)]
+            for board in range(boards)]
+
+    def list_count(self):
+        return self.board_count * self.lists_per_board
+
+    def boards(self):
+        """ Boards with their lists, as members/me/boards answers. """
+        return [{'name': 'board {}'.format(board),
+                 'id': trello_id(BOARD, board),
+                 'dateLastActivity': '2017-01-01T00:00:00.000Z',
+                 'lists': [{'name': 'list {}'.format(_list),
+                            'id': trello_id(LIST, _list)}
+                           for _list in range(
+                               board * self.lists_per_board,
+                               (board + 1) * self.lists_per_board)]}
+                for board in range(self.board_count)]
+
+    def list_ids(self):
+        return [trello_id(LIST, _list) for _list in range(self.list_count())]
+
+    def list_span(self, list_pos):
+        """ Numbers of the first card on a list and of cards on it. """
+        per_list, extra = divmod(self.card_count, self.list_count())
+        first = list_pos * per_list + min(list_pos, extra)
+        return first, per_list + (1 if list_pos < extra else 0)
+
+    def list_of_card(self, card):
+        """ Position of the list holding card number card. """
+        per_list, extra = divmod(self.card_count, self.list_count())
+        if card < extra * (per_list + 1):
+            return card // (per_list + 1)
+        return extra + (card - extra * (per_list + 1)) // per_list
+
+    def list_cards(self, list_pos):
+        """ The cards of the list at list_pos, as lists/{id}/cards answers. """
+        first, count = self.list_span(list_pos)
+        labels = self.board_labels[list_pos // self.lists_per_board]
+        rng = random.Random(self.seed * 1000003 + list_pos)
+        list_id = trello_id(LIST, list_pos)
+        return [{'name': 'card {}'.format(card),
+                 'id': trello_id(CARD, card),
+                 'idList': list_id,
+                 'desc': 'description of card {}'.format(card),
+                 'labels': [dict(label) for label in rng.sample(
+                     labels, min(rng.choice((0, 1, 1, 2, 2, 3)),
+                                 len(labels)))]}
+                for card in range(first, first + count)]
+
+    def iter_lists(self):
+        """ Yield (list position, cards) for every list in order. """
+        for list_pos in range(self.list_count()):
+            yield list_pos, self.list_cards(list_pos)
+
+
+# Accounts the benchmarks run on, by name.
+PRESETS = {
+    '1k': dict(boards=4, lists_per_board=5, cards=1000,
+               vocabulary_size=200),
+    '10k': dict(boards=20, lists_per_board=8, cards=10000,
+                vocabulary_size=1000),
+    '100k': dict(boards=100, lists_per_board=10, cards=100000,
+                 vocabulary_size=3000),
+    '1m': dict(boards=500, lists_per_board=10, cards=1000000,
+               vocabulary_size=8000)
+}
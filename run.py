@@ -1,22 +1,79 @@
+import argparse
 import cmd
+import os
+import shlex
 import sys
+import time
 sys.path.append('./ttags/')
 from app import TrelloApp
+from cache import BoardCache, ScoreCache, default_path
+from cluster import ENGINES, SCORE_VERSION, MatrixEngine, ParallelEngine
+import batch
+import metrics
+import profiling
+import service
 from pprint import pprint
 
+# Port webhook callbacks are received on, unless given to watch.
+WEBHOOK_PORT = 8090
+
+
+def split_scope(arg):
+    """
+    The options of a command and the board and list it is limited to,
+    given as board=NAME and list=NAME. Names with spaces are quoted.
+    """
+    options = []
+    scope = {'board': None, 'list': None}
+    for option in shlex.split(arg):
+        key, _, value = option.partition('=')
+        if key in scope and value:
+            scope[key] = value
+        else:
+            options.append(option)
+    return options, scope['board'], scope['list']
+
+
 class TrelloCLI(cmd.Cmd):
     intro = 'Welcome to TrelloTags. Type help or ? to list commands.\n'
     prompt = '(TrelloTags) > '
 
-    def __init__(self):
+    def __init__(self, app=None, profile_mode=None):
         super(TrelloCLI, self).__init__()
-        self.app = TrelloApp()
+        self.app = app or TrelloApp(cache=BoardCache())
+        # with a profiling mode, reinit and suggest always run profiled
+        self.profile_mode = profile_mode
+
+    def profiled(self, command, fn, *args, mode=None, prefix=None):
+        """
+        Run fn under the profiler, print what it found and return fn's
+        result. Without a prefix, files are named after the command and
+        the time.
+        """
+        profile = profiling.Profile(
+            mode or self.profile_mode or 'cprofile',
+            prefix or 'ttags-{}-{}'.format(command,
+                                           time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            return profile.run(fn, *args)
+        finally:
+            for line in profile.report():
+                print(line)
+
+    def precmd(self, line):
+        # catch up on changes trello posted while waiting for a command
+        self.app.apply_events()
+        return line
 
     def do_login(self, arg):
         """Start a TrelloTags session."""
         try:
             if self.app.login():
                 print("Logged in.")
+                unfinished = self.app.unfinished_merges()
+                if unfinished:
+                    print("{} merges did not finish last time, run resume "
+                          "to finish them.".format(len(unfinished)))
         except FileNotFoundError:
             print("Configuration file not found. Place in ttargs as client_credentials.json.")
     def do_logout(self, arg):
@@ -30,33 +87,287 @@ class TrelloCLI(cmd.Cmd):
     def do_suggest(self, arg):
         """
         Find similar labels and merge them. Only works if you are logged in.
+        Use 'suggest dry' to print the merge plans without changing anything.
+        Use 'suggest new' to only see groups that changed since the last
+        'suggest new', which only compares the labels that changed.
+        Add 'board=NAME' or 'list=NAME', or both, to only look at the
+        labels and cards of one board or list. Quote names with spaces.
+        'new' has no effect then.
         """
-        if self.app.authenticated:
-            self.app.suggest_similar()
-        else:
+        if not self.app.authenticated:
+            print("Sorry, you are not logged in. Log in with 'login'.")
+            return
+        try:
+            options, board, board_list = split_scope(arg)
+            self.app.find_scope(board, board_list)
+        except ValueError as error:
+            print(error)
+            return
+        label_groups = None
+        if self.profile_mode:
+            label_groups = self.profiled(
+                'suggest', lambda: self.app.similar_groups(
+                    'new' in options, self.app.prepare(board, board_list)))
+        self.app.suggest_similar(dry_run=('dry' in options),
+                                 changed_only=('new' in options),
+                                 label_groups=label_groups, board=board,
+                                 board_list=board_list)
+
+    def do_resume(self, arg):
+        """
+        Finish merges cut short by a crash or a network failure. Only the
+        label changes that did not go through are made. Must be logged in.
+        """
+        if not self.app.authenticated:
             print("Sorry, you are not logged in. Log in with 'login'.")
+        elif not self.app.unfinished_merges():
+            print("Nothing to resume.")
+        else:
+            failures = self.app.resume_merges()
+            for update, error in failures:
+                print("  Could not update {} ({})".format(update.card_id,
+                                                          error))
+            print("Some operations failed again, run resume to retry."
+                  if failures else "Every merge is finished.")
 
     def do_reinit(self, arg):
         """
         Reinitialize the data. May solve some errors caused by old data.
+        Everything is fetched again, cached boards included.
         Must be logged in.
         """
         if self.app.authenticated:
-            self.app.initialize()
+            if self.profile_mode:
+                self.profiled('reinit', self.app.initialize, False)
+            else:
+                self.app.initialize(use_cache=False)
         else:
             print("Sorry, you are not logged in. Log in with 'login'.")
-    
+
+    def do_watch(self, arg):
+        """
+        Keep the data up to date as it changes on trello, without reinit.
+        Use 'watch URL [PORT]', where URL is a public address trello can
+        post to that forwards to PORT on this machine (8090 by default).
+        'watch off' stops. Must be logged in.
+        """
+        options = arg.split()
+        if options == ['off']:
+            self.app.unwatch()
+            print("Stopped watching.")
+            return
+        if not options:
+            print("Watching {} boards.".format(len(self.app.webhooks))
+                  if self.app.webhook_server else "Not watching.")
+            return
+        if not self.app.authenticated:
+            print("Sorry, you are not logged in. Log in with 'login'.")
+            return
+        try:
+            port = int(options[1]) if len(options) > 1 else WEBHOOK_PORT
+        except ValueError:
+            print("{} is not a port, use 'watch URL [PORT]'.".format(
+                options[1]))
+            return
+        refused = self.app.watch(options[0], port,
+                                 self.app.credentials.get('secret'))
+        print("Watching {} boards.".format(len(self.app.webhooks)))
+        for board in refused:
+            print("  Trello would not watch {}.".format(board.name))
+
+    def do_profile(self, arg):
+        """
+        Profile a command: 'profile reinit' or 'profile suggest [new]'.
+        For suggest only the search for similar groups is profiled, no
+        questions are asked. Add 'sample' to sample stacks instead of
+        tracing every call, and a file prefix to choose where the pstats
+        and collapsed stacks files go. Must be logged in.
+        """
+        options = arg.split()
+        if not options or options[0] not in ('reinit', 'suggest'):
+            print("Profile what? Use 'profile reinit' or 'profile suggest'.")
+            return
+        if not self.app.authenticated:
+            print("Sorry, you are not logged in. Log in with 'login'.")
+            return
+        command = options[0]
+        mode = None
+        prefix = None
+        for option in options[1:]:
+            if option in profiling.MODES:
+                mode = option
+            elif option != 'new':
+                prefix = option
+        if command == 'reinit':
+            self.profiled(command, self.app.initialize, False, mode=mode,
+                          prefix=prefix)
+        else:
+            groups = self.profiled(command, self.app.similar_groups,
+                                   'new' in options, mode=mode,
+                                   prefix=prefix)
+            print("Found {} groups of similar labels.".format(len(groups)))
+
     def do_show(self,arg):
-        """Prints out all the data currently stored."""
-        pprint("Boards: {}".format(self.app.Boards))
-        pprint("Lists: {}".format(self.app.Lists))
-        pprint("Cards: {}".format(self.app.Cards))
+        """
+        Prints out all the data currently stored. Use 'show board=NAME'
+        or 'show list=NAME', or both, to only print one board or list,
+        loading its cards first if need be. Quote names with spaces.
+        """
+        try:
+            options, board, board_list = split_scope(arg)
+            if board is None and board_list is None:
+                boards = self.app.Boards
+                lists = self.app.Lists
+                cards = self.app.Cards
+            else:
+                self.app.prepare(board, board_list)
+                boards, list_ids = self.app.find_scope(board, board_list)
+                lists = [_list for found in boards for _list in found.lists
+                         if list_ids is None or _list.id in list_ids]
+                cards = self.app.cards_in(boards, list_ids)
+        except ValueError as error:
+            print(error)
+            return
+        pprint("Boards: {}".format(boards))
+        pprint("Lists: {}".format(lists))
+        pprint("Cards: {}".format([card.to_json() for card in cards]))
+        if self.app.lazy and board is None and board_list is None:
+            print("Cards of {} of {} boards are loaded.".format(
+                len(self.app.loaded_boards), len(self.app.Boards)))
+
+    def do_stats(self, arg):
+        """
+        Show request counts, errors, bytes and latencies per endpoint, and
+        the time spent loading, indexing, clustering and merging.
+        Use 'stats json [file]' or 'stats prometheus [file]' to export
+        them, 'stats reset' to start over and 'stats on' or 'stats off'
+        to turn recording on or off.
+        """
+        recorded = self.app.metrics
+        options = arg.split()
+        command = options[0] if options else ''
+        if command in ('on', 'off'):
+            recorded.enabled = command == 'on'
+            print("Metrics are {}.".format(command))
+        elif command == 'reset':
+            recorded.reset()
+            print("Metrics cleared.")
+        elif command in ('json', 'prometheus'):
+            text = (recorded.to_json() if command == 'json'
+                    else recorded.to_prometheus())
+            if len(options) > 1:
+                with open(options[1], 'w') as out:
+                    out.write(text)
+                print("Wrote {}.".format(options[1]))
+            else:
+                print(text)
+        elif command:
+            print("Unknown option {}, see 'help stats'.".format(command))
+        else:
+            if not recorded.enabled:
+                print("Metrics are off, turn them on with 'stats on'.")
+            for line in recorded.summary():
+                print(line)
 
     def do_quit(self, arg):
         """Quit TrelloTags."""
+        # webhooks left behind would keep posting to a closed port
+        self.app.unwatch()
         sys.exit()
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Find and merge similar '
+                                     'trello labels.')
+    parser.add_argument('--board-at-a-time', action='store_true',
+                        help='load one board at a time and keep only the '
+                        'label index in memory, for very large accounts')
+    parser.add_argument('--lazy', action='store_true',
+                        help='load only boards and lists at login and the '
+                        'cards of a board once a command needs them')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='spill the label index to disk once it would '
+                        'take more than MB megabytes')
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        default='blocked',
+                        help='how similar labels are grouped')
+    parser.add_argument('--scoring-workers', type=int, metavar='N',
+                        help='processes the parallel engine scores with, '
+                        'one per core by default')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='do not record request and phase metrics')
+    parser.add_argument('--profile', choices=profiling.MODES,
+                        default=os.environ.get('TTAGS_PROFILE') or None,
+                        help='always profile reinit and suggest, also set '
+                        'by TTAGS_PROFILE')
+    parser.add_argument('--batch', metavar='ACCOUNTS',
+                        help='merge without asking on every account in this '
+                        'JSON file, then exit')
+    parser.add_argument('--policy', metavar='FILE',
+                        help='JSON merge policy for --batch')
+    parser.add_argument('--reports', metavar='DIR', default='reports',
+                        help='where --batch writes a report per account')
+    parser.add_argument('--parallel-accounts', type=int, default=4,
+                        metavar='N', help='accounts --batch processes at once')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a service with a local HTTP API '
+                        'instead of the prompt')
+    parser.add_argument('--port', type=int, default=8095,
+                        help='port --serve listens on')
+    args = parser.parse_args(argv)
+    if args.lazy and args.board_at_a_time:
+        parser.error('--lazy keeps the cards it loads, it does not go with '
+                     '--board-at-a-time')
+    # argparse does not check defaults against the choices
+    if args.profile is not None and args.profile not in profiling.MODES:
+        parser.error('TTAGS_PROFILE must be one of {}'.format(
+            ', '.join(profiling.MODES)))
+    return args
+
+
+def make_engine(args, scores=None):
+    if args.engine == 'matrix':
+        # scores whole tiles at once, looking pairs up would only slow it
+        return MatrixEngine()
+    # scores are kept between runs, see cache.ScoreCache
+    if scores is None:
+        scores = ScoreCache(SCORE_VERSION)
+    if args.engine == 'parallel':
+        return ParallelEngine(workers=args.scoring_workers, scores=scores)
+    return ENGINES[args.engine](scores=scores)
+
+
 # try it out
 if __name__ == '__main__':
-    TrelloCLI().cmdloop()
+    args = parse_args()
+    if args.no_metrics:
+        metrics.DEFAULT.enabled = False
+    if args.batch:
+        policy = (batch.Policy.load(args.policy) if args.policy
+                  else batch.Policy())
+        reports = batch.run_batch(batch.load_accounts(args.batch), policy,
+                                  args.reports, args.parallel_accounts)
+        for line in batch.summary(reports):
+            print(line)
+        sys.exit(1 if any(report['error'] for report in reports) else 0)
+    if args.serve:
+        the_service = service.Service(
+            lambda scores: make_engine(args, scores),
+            scores=ScoreCache(SCORE_VERSION),
+            journal_dir=default_path('journals'),
+            service_metrics=metrics.DEFAULT)
+        server = service.ServiceServer(the_service, args.port)
+        print("Serving on http://localhost:{}".format(server.server_port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        sys.exit()
+    budget = None
+    if args.memory_budget is not None:
+        budget = int(args.memory_budget * 2 ** 20)
+    TrelloCLI(TrelloApp(engine=make_engine(args), cache=BoardCache(),
+                        board_at_a_time=args.board_at_a_time,
+                        memory_budget=budget, lazy=args.lazy,
+                        journal_dir=default_path('journals')),
+              profile_mode=args.profile).cmdloop()
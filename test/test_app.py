@@ -1,14 +1,74 @@
 import sys
 sys.path.append('ttags/')
+import json
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
 import app
+import cache
+import merge
+import metrics
+import records
+from test.test_merge import RecordingTool
+from test.test_model import FakeResponse
+
+
+class FakeTool:
+    """ Serves boards and lists from memory instead of trello. """
+
+    def __init__(self, boards, lists, delays=None):
+        self.boards = boards
+        self.lists = lists
+        self.delays = delays or dict()
+        # ids of the boards whose cards were asked for
+        self.fetched = []
+
+    def get_boards(self):
+        return FakeResponse(200, content=json.dumps(self.boards).encode())
+
+    def iter_list_cards(self, list_id):
+        time.sleep(self.delays.get(list_id, 0))
+        if list_id not in self.lists:
+            raise IOError('404 error')
+        for card in self.lists[list_id]:
+            yield dict(card, idList=list_id)
+
+    def iter_boards_cards(self, board_ids):
+        self.fetched += board_ids
+        for position, board_id in enumerate(board_ids):
+            board = [b for b in self.boards if b['id'] == board_id][0]
+            if any(l['id'] not in self.lists for l in board['lists']):
+                yield position, IOError('not found')
+                continue
+            # boards hand back cards grouped by list, last list first here
+            for _list in reversed(board['lists']):
+                for card in self.lists[_list['id']]:
+                    yield position, dict(card, idList=_list['id'])
+
+
+def fake_account():
+    boards = [{'name': 'board1', 'id': 'b1', 'lists': [
+        {'name': 'list1', 'id': 'l1'},
+        {'name': 'list2', 'id': 'l2'},
+        {'name': 'list3', 'id': 'l3'}]}]
+    lists = {
+        'l1': [{'name': 'card1', 'id': 'c1', 'desc': '',
+                'labels': [{'name': 'bug', 'id': 'lb1'}]}],
+        'l2': [{'name': 'card2', 'id': 'c2', 'desc': '',
+                'labels': [{'name': 'bugs', 'id': 'lb2'}]}],
+        'l3': [{'name': 'card3', 'id': 'c3', 'desc': '',
+                'labels': []}]
+    }
+    return boards, lists
 
 
 class AppTest(unittest.TestCase):
 
     def setUp(self):
         self.App = app.TrelloApp()
-        self.App.Cards = [{
+        self.App.Cards = app.TrelloApp.extract_cards([{
             'name': 'card1',
             'id': 'id1',
             'labels': [
@@ -26,7 +86,7 @@ class AppTest(unittest.TestCase):
                 {'name': 'labell2',
                  'id': 'labelid2'}
             ]
-        }]
+        }])
 
     def test_parse_boards_json(self):
         boards = [
@@ -46,16 +106,8 @@ class AppTest(unittest.TestCase):
         parsed = app.TrelloApp.parse_boards_json(boards)
 
         expected = [
-            {
-                'name': 'board1',
-                'id': 'id1',
-                'lists': [
-                    {
-                        'name': 'list1',
-                        'id': 'id100'
-                    }
-                ]
-            }
+            records.Board('board1', 'id1',
+                          [records.BoardList('list1', 'id100')])
         ]
 
         self.assertTrue(parsed == expected)
@@ -78,14 +130,8 @@ class AppTest(unittest.TestCase):
         extracted = app.TrelloApp.extract_lists(board)
 
         expected = [
-            {
-                'name': 'list1',
-                'id': 'id1'
-            },
-            {
-                'name': 'list2',
-                'id': 'id2'
-            }
+            records.BoardList('list1', 'id1'),
+            records.BoardList('list2', 'id2')
         ]
 
         self.assertTrue(expected == extracted)
@@ -104,16 +150,13 @@ class AppTest(unittest.TestCase):
 
         extracted = app.TrelloApp.extract_cards(arr_of_cards)
         expected = [
-            {'name': 'card1',
-             'id': 'id1',
-             'labels': [{
-                 'name': 'label1',
-                 'id': 'idlabel1'
-             }]
-             }
+            records.Card('card1', 'id1',
+                         [records.LABELS.intern('idlabel1', 'label1')])
         ]
 
         self.assertTrue(extracted == expected)
+        self.assertEqual(extracted[0].label_dicts(),
+                         [{'name': 'label1', 'id': 'idlabel1'}])
 
     def test_prepare_labels(self):
         prep_cards = self.App.prepare_labels(self.App.Cards)
@@ -157,6 +200,366 @@ class AppTest(unittest.TestCase):
 
         self.assertTrue(expected_label_groups == label_groups)
 
+    def test_initialize_keeps_list_order(self):
+        boards, lists = fake_account()
+        self.App.authenticated = True
+        self.App.bulk = False
+        self.App.tool = FakeTool(boards, lists,
+                                 delays={'l1': 0.05, 'l2': 0.02})
+        self.App.initialize()
+
+        self.assertEqual([card.id for card in self.App.Cards],
+                         ['c1', 'c2', 'c3'])
+        self.assertEqual(self.App.failed_lists, [])
+
+    def test_initialize_reports_failed_lists(self):
+        boards, lists = fake_account()
+        del lists['l2']
+        self.App.authenticated = True
+        self.App.bulk = False
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+
+        self.assertEqual([card.id for card in self.App.Cards],
+                         ['c1', 'c3'])
+        self.assertEqual([l.id for l, error in self.App.failed_lists],
+                         ['l2'])
+
+    def test_initialize_bulk_matches_list_by_list(self):
+        boards, lists = fake_account()
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+        bulk_cards = self.App.Cards
+
+        self.App.bulk = False
+        self.App.initialize()
+        self.assertEqual(bulk_cards, self.App.Cards)
+
+    def test_initialize_bulk_reports_failed_boards(self):
+        boards, lists = fake_account()
+        del lists['l2']
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+
+        self.assertEqual(self.App.Cards, [])
+        self.assertEqual([l.id for l, error in self.App.failed_lists],
+                         ['l1', 'l2', 'l3'])
+
+    def test_suggest_dry_run_changes_nothing(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                mock.patch('builtins.print') as printed:
+            self.App.suggest_similar(dry_run=True)
+
+        output = [call[0][0] for call in printed.call_args_list]
+        self.assertIn('1 cards, 2 operations:', output)
+        self.assertFalse(self.App.dirty)
+
+    def test_suggest_changed_only_skips_unchanged_groups(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        with mock.patch('builtins.input', side_effect=['n']) as asked, \
+                mock.patch('builtins.print'):
+            self.App.suggest_similar(changed_only=True)
+            self.App.suggest_similar(changed_only=True)
+        self.assertEqual(asked.call_count, 1)
+
+        self.App.index.add_label('c1', 'lb3', 'bugz')
+        with mock.patch('builtins.input', side_effect=['n']), \
+                mock.patch('builtins.print') as printed:
+            self.App.suggest_similar(changed_only=True)
+        self.assertEqual(printed.call_args_list[0][0][1],
+                         ['bug', 'bugs', 'bugz'])
+
+    def test_merge_patches_cards_in_place(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        self.App.tool = RecordingTool()
+        with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                mock.patch('builtins.print'):
+            self.App.suggest_similar()
+
+        self.assertEqual([card.label_dicts() for card in self.App.Cards],
+                         [[{'name': 'bug', 'id': 'lb1'}],
+                          [{'name': 'bug', 'id': 'lb1'}]])
+        self.assertFalse(self.App.dirty)
+        self.assertEqual(self.App.index.names(), ['bug'])
+        self.assertEqual(self.App.index.cards_with('lb1'), ['c1', 'c2'])
+
+    def test_phases_are_timed(self):
+        boards, lists = fake_account()
+        self.App.metrics = metrics.Metrics()
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+        self.App.tool = RecordingTool()
+        with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                mock.patch('builtins.print'):
+            self.App.suggest_similar()
+
+        phases = self.App.metrics.snapshot()['phases']
+        self.assertEqual(sorted(phases),
+                         ['cluster', 'index', 'load', 'merge'])
+        self.assertEqual(phases['merge']['runs'], 1)
+
+        for board_at_a_time in (False, True):
+            self.App.metrics = metrics.Metrics()
+            self.App.board_at_a_time = board_at_a_time
+            self.App.tool = FakeTool(boards, lists)
+            self.App.initialize()
+            phases = self.App.metrics.snapshot()['phases']
+            self.assertEqual(phases['load']['runs'], 1)
+            self.assertEqual(phases['index']['runs'], 1)
+
+    def test_failed_merge_marks_data_dirty(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        self.App.tool = RecordingTool(failing_cards=['c2'])
+        with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                mock.patch('builtins.print'):
+            self.App.suggest_similar()
+
+        self.assertTrue(self.App.dirty)
+        self.assertEqual(self.App.Cards[1].label_dicts(),
+                         [{'name': 'bugs', 'id': 'lb2'}])
+
+    def test_resume_finishes_failed_merge(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        with tempfile.TemporaryDirectory() as directory:
+            self.App.journal = merge.Journal(
+                os.path.join(directory, 'journal'))
+            self.App.tool = RecordingTool(failing_cards=['c2'])
+            with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                    mock.patch('builtins.print'):
+                self.App.suggest_similar()
+            self.assertEqual(len(self.App.unfinished_merges()), 1)
+
+            self.App.tool = RecordingTool()
+            with mock.patch('builtins.print'):
+                self.assertEqual(self.App.resume_merges(), [])
+            self.assertEqual(self.App.tool.calls, [('post', 'c2', 'lb1'),
+                                                   ('delete', 'c2', 'lb2')])
+            self.assertEqual(self.App.unfinished_merges(), [])
+        self.assertEqual(self.App.Cards[1].label_dicts(),
+                         [{'name': 'bug', 'id': 'lb1'}])
+
+    def test_journal_per_member(self):
+        class MemberTool:
+            """ Every login gets a new token, the member stays the same. """
+            members = {'first': 'm1', 'renewed': 'm1', 'other': 'm2'}
+
+            def __init__(self, credentials, **kwargs):
+                self.token = credentials['token']
+
+            def get_member(self):
+                return FakeResponse(200, content=json.dumps(
+                    {'id': MemberTool.members[self.token]}).encode())
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('model.TrelloTool', MemberTool):
+            self.App.journal_dir = directory
+            self.App.connect({'key': 'key', 'token': 'first'})
+            plan = merge.MergePlan('lb1', 'bug')
+            update = merge.CardUpdate('c2')
+            update.add = 'lb1'
+            plan.updates.append(update)
+            self.App.journal.begin(plan)
+            self.assertEqual(len(self.App.unfinished_merges()), 1)
+
+            self.App.connect({'key': 'key', 'token': 'other'})
+            self.assertEqual(self.App.unfinished_merges(), [])
+            # logging in again after a crash gives a new token
+            self.App.connect({'key': 'key', 'token': 'renewed'})
+            self.assertEqual(len(self.App.unfinished_merges()), 1)
+
+    def test_record_update_moves_card_between_labels(self):
+        boards, lists = fake_account()
+        self.App.Cards = app.TrelloApp.extract_cards(
+            lists['l1'] + lists['l2'])
+        self.App.index_cards()
+        plan = app.merge.compile_plan(self.App.index, 'lb1', ['lb2'], 'bug')
+
+        self.App.record_update(plan.updates[0], 'bug')
+        self.assertEqual(self.App.index.cards_with('lb1'), ['c1', 'c2'])
+        self.assertEqual(self.App.index.ids_for('bugs'), [])
+        self.assertEqual(self.App.Cards[1].label_dicts(),
+                         [{'name': 'bug', 'id': 'lb1'}])
+
+    def test_merge_uses_each_boards_own_label(self):
+        boards, lists = fake_account()
+        boards += [{'name': 'board2', 'id': 'b2', 'lists': [
+            {'name': 'list4', 'id': 'l4'}, {'name': 'list5', 'id': 'l5'}]},
+            {'name': 'board3', 'id': 'b3', 'lists': [
+                {'name': 'list6', 'id': 'l6'}]}]
+        lists['l4'] = [{'name': 'card4', 'id': 'c4', 'desc': '',
+                        'labels': [{'name': 'bug', 'id': 'lb4'}]}]
+        lists['l5'] = [{'name': 'card5', 'id': 'c5', 'desc': '',
+                        'labels': [{'name': 'bugs', 'id': 'lb5'}]}]
+        lists['l6'] = [{'name': 'card6', 'id': 'c6', 'desc': '',
+                        'labels': [{'name': 'bugs', 'id': 'lb6'}]}]
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+
+        plan = self.App.plan_merge(['bugs'], 'bug')
+        self.assertEqual([(u.card_id, u.add) for u in plan.updates],
+                         [('c2', 'lb1'), ('c5', 'lb4')])
+        self.assertEqual(plan.skipped, ['c6'])
+
+    def test_board_at_a_time_matches_all_in_memory(self):
+        boards, lists = fake_account()
+        boards.append({'name': 'board2', 'id': 'b2', 'lists': [
+            {'name': 'list4', 'id': 'l4'}]})
+        lists['l4'] = [{'name': 'card4', 'id': 'c4', 'desc': '',
+                        'labels': [{'name': 'bugz', 'id': 'lb3'},
+                                   {'name': 'bug', 'id': 'lb1'}]}]
+        merges = []
+        for board_at_a_time, budget in ((False, None), (True, None),
+                                        (True, 0)):
+            App = app.TrelloApp(board_at_a_time=board_at_a_time,
+                                memory_budget=budget)
+            App.authenticated = True
+            App.tool = FakeTool(boards, lists)
+            App.initialize()
+            recorder = RecordingTool()
+            App.tool = recorder
+            with mock.patch('builtins.input',
+                            side_effect=['y', 'bug']), \
+                    mock.patch('builtins.print'):
+                App.suggest_similar()
+            self.assertEqual(App.Cards == [], board_at_a_time)
+            merges.append((recorder.calls, App.index.names(),
+                           App.index.cards_with('lb1')))
+        self.assertEqual(merges[1], merges[0])
+        self.assertEqual(merges[2], merges[0])
+
+    def test_initialize_skips_unchanged_cached_boards(self):
+        boards, lists = fake_account()
+        boards[0]['dateLastActivity'] = '2017-01-01'
+        with tempfile.TemporaryDirectory() as directory:
+            self.App.cache = cache.BoardCache(
+                os.path.join(directory, 'cache.sqlite3'))
+            self.App.authenticated = True
+            self.App.tool = FakeTool(boards, lists)
+            self.App.initialize()
+            first_cards = self.App.Cards
+
+            self.App.initialize()
+            self.assertEqual(self.App.tool.fetched, ['b1'])
+            self.assertEqual(self.App.Cards, first_cards)
+
+            boards[0]['dateLastActivity'] = '2017-01-02'
+            self.App.initialize()
+            self.assertEqual(self.App.tool.fetched, ['b1', 'b1'])
+
+            self.App.initialize(use_cache=False)
+            self.assertEqual(self.App.tool.fetched, ['b1', 'b1', 'b1'])
+
+    def two_board_account(self):
+        boards, lists = fake_account()
+        boards.append({'name': 'Board Two', 'id': 'b2', 'lists': [
+            {'name': 'list4', 'id': 'l4'}]})
+        lists['l4'] = [{'name': 'card4', 'id': 'c4', 'desc': '',
+                        'labels': [{'name': 'feature', 'id': 'lb4'},
+                                   {'name': 'features', 'id': 'lb5'}]}]
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+
+    def test_lazy_initialize_loads_no_cards(self):
+        self.two_board_account()
+        self.App.lazy = True
+        self.App.initialize()
+        self.assertEqual([board.id for board in self.App.Boards],
+                         ['b1', 'b2'])
+        self.assertEqual(self.App.Cards, [])
+        self.assertEqual(self.App.tool.fetched, [])
+
+        groups = self.App.similar_groups(
+            label_index=self.App.prepare(board='board two'))
+        self.assertEqual(groups, [['feature', 'features']])
+        self.assertEqual(self.App.tool.fetched, ['b2'])
+
+        self.App.similar_groups()
+        self.assertEqual(self.App.tool.fetched, ['b2', 'b1'])
+        self.assertEqual(sorted(self.App.card_map),
+                         ['c1', 'c2', 'c3', 'c4'])
+
+    def test_lazy_skips_events_of_unloaded_boards(self):
+        self.two_board_account()
+        self.App.lazy = True
+        self.App.initialize()
+        self.App.prepare(board='b2')
+        event = {'type': 'addLabelToCard', 'data': {
+            'board': {'id': 'b1'}, 'card': {'id': 'c3'},
+            'label': {'id': 'lb1', 'name': 'bug'}}}
+        self.assertFalse(self.App.apply_event(event))
+        event['data']['board']['id'] = 'b2'
+        event['data']['card']['id'] = 'c4'
+        self.assertTrue(self.App.apply_event(event))
+
+    def test_lazy_refetches_boards_changed_before_loading(self):
+        self.two_board_account()
+        self.App.tool.boards[0]['dateLastActivity'] = '2017-01-01'
+        with tempfile.TemporaryDirectory() as directory:
+            self.App.cache = cache.BoardCache(
+                os.path.join(directory, 'cache.sqlite3'))
+            self.App.initialize()
+            self.App.lazy = True
+            self.App.initialize()
+
+            # card3 is given bug on trello after login
+            self.App.tool.lists['l3'][0]['labels'] = [
+                {'name': 'bug', 'id': 'lb1'}]
+            self.App.events.append({'type': 'addLabelToCard', 'data': {
+                'board': {'id': 'b1'}, 'card': {'id': 'c3'},
+                'label': {'id': 'lb1', 'name': 'bug'}}})
+            self.assertEqual(self.App.apply_events(), 0)
+            self.App.prepare(board='b1')
+
+        self.assertEqual(self.App.tool.fetched, ['b1', 'b2', 'b1'])
+        self.assertEqual(self.App.index.cards_with('lb1'), ['c1', 'c3'])
+
+    def test_suggest_limited_to_a_list(self):
+        self.two_board_account()
+        lists = self.App.tool.lists
+        lists['l2'][0]['labels'].append({'name': 'bug', 'id': 'lb1'})
+        # card3 has bugs too, but is on list3
+        lists['l3'][0]['labels'] = [{'name': 'bugs', 'id': 'lb2'}]
+        self.App.initialize()
+        self.App.tool = RecordingTool()
+        with mock.patch('builtins.input', side_effect=['y', 'bug']), \
+                mock.patch('builtins.print') as printed:
+            self.App.suggest_similar(board_list='list2')
+            self.App.suggest_similar(board_list='list2')
+
+        # one group asked about, the second run finds nothing on list2
+        self.assertEqual(len(printed.call_args_list[0][0]), 3)
+        self.assertEqual(self.App.card_map['c2'].label_dicts(),
+                         [{'name': 'bug', 'id': 'lb1'}])
+        self.assertEqual(self.App.card_map['c3'].label_dicts(),
+                         [{'name': 'bugs', 'id': 'lb2'}])
+
+    def test_find_scope(self):
+        self.two_board_account()
+        self.App.initialize()
+        boards, list_ids = self.App.find_scope(board_list='LIST2')
+        self.assertEqual([board.id for board in boards], ['b1'])
+        self.assertEqual(list_ids, {'l2'})
+        with self.assertRaises(ValueError):
+            self.App.find_scope(board='b2', board_list='list2')
+        self.App.board_at_a_time = True
+        with self.assertRaises(ValueError):
+            self.App.find_scope(board='b1')
+
 
 if __name__ == '__main__':
     unittest.main()
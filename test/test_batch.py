@@ -0,0 +1,111 @@
+import sys
+sys.path.append('ttags/')
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import batch
+import index
+import records
+from test.test_app import FakeTool, fake_account
+from test.test_merge import RecordingTool
+
+
+class AccountTool(FakeTool, RecordingTool):
+    """ Serves a fake account and records the merges made on it. """
+    BATCH_LIMIT = 10
+
+    def __init__(self, credentials, **kwargs):
+        boards, lists = fake_account()
+        if credentials['token'] == 'broken':
+            boards = None
+        FakeTool.__init__(self, boards, lists)
+        RecordingTool.__init__(self)
+
+
+def card(card_id, *names):
+    return records.Card(card_id, card_id,
+                        [records.LABELS.intern(name, name) for name in names])
+
+
+class PolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index.LabelIndex.from_cards([
+            card('c1', 'bug'), card('c2', 'bugs'), card('c3', 'bugs'),
+            card('c4', 'bug-report')])
+        self.group = ['bug', 'bugs', 'bug-report']
+
+    def test_winner_rules(self):
+        expected = {'most_cards': 'bugs', 'shortest': 'bug',
+                    'longest': 'bug-report', 'alphabetical': 'bug',
+                    'first': 'bug'}
+        for rule, winner in expected.items():
+            self.assertEqual(batch.Policy(winner=rule).choose(
+                self.group, self.index)[0], winner)
+
+    def test_kept_labels_are_never_replaced(self):
+        policy = batch.Policy(winner='shortest', keep=['bug-report'])
+        self.assertEqual(policy.choose(self.group, self.index),
+                         ('bug-report', ['bug', 'bugs']))
+
+    def test_unknown_winner(self):
+        with self.assertRaises(ValueError):
+            batch.Policy(winner='newest')
+
+    def test_min_score_is_inclusive(self):
+        # bug and bugs score exactly 86
+        for min_score, groups in ((86, [['bug', 'bugs']]), (87, [])):
+            engine = batch.Policy(min_score=min_score).make_engine()
+            self.assertEqual(engine.leven(['bug', 'bugs']), groups)
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.accounts = [{'name': 'team a', 'key': 'k', 'token': 't1'},
+                         {'name': 'team b', 'key': 'k', 'token': 'broken'}]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_batch(self, policy):
+        with mock.patch('model.TrelloTool', AccountTool), \
+                mock.patch('builtins.print'):
+            return batch.run_batch(self.accounts, policy, self.dir.name,
+                                   workers=2)
+
+    def test_merges_and_reports_every_account(self):
+        reports = self.run_batch(batch.Policy(winner='shortest'))
+
+        with open(os.path.join(self.dir.name, 'team_a.json')) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report, reports[0])
+        self.assertIsNone(report['error'])
+        self.assertEqual(report['cards'], 3)
+        group, = report['groups']
+        self.assertEqual((group['winner'], group['replaced'],
+                          group['status'], group['operations']),
+                         ('bug', ['bugs'], 'merged', 2))
+        self.assertEqual(report['metrics']['phases']['merge']['runs'], 1)
+
+        self.assertIn('TypeError', reports[1]['error'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir.name, 'team_b.json')))
+
+    def test_dry_run_changes_nothing(self):
+        reports = self.run_batch(batch.Policy(dry_run=True))
+        self.assertEqual(reports[0]['groups'][0]['status'], 'dry_run')
+        self.assertNotIn('merge', reports[0]['metrics']['phases'])
+
+    def test_summary(self):
+        lines = batch.summary(self.run_batch(batch.Policy()))
+        self.assertTrue(lines[0].startswith(
+            'team a: 1 groups, 1 merged, 0 failed in'))
+        self.assertTrue(lines[1].startswith('team b: failed after'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import sys
+sys.path.append('ttags/')
+import os
+import tempfile
+import unittest
+import cache
+import records
+
+
+class BoardCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ttags', 'cache.db')
+        self.cache = cache.BoardCache(self.path)
+        self.board = records.Board('board1', 'b1', [], '2017-01-01')
+        self.cards = [records.Card(
+            'card1', 'c1', [records.LABELS.intern('l1', 'bug')], 'list1')]
+
+    def tearDown(self):
+        self.cache.connection.close()
+        self.directory.cleanup()
+
+    def test_returns_cards_of_unchanged_board(self):
+        self.cache.store(self.board, self.cards)
+        self.assertEqual(self.cache.cards(self.board), self.cards)
+
+    def test_changed_board_is_a_miss(self):
+        self.cache.store(self.board, self.cards)
+        changed = records.Board('board1', 'b1', [], '2017-01-02')
+        self.assertIsNone(self.cache.cards(changed))
+
+    def test_board_without_activity_date_is_a_miss(self):
+        self.cache.store(self.board, self.cards)
+        self.assertIsNone(self.cache.cards(records.Board('board1', 'b1', [])))
+
+    def test_survives_reopening(self):
+        self.cache.store(self.board, self.cards)
+        self.cache.connection.close()
+        self.cache = cache.BoardCache(self.path)
+        self.assertEqual(self.cache.cards(self.board), self.cards)
+
+
+class ScoreCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'scores.db')
+        self.scored = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def compute(self, first, second):
+        self.scored.append((first, second))
+        return len(first) + len(second)
+
+    def test_scores_once_and_survives_reopening(self):
+        scores = cache.ScoreCache('v1', self.path)
+        self.assertEqual(scores.score('ab', 'c', self.compute), 3)
+        self.assertEqual(scores.score('ab', 'c', self.compute), 3)
+        scores.save()
+        scores.connection.close()
+
+        scores = cache.ScoreCache('v1', self.path)
+        self.assertEqual(scores.score('ab', 'c', self.compute), 3)
+        self.assertEqual(self.scored, [('ab', 'c')])
+        scores.connection.close()
+
+    def test_other_versions_are_dropped(self):
+        scores = cache.ScoreCache('v1', self.path)
+        scores.score('ab', 'c', self.compute)
+        scores.save()
+        scores.connection.close()
+
+        scores = cache.ScoreCache('v2', self.path)
+        self.assertEqual(len(scores.entries), 0)
+        scores.connection.close()
+
+    def test_evicts_least_recently_used(self):
+        scores = cache.ScoreCache('v1', self.path, capacity=2)
+        scores.score('a', 'b', self.compute)
+        scores.score('c', 'd', self.compute)
+        scores.score('a', 'b', self.compute)
+        scores.score('e', 'f', self.compute)
+        self.assertEqual(list(scores.entries), [('a', 'b'), ('e', 'f')])
+        scores.connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
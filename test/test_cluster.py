@@ -0,0 +1,156 @@
+import sys
+sys.path.append('ttags/')
+import random
+import unittest
+import os
+import tempfile
+import cache
+import cluster
+from fuzzywuzzy import fuzz
+
+
+def random_names(rng, count):
+    """ Short names with shared stems, typos and separators. """
+    stems = ['bug', 'feature', 'urgent', 'design', 'backend', 'ui', 'review']
+    names = set()
+    while len(names) < count:
+        name = list(rng.choice(stems))
+        for _ in range(rng.randint(0, 2)):
+            pos = rng.randrange(len(name) + 1)
+            name.insert(pos, rng.choice('abcdefxyz_-'))
+        names.add(''.join(name))
+    return list(names)
+
+
+def canonical(groups):
+    return sorted(sorted(group) for group in groups)
+
+
+class ClusterTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(cluster.normalize('in-progress_now'),
+                         'in progress now')
+
+    def test_candidates_bound_score(self):
+        index = cluster.CandidateIndex(['foo', 'bar', 'f-o', 'xfyyyy'], 0.4)
+        self.assertEqual(sorted(index.candidates('foo')), [0, 2])
+
+    def test_removed_names_are_not_candidates(self):
+        index = cluster.CandidateIndex(['foo', 'foi'], 0.4)
+        index.remove(1)
+        self.assertEqual(list(index.candidates('foo')), [0])
+
+    def test_blocked_leven_matches_scan(self):
+        rng = random.Random(7)
+        for count in (10, 60, 200):
+            names = random_names(rng, count)
+            expected = cluster.ScanEngine().leven(list(names))
+            found = cluster.BlockedEngine().leven(list(names))
+            self.assertEqual(canonical(expected), canonical(found))
+
+    def test_blocked_simple_matches_scan(self):
+        names = random_names(random.Random(3), 120)
+        random.seed(11)
+        expected = cluster.ScanEngine().simple(list(names))
+        random.seed(11)
+        found = cluster.BlockedEngine().simple(list(names))
+        self.assertEqual(canonical(expected), canonical(found))
+
+    def test_leven_skips_names_without_characters(self):
+        groups = cluster.BlockedEngine().leven(['', '--', 'foo', 'foi'])
+        self.assertEqual(canonical(groups), [['foi', 'foo']])
+
+    def test_parallel_leven_matches_blocked(self):
+        rng = random.Random(13)
+        names = random_names(rng, 300) + ['', '--']
+        expected = cluster.BlockedEngine().leven(list(names))
+        engine = cluster.ParallelEngine(workers=3, block=7, min_parallel=0)
+        self.assertEqual(engine.leven(list(names)), expected)
+
+    def test_score_cache_keeps_groups_and_skips_known_pairs(self):
+        names = random_names(random.Random(17), 150)
+        expected = cluster.BlockedEngine().leven(list(names))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'scores.db')
+            for run in range(2):
+                scores = cache.ScoreCache(cluster.SCORE_VERSION, path)
+                engine = cluster.BlockedEngine(scores=scores)
+                self.assertEqual(engine.leven(list(names)), expected)
+                scores.connection.close()
+            self.assertEqual(scores.misses, 0)
+            self.assertGreater(scores.hits, 0)
+
+    def test_union_find_roots_at_smallest(self):
+        sets = cluster.UnionFind(5)
+        sets.union(4, 2)
+        sets.union(2, 3)
+        sets.union(0, 1)
+        self.assertEqual(sets.groups(), [[0, 1], [2, 3, 4]])
+
+
+class ClusterStateTest(unittest.TestCase):
+
+    def test_built_from_nothing_matches_blocked(self):
+        names = random_names(random.Random(21), 200) + ['', '--']
+        state = cluster.ClusterState()
+        expected = cluster.BlockedEngine().leven(list(names))
+        self.assertEqual(state.update(names), expected)
+        self.assertEqual(state.groups(), expected)
+
+    def test_update_returns_only_changed_groups(self):
+        state = cluster.ClusterState()
+        names = ['bug', 'bugs', 'design', 'designs', 'review']
+        state.update(names)
+        self.assertEqual(state.update(names + ['reveiw']),
+                         [['reveiw', 'review']])
+        self.assertEqual(state.update(names + ['reveiw']), [])
+
+    def test_update_scores_only_changed_names(self):
+        scored = []
+
+        def ratio(seed, name):
+            scored.append(name)
+            return fuzz.ratio(seed, name)
+        state = cluster.ClusterState(ratio=ratio)
+        names = random_names(random.Random(4), 100)
+        state.update(names)
+        del scored[:]
+        state.update(names + ['bugxyz'])
+        self.assertEqual(set(scored), {'bugxyz'})
+
+    def test_removing_a_seed_places_its_members_again(self):
+        state = cluster.ClusterState()
+        state.update(['bug', 'bugs', 'bugz'])
+        self.assertEqual(state.update(['bugs', 'bugz']), [['bugs', 'bugz']])
+        self.assertEqual(state.update(['bugz']), [])
+        self.assertEqual(state.groups(), [])
+
+
+@unittest.skipIf(cluster.np is None, 'numpy not installed')
+class MatrixEngineTest(unittest.TestCase):
+
+    def test_pairs_match_fuzz_ratio(self):
+        rng = random.Random(5)
+        names = random_names(rng, 150) + ['', 'x' * 70 + 'bug', 'bug' * 30]
+        names = [cluster.normalize(name) for name in names]
+        expected = set((i, j) for i in range(len(names))
+                       for j in range(i + 1, len(names))
+                       if fuzz.ratio(names[i], names[j]) > 40)
+        found = set(cluster.MatrixEngine(tile=32).similar_pairs(names))
+        self.assertEqual(expected, found)
+
+    def test_leven_groups_connected_names(self):
+        label_names = ['foo', 'foi', 'bar', 'bae', 'xyzw']
+        groups = cluster.MatrixEngine().leven(label_names)
+        self.assertEqual(groups, [['bae', 'bar'], ['foi', 'foo']])
+
+    def test_leven_is_order_independent(self):
+        names = random_names(random.Random(9), 80)
+        shuffled = list(reversed(names))
+        engine = cluster.MatrixEngine(tile=16)
+        self.assertEqual(engine.leven(names), engine.leven(shuffled))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import sys
+sys.path.append('ttags/')
+import unittest
+import index
+import records
+
+
+class LabelIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index.LabelIndex.from_cards([
+            records.Card.from_json({'name': 'card1', 'id': 'c1', 'labels': [
+                {'name': 'bug', 'id': 'l1'}, {'name': 'ui', 'id': 'l2'}]}),
+            records.Card.from_json({'name': 'card2', 'id': 'c2', 'labels': [
+                {'name': 'bug', 'id': 'l3'}]})])
+
+    def test_lookups(self):
+        self.assertEqual(self.index.names(), ['bug', 'ui'])
+        self.assertEqual(self.index.ids_for('bug'), ['l1', 'l3'])
+        self.assertEqual(self.index.cards_with('l1'), ['c1'])
+        self.assertTrue(self.index.has_label('c1', 'l2'))
+        self.assertFalse(self.index.has_label('c2', 'l2'))
+
+    def test_removing_last_card_drops_label_and_name(self):
+        self.index.remove_label('c1', 'l2')
+        self.assertEqual(self.index.names(), ['bug'])
+        self.assertEqual(self.index.cards_with('l2'), [])
+
+    def test_add_label(self):
+        self.index.add_label('c2', 'l2', 'ui')
+        self.assertEqual(self.index.cards_with('l2'), ['c1', 'c2'])
+        self.assertTrue(self.index.has_label('c2', 'l2'))
+
+    def test_remove_card(self):
+        self.index.remove_card('c1')
+        self.assertEqual(self.index.names(), ['bug'])
+        self.assertEqual(self.index.ids_for('bug'), ['l3'])
+        self.assertNotIn('c1', self.index.card_labels)
+
+    def test_rename_label(self):
+        self.index.rename_label('l3', 'ui')
+        self.assertEqual(self.index.ids_for('bug'), ['l1'])
+        self.assertEqual(self.index.ids_for('ui'), ['l2', 'l3'])
+        self.assertEqual(self.index.cards_with('l3'), ['c2'])
+
+        self.index.remove_label('c1', 'l2')
+        self.index.rename_label('l2', 'gone')
+        self.assertNotIn('gone', self.index.names())
+
+
+class SpillingLabelIndexTest(unittest.TestCase):
+
+    def apply(self, label_index):
+        """ The same adds and removes, returning what lookups show. """
+        for card in range(20):
+            for label in range(card % 4):
+                label_index.add_label('c{}'.format(card),
+                                      'l{}'.format(label + card % 3),
+                                      'name{}'.format(label))
+        label_index.remove_label('c5', 'l2')
+        label_index.remove_card('c7')
+        label_index.add_label('c1', 'l2', 'name1')
+        label_index.add_label('c2', 'l1', 'name0')
+        return ([(name, label_index.ids_for(name))
+                 for name in label_index.names()],
+                [label_index.cards_with('l{}'.format(label))
+                 for label in range(6)],
+                label_index.has_label('c1', 'l2'),
+                label_index.has_label('c5', 'l2'))
+
+    def test_matches_in_memory_index(self):
+        expected = self.apply(index.LabelIndex())
+        for budget in (0, 2000, 10 ** 6):
+            spilling = index.SpillingLabelIndex(budget)
+            self.assertEqual(self.apply(spilling), expected)
+            self.assertEqual(spilling.store is not None, budget < 10 ** 6)
+
+    def test_dropped_label_leaves_names(self):
+        spilling = index.SpillingLabelIndex(0)
+        spilling.add_label('c1', 'l1', 'bug')
+        spilling.remove_label('c1', 'l1')
+        self.assertEqual(spilling.names(), [])
+        self.assertEqual(spilling.cards_with('l1'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
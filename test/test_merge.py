@@ -0,0 +1,173 @@
+import sys
+sys.path.append('ttags/')
+import os
+import tempfile
+import unittest
+import index
+import merge
+import records
+from concurrent.futures import Future
+from test.test_model import FakeResponse
+
+
+class RecordingTool:
+    """ Runs submitted work inline and records label calls. """
+
+    def __init__(self, failing_cards=(), failing_deletes=(),
+                 statuses=None):
+        self.calls = []
+        self.failing_cards = failing_cards
+        self.failing_deletes = failing_deletes
+        # (call, card id, label id) -> response, to answer with instead
+        self.statuses = statuses or dict()
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def post_id_label(self, card_id, label_id):
+        self.calls.append(('post', card_id, label_id))
+        if ('post', card_id, label_id) in self.statuses:
+            return self.statuses['post', card_id, label_id]
+        return FakeResponse(500 if card_id in self.failing_cards else 200)
+
+    def delete_card_label(self, card_id, label_id):
+        self.calls.append(('delete', card_id, label_id))
+        if ('delete', card_id, label_id) in self.statuses:
+            return self.statuses['delete', card_id, label_id]
+        return FakeResponse(500 if card_id in self.failing_deletes else 200)
+
+
+def card(card_id, *label_ids):
+    return records.Card(card_id, card_id,
+                        [records.LABELS.intern(l, l) for l in label_ids])
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index.LabelIndex.from_cards([
+            card('c1', 'bug', 'bugs'),
+            card('c2', 'bug', 'bugz'),
+            card('c3', 'bugz')])
+
+    def test_card_with_several_labels_gets_one_add(self):
+        plan = merge.compile_plan(self.index, 'target', ['bug', 'bugs'])
+        update = plan.updates[0]
+        self.assertEqual(update.card_id, 'c1')
+        self.assertEqual(update.add, 'target')
+        self.assertEqual(update.removes, ['bug', 'bugs'])
+        self.assertEqual(plan.operation_count(), 5)
+
+    def test_card_with_replacing_label_is_not_given_it_again(self):
+        plan = merge.compile_plan(self.index, 'bug', ['bugz'])
+        self.assertEqual([u.add for u in plan.updates], [None, 'bug'])
+        self.assertEqual(plan.operation_count(), 3)
+
+    def test_repeated_labels_are_deduplicated(self):
+        plan = merge.compile_plan(self.index, 'bug', ['bugs', 'bugs'])
+        self.assertEqual(plan.operation_count(), 1)
+
+    def test_execute_adds_before_removing(self):
+        tool = RecordingTool()
+        plan = merge.compile_plan(self.index, 'bugs', ['bugz'])
+        done = []
+        self.assertEqual(merge.execute_plan(tool, plan, done.append), [])
+        self.assertEqual(tool.calls, [('post', 'c2', 'bugs'),
+                                      ('delete', 'c2', 'bugz'),
+                                      ('post', 'c3', 'bugs'),
+                                      ('delete', 'c3', 'bugz')])
+        self.assertEqual(done, plan.updates)
+
+    def test_execute_reports_failed_cards(self):
+        tool = RecordingTool(failing_cards=['c3'])
+        plan = merge.compile_plan(self.index, 'bug', ['bugz'])
+        done = []
+        failures = merge.execute_plan(tool, plan, done.append)
+        self.assertEqual([u.card_id for u, error in failures], ['c3'])
+        self.assertEqual([u.card_id for u in done], ['c2'])
+        # the old label stays on the card whose add failed
+        self.assertNotIn(('delete', 'c3', 'bugz'), tool.calls)
+
+    def test_replacing_label_per_card(self):
+        replacing = {'c1': 'bug', 'c2': 'other-bug', 'c3': None}
+        plan = merge.compile_plan(self.index, 'bug', ['bugs', 'bugz'],
+                                  'bug', replacing.get)
+        self.assertEqual([(u.card_id, u.add, u.removes)
+                          for u in plan.updates],
+                         [('c1', None, ['bugs']),
+                          ('c2', 'other-bug', ['bugz'])])
+        self.assertEqual(plan.skipped, ['c3'])
+        self.assertEqual(plan.describe()[-1], '  1 cards left alone, their '
+                         'board has no label called bug')
+
+    def test_describe_counts_operations(self):
+        plan = merge.compile_plan(self.index, 'bug', ['bugz'])
+        lines = plan.describe({'c3': 'card three'})
+        self.assertEqual(lines[0], '2 cards, 3 operations:')
+        self.assertEqual(lines[2], '  card three (c3): add bug; remove bugz')
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = merge.Journal(os.path.join(self.dir.name, 'journal'))
+        self.index = index.LabelIndex.from_cards([
+            card('c1', 'bug', 'bugs'),
+            card('c2', 'bugs'),
+            card('c3', 'bugz')])
+        self.plan = merge.compile_plan(self.index, 'bug', ['bugs', 'bugz'],
+                                       'bug')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_finished_merge_leaves_nothing_behind(self):
+        merge.execute_plan(RecordingTool(), self.plan, journal=self.journal)
+        self.assertEqual(self.journal.unfinished(), [])
+        self.assertFalse(os.path.exists(self.journal.path))
+
+    def test_only_outstanding_operations_are_resumed(self):
+        failures = merge.execute_plan(
+            RecordingTool(failing_cards=['c2'], failing_deletes=['c3']),
+            self.plan, journal=self.journal)
+        self.assertEqual([u.card_id for u, error in failures], ['c2', 'c3'])
+
+        (plan_id, plan), = self.journal.unfinished()
+        self.assertEqual(plan.replacing_name, 'bug')
+        self.assertEqual([(u.card_id, u.add, u.removes)
+                          for u in plan.updates],
+                         [('c2', 'bug', ['bugs']), ('c3', None, ['bugz'])])
+
+        tool = RecordingTool()
+        self.assertEqual(merge.execute_plan(tool, plan, journal=self.journal,
+                                            plan_id=plan_id), [])
+        self.assertEqual(tool.calls, [('post', 'c2', 'bug'),
+                                      ('delete', 'c2', 'bugs'),
+                                      ('delete', 'c3', 'bugz')])
+        self.assertEqual(self.journal.unfinished(), [])
+
+    def test_steps_already_made_count_as_done(self):
+        tool = RecordingTool(statuses={
+            ('post', 'c2', 'bug'): FakeResponse(
+                400, content=b'that label is already on the card'),
+            ('delete', 'c2', 'bugs'): FakeResponse(404)})
+        self.assertEqual(merge.execute_plan(tool, self.plan,
+                                            journal=self.journal), [])
+
+    def test_line_cut_short_is_skipped(self):
+        merge.execute_plan(RecordingTool(failing_cards=['c2']), self.plan,
+                           journal=self.journal)
+        with open(self.journal.path, 'a') as journal_file:
+            journal_file.write('{"done": "')
+        (plan_id, plan), = self.journal.unfinished()
+        self.assertEqual(plan.operation_count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
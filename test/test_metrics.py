@@ -0,0 +1,74 @@
+import sys
+sys.path.append('ttags/')
+import json
+import unittest
+import metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_observations_fall_in_buckets(self):
+        histogram = metrics.Histogram((0.1, 1, float('inf')))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.cumulative(),
+                         [(0.1, 2), (1, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.95), float('inf'))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        self.metrics.record_request('get_list', 0.02, 200, 100)
+        self.metrics.record_request('get_list', 0.3, 429)
+        self.metrics.record_request('batch', 0.01, None)
+        self.metrics.record_bytes('get_list', 50)
+        self.metrics.record_phase('load', 2.5)
+
+    def test_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        get_list = snapshot['endpoints']['get_list']
+        self.assertEqual((get_list['requests'], get_list['errors'],
+                          get_list['bytes']), (2, 1, 150))
+        self.assertEqual(snapshot['endpoints']['batch']['errors'], 1)
+        self.assertEqual(snapshot['phases'],
+                         {'load': {'runs': 1, 'seconds': 2.5}})
+
+    def test_phase_times_its_block(self):
+        with self.metrics.phase('index'):
+            pass
+        self.assertEqual(self.metrics.snapshot()['phases']['index']['runs'],
+                         1)
+
+    def test_json_export(self):
+        exported = json.loads(self.metrics.to_json())
+        self.assertEqual(exported['endpoints']['get_list']['buckets'][-1],
+                         ['+Inf', 2])
+
+    def test_prometheus_export(self):
+        lines = self.metrics.to_prometheus().splitlines()
+        self.assertIn('# TYPE ttags_request_seconds histogram', lines)
+        self.assertIn('ttags_requests_total{endpoint="get_list"} 2', lines)
+        self.assertIn('ttags_request_errors_total{endpoint="batch"} 1',
+                      lines)
+        self.assertIn('ttags_request_seconds_bucket{endpoint="get_list",'
+                      'le="0.025"} 1', lines)
+        self.assertIn('ttags_request_seconds_bucket{endpoint="get_list",'
+                      'le="+Inf"} 2', lines)
+        self.assertIn('ttags_phase_seconds_total{phase="load"} 2.5', lines)
+
+    def test_disabled_records_nothing(self):
+        disabled = metrics.Metrics(enabled=False)
+        disabled.record_request('get_list', 0.1, 200, 10)
+        with disabled.phase('load'):
+            pass
+        self.assertEqual(disabled.snapshot(),
+                         {'endpoints': dict(), 'phases': dict()})
+
+
+if __name__ == '__main__':
+    unittest.main()
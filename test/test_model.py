@@ -0,0 +1,205 @@
+import sys
+sys.path.append('ttags/')
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import requests
+import metrics
+import model
+import scheduler
+
+
+class FakeClock:
+    """ A clock that only moves when something sleeps. """
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    """ Stands in for a requests response. """
+
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or dict()
+        self.content = content
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError('{} error'.format(self.status_code))
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """ Answers with the given responses in order. """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    def log_message(self, format, *args):
+        return
+
+
+class TrelloToolTest(unittest.TestCase):
+
+    def setUp(self):
+        clock = FakeClock()
+        buckets = [scheduler.TokenBucket(1000, 1, clock=clock)]
+        self.tool = model.TrelloTool(
+            {'key': 'k', 'token': 't'},
+            request_scheduler=scheduler.Scheduler(buckets, clock=clock,
+                                                  sleep=clock.sleep))
+        self.delays = clock.sleeps
+
+    def test_retries_rate_limited_requests(self):
+        self.tool.session = FakeSession([
+            FakeResponse(429, {'Retry-After': '3'}),
+            FakeResponse(503),
+            FakeResponse(200)])
+        response = self.tool.request('get', 'http://trello')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.delays, [3.0, 1.0])
+        self.assertEqual(self.tool.stats()['retries'], 2)
+
+    def test_retry_after_is_capped(self):
+        self.tool.session = FakeSession([
+            FakeResponse(429, {'Retry-After': '86400'}),
+            FakeResponse(200)])
+        self.tool.request('get', 'http://trello')
+        self.assertEqual(self.delays, [30])
+
+    def test_waits_for_trello_rate_limit_interval(self):
+        headers = {'x-rate-limit-api-token-remaining': '0',
+                   'x-rate-limit-api-token-interval-ms': '10000'}
+        self.tool.session = FakeSession([FakeResponse(429, headers),
+                                         FakeResponse(200)])
+        self.tool.request('get', 'http://trello')
+        self.assertEqual(self.delays, [10.0])
+
+    def test_gives_up_after_retries(self):
+        self.tool.retries = 2
+        self.tool.session = FakeSession([FakeResponse(500)] * 3)
+        response = self.tool.request('get', 'http://trello')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.tool.stats()['failures'], 1)
+
+    def test_connection_errors_are_retried(self):
+        self.tool.session = FakeSession([requests.ConnectionError(),
+                                         FakeResponse(200)])
+        self.assertEqual(
+            self.tool.request('get', 'http://trello').status_code, 200)
+
+    def test_base_url_can_be_changed(self):
+        tool = model.TrelloTool({'key': 'k', 'token': 't'},
+                                base_url='http://localhost:8081/1/')
+        self.assertEqual(tool.endpoint('delete_label', 'c1', 'l1'),
+                         'http://localhost:8081/1/cards/c1/idLabels/l1')
+        self.assertEqual(self.tool.endpoint('get_boards'),
+                         'https://api.trello.com/1/members/me/boards')
+
+    def test_streams_list_cards(self):
+        cards = [{'id': 'c{}'.format(i), 'name': 'card', 'labels': []}
+                 for i in range(3)]
+        response = FakeResponse(200, content=json.dumps(cards).encode())
+        self.tool.session = FakeSession([response])
+
+        with mock.patch.object(model.TrelloTool, 'CHUNK_SIZE', 7):
+            self.assertEqual(list(self.tool.iter_list_cards('l1')), cards)
+        self.assertTrue(response.closed)
+
+    def test_streams_batch_cards_and_errors(self):
+        body = [{'200': [{'id': 'c1'}, {'id': 'c2'}]},
+                {'name': 'NotFound', 'message': 'board not found',
+                 'statusCode': 404},
+                {'200': [{'id': 'c3'}]}]
+        self.tool.session = FakeSession([
+            FakeResponse(200, content=json.dumps(body).encode())])
+
+        results = list(self.tool.iter_boards_cards(['b1', 'b2', 'b3']))
+        self.assertEqual(results[:3], [(0, {'id': 'c1'}), (0, {'id': 'c2'}),
+                                       (2, {'id': 'c3'})])
+        position, error = results[3]
+        self.assertEqual(position, 1)
+        self.assertEqual(str(error), 'board b2: board not found')
+
+    def test_records_metrics_per_endpoint(self):
+        self.tool.metrics = metrics.Metrics()
+        cards = json.dumps([{'id': 'c1', 'name': 'card', 'labels': []}])
+        self.tool.session = FakeSession([
+            FakeResponse(429, {'Retry-After': '1'}),
+            FakeResponse(200, content=cards.encode()),
+            FakeResponse(200, content=b'["l1"]')])
+        list(self.tool.iter_list_cards('l1'))
+        self.tool.post_id_label('c1', 'l1')
+
+        endpoints = self.tool.metrics.snapshot()['endpoints']
+        self.assertEqual(endpoints['get_list']['requests'], 2)
+        self.assertEqual(endpoints['get_list']['errors'], 1)
+        self.assertEqual(endpoints['get_list']['bytes'], len(cards))
+        self.assertEqual(endpoints['post_label']['bytes'], 6)
+
+    def test_disabled_metrics_record_nothing(self):
+        self.tool.metrics = metrics.Metrics(enabled=False)
+        self.tool.session = FakeSession([FakeResponse(200, content=b'[]')])
+        list(self.tool.iter_list_cards('l1'))
+        self.assertEqual(self.tool.metrics.snapshot()['endpoints'], dict())
+
+    def test_connections_are_reused(self):
+        server = HTTPServer(('localhost', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://localhost:{}/'.format(server.server_port)
+            for _ in range(5):
+                self.tool.request('get', url)
+            stats = self.tool.stats()
+        finally:
+            # drop the kept alive connection so the server can stop
+            self.tool.session.close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused_connections'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import sys
+sys.path.append('ttags/')
+import os
+import pstats
+import tempfile
+import time
+import unittest
+import profiling
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += sum(range(100))
+    return total
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.dir.name, 'run')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_cprofile_writes_pstats_and_collapsed_stacks(self):
+        profile = profiling.Profile('cprofile', self.prefix, interval=0.001)
+        self.assertGreater(profile.run(busy, 0.1), 0)
+
+        self.assertEqual(profile.paths, [self.prefix + '.pstats',
+                                         self.prefix + '.collapsed'])
+        functions = [name for (path, line, name) in
+                     pstats.Stats(self.prefix + '.pstats').stats]
+        self.assertIn('busy', functions)
+        with open(self.prefix + '.collapsed') as collapsed:
+            stack, count = collapsed.readline().rsplit(' ', 1)
+        self.assertIn('busy (test_profiling.py:', stack)
+        self.assertGreater(int(count), 0)
+        self.assertTrue(any(' busy (test_profiling.py:' in line
+                            for line in profile.report()))
+
+    def test_sample_mode_reports_hot_functions(self):
+        profile = profiling.Profile('sample', self.prefix, interval=0.001)
+        profile.run(busy, 0.1)
+
+        self.assertEqual(profile.paths, [self.prefix + '.collapsed'])
+        name, own, total = profile.sampler.top(1)[0]
+        self.assertLessEqual(own, total)
+        self.assertTrue(any('busy' in line for line in profile.report()))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            profiling.Profile('perf', self.prefix)
+
+
+if __name__ == '__main__':
+    unittest.main()
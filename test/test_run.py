@@ -0,0 +1,114 @@
+import sys
+sys.path.append('ttags/')
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+import app
+import metrics
+import run
+from test.test_app import FakeTool, fake_account
+
+
+def printed(call):
+    """ Everything printed while running call, one string per print. """
+    with mock.patch('builtins.print') as printer, \
+            mock.patch('run.pprint') as pprinter:
+        call()
+    return [' '.join(str(arg) for arg in args[0])
+            for args in printer.call_args_list + pprinter.call_args_list]
+
+
+class CLITest(unittest.TestCase):
+
+    def setUp(self):
+        boards, lists = fake_account()
+        boards.append({'name': 'Board Two', 'id': 'b2', 'lists': [
+            {'name': 'list4', 'id': 'l4'}]})
+        lists['l4'] = [{'name': 'card4', 'id': 'c4', 'desc': '',
+                        'labels': [{'name': 'feature', 'id': 'lb4'}]}]
+        self.App = app.TrelloApp(app_metrics=metrics.Metrics())
+        self.App.authenticated = True
+        self.App.tool = FakeTool(boards, lists)
+        self.App.initialize()
+        self.cli = run.TrelloCLI(self.App)
+
+    def test_split_scope(self):
+        self.assertEqual(run.split_scope('dry board="Team Board" new'),
+                         (['dry', 'new'], 'Team Board', None))
+        self.assertEqual(run.split_scope('list=l2 board= other'),
+                         (['board=', 'other'], None, 'l2'))
+
+    def test_show_limited_to_a_list(self):
+        lines = printed(lambda: self.cli.onecmd('show list=LIST2'))
+        self.assertEqual(lines[1], "Lists: [BoardList(name='list2', "
+                         "id='l2')]")
+        self.assertIn("'id': 'c2'", lines[2])
+        self.assertNotIn("'id': 'c1'", lines[2])
+        self.assertEqual(printed(lambda: self.cli.onecmd('show board=nope')),
+                         ['No board called nope.'])
+
+    def test_suggest_limited_to_a_board(self):
+        with mock.patch('builtins.input', side_effect=['y', 'bug']):
+            lines = printed(lambda: self.cli.onecmd(
+                'suggest dry board="board1"'))
+        self.assertIn("Dry run, would merge ['bugs'] into bug.", lines)
+        with mock.patch('builtins.input') as asked:
+            printed(lambda: self.cli.onecmd('suggest board="Board Two"'))
+        self.assertFalse(asked.called)
+
+    def test_stats_exports(self):
+        self.cli.onecmd('stats reset')
+        self.App.tool = FakeTool(*fake_account())
+        printed(lambda: self.cli.onecmd('reinit'))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stats.json')
+            printed(lambda: self.cli.onecmd('stats json ' + path))
+            with open(path) as exported:
+                self.assertEqual(json.load(exported)['phases']['load']['runs'],
+                                 1)
+        lines = printed(lambda: self.cli.onecmd('stats prometheus'))
+        self.assertIn('ttags_phase_runs_total{phase="load"} 1', lines[0])
+        self.assertEqual(printed(lambda: self.cli.onecmd('stats bogus')),
+                         ["Unknown option bogus, see 'help stats'."])
+
+    def test_watch_needs_a_port_number(self):
+        self.assertEqual(
+            printed(lambda: self.cli.onecmd('watch http://x notaport')),
+            ["notaport is not a port, use 'watch URL [PORT]'."])
+
+    def test_profile_suggest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, 'out')
+            lines = printed(lambda: self.cli.onecmd(
+                'profile suggest sample ' + prefix))
+            self.assertEqual(os.listdir(directory), ['out.collapsed'])
+        self.assertEqual(lines[0], 'Wrote {}.collapsed.'.format(prefix))
+        self.assertEqual(lines[-1], 'Found 1 groups of similar labels.')
+        self.assertEqual(printed(lambda: self.cli.onecmd('profile')),
+                         ["Profile what? Use 'profile reinit' or "
+                          "'profile suggest'."])
+
+
+class ParseArgsTest(unittest.TestCase):
+
+    def test_profile_mode_from_the_environment(self):
+        with mock.patch.dict(os.environ, {'TTAGS_PROFILE': 'sample'}):
+            self.assertEqual(run.parse_args([]).profile, 'sample')
+        with mock.patch.dict(os.environ, {'TTAGS_PROFILE': 'bogus'}), \
+                mock.patch('sys.stderr'), \
+                self.assertRaises(SystemExit):
+            run.parse_args([])
+
+    def test_lazy_needs_the_cards(self):
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            run.parse_args(['--lazy', '--board-at-a-time'])
+
+    def test_make_engine(self):
+        args = run.parse_args(['--engine', 'matrix'])
+        self.assertIsInstance(run.make_engine(args), run.MatrixEngine)
+
+
+if __name__ == '__main__':
+    unittest.main()
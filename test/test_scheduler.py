@@ -0,0 +1,73 @@
+import sys
+sys.path.append('ttags/')
+import threading
+import unittest
+import scheduler
+from test.test_model import FakeClock
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = scheduler.TokenBucket(4, 1, burst=2, clock=self.clock)
+
+    def test_bursts_up_to_burst(self):
+        self.assertEqual([self.bucket.reserve() for _ in range(4)],
+                         [0, 0, 0.5, 1.0])
+
+    def test_refills_over_time(self):
+        self.bucket.reserve()
+        self.bucket.reserve()
+        self.clock.sleep(0.5)
+        self.assertEqual(self.bucket.reserve(), 0)
+
+    def test_slows_down_and_recovers(self):
+        self.bucket.slow_down()
+        self.assertEqual(self.bucket.rate, 1)
+        self.assertEqual(self.bucket.reserve(), 1)
+        for _ in range(32):
+            self.bucket.speed_up()
+        self.assertEqual(self.bucket.rate, 2)
+
+    def test_no_window_exceeds_the_limit(self):
+        clock = FakeClock()
+        buckets = [scheduler.TokenBucket(*scheduler.KEY_LIMIT, clock=clock),
+                   scheduler.TokenBucket(*scheduler.TOKEN_LIMIT, clock=clock)]
+        pacer = scheduler.Scheduler(buckets, clock=clock, sleep=clock.sleep)
+        sent = []
+        for _ in range(500):
+            pacer.wait_turn()
+            sent.append(clock())
+        limit, interval = scheduler.TOKEN_LIMIT
+        for first, start in enumerate(sent):
+            in_window = [when for when in sent[first:]
+                         if when <= start + interval]
+            self.assertLessEqual(len(in_window), limit)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_pause_holds_back_callers(self):
+        clock = FakeClock()
+        bucket = scheduler.TokenBucket(100, 1, clock=clock)
+        pacer = scheduler.Scheduler([bucket], clock=clock, sleep=clock.sleep)
+        pacer.pause(5)
+        pacer.wait_turn()
+        self.assertEqual(clock.sleeps, [5])
+
+    def test_submit_runs_concurrently(self):
+        pacer = scheduler.Scheduler([], workers=4)
+        barrier = threading.Barrier(4, timeout=5)
+        futures = [pacer.submit(barrier.wait) for _ in range(4)]
+        self.assertEqual(sorted(f.result() for f in futures), [0, 1, 2, 3])
+
+    def test_buckets_are_shared_per_name(self):
+        first = scheduler.Scheduler.for_credentials('key', 'token1')
+        second = scheduler.Scheduler.for_credentials('key', 'token2')
+        self.assertIs(first.buckets[0], second.buckets[0])
+        self.assertIsNot(first.buckets[1], second.buckets[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import sys
+sys.path.append('ttags/')
+import json
+import unittest
+import requests
+import app
+import server
+from test.test_model import FakeResponse
+
+SECRET = 'app secret'
+CALLBACK_URL = 'https://example.com/trello'
+
+# Webhook callbacks as trello sends them, trimmed to what is used.
+RECORDED = [
+    {'action': {'type': 'addLabelToCard', 'data': {
+        'card': {'id': 'c2', 'name': 'card2'},
+        'label': {'id': 'lb1', 'name': 'bug', 'color': 'red'}}}},
+    {'action': {'type': 'removeLabelFromCard', 'data': {
+        'card': {'id': 'c2', 'name': 'card2'},
+        'label': {'id': 'lb2', 'name': 'bugs', 'color': 'red'}}}},
+    {'action': {'type': 'createCard', 'data': {
+        'card': {'id': 'c4', 'name': 'card4'},
+        'list': {'id': 'l1', 'name': 'list1'}}}},
+    {'action': {'type': 'addLabelToCard', 'data': {
+        'card': {'id': 'c4', 'name': 'card4'},
+        'label': {'id': 'lb3', 'name': 'feature', 'color': 'green'}}}},
+    {'action': {'type': 'updateLabel', 'data': {
+        'label': {'id': 'lb3', 'name': 'feature request'},
+        'old': {'name': 'feature'}}}},
+    {'action': {'type': 'updateCard', 'data': {
+        'card': {'id': 'c3', 'name': 'card3', 'closed': True},
+        'old': {'closed': False}}}}
+]
+
+
+def post(url, payload, secret=SECRET):
+    body = json.dumps(payload).encode()
+    return requests.post(url, data=body, headers={
+        'X-Trello-Webhook': server.webhook_signature(secret, body,
+                                                     CALLBACK_URL)})
+
+
+class WebhookServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.actions = []
+        self.server = server.WebhookServer(0, SECRET, CALLBACK_URL,
+                                           self.actions.append).start()
+        self.url = 'http://localhost:{}/'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_answers_trello_check(self):
+        self.assertEqual(requests.head(self.url).status_code, 200)
+
+    def test_rejects_bad_signatures(self):
+        response = post(self.url, RECORDED[0], secret='wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.actions, [])
+
+    def test_replayed_events_update_the_app(self):
+        App = app.TrelloApp()
+        App.Cards = app.TrelloApp.extract_cards([
+            {'name': 'card1', 'id': 'c1', 'idList': 'l1',
+             'labels': [{'name': 'bug', 'id': 'lb1'}]},
+            {'name': 'card2', 'id': 'c2', 'idList': 'l2',
+             'labels': [{'name': 'bugs', 'id': 'lb2'}]},
+            {'name': 'card3', 'id': 'c3', 'idList': 'l3', 'labels': []}])
+        App.index_cards()
+        self.server.on_action = App.events.append
+
+        for payload in RECORDED:
+            self.assertEqual(post(self.url, payload).status_code, 200)
+        self.assertEqual(App.apply_events(), len(RECORDED))
+
+        self.assertEqual(App.index.names(), ['bug', 'feature request'])
+        self.assertEqual(App.index.cards_with('lb1'), ['c1', 'c2'])
+        self.assertEqual([card.id for card in App.Cards], ['c1', 'c2', 'c4'])
+        self.assertEqual(App.card_map['c4'].label_dicts(),
+                         [{'name': 'feature request', 'id': 'lb3'}])
+        self.assertEqual(App.card_map['c2'].label_dicts(),
+                         [{'name': 'bug', 'id': 'lb1'}])
+        self.assertFalse(App.dirty)
+
+    def test_dropped_cards_leave_the_others_findable(self):
+        App = app.TrelloApp()
+        App.Cards = app.TrelloApp.extract_cards([
+            {'name': name, 'id': name, 'idList': 'l1', 'labels': []}
+            for name in ('c1', 'c2', 'c3', 'c4')])
+        App.index_cards()
+        App.drop_card('c2')
+        App.drop_card('c4')
+        App.drop_card('missing')
+        self.assertEqual([card.id for card in App.Cards], ['c1', 'c3'])
+        self.assertEqual(App.card_positions, {'c1': 0, 'c3': 1})
+
+    def test_watching_again_replaces_the_webhooks(self):
+        class WebhookTool:
+            def __init__(self):
+                self.webhooks = []
+
+            def post_webhook(self, board_id, callback_url):
+                self.webhooks.append(board_id)
+                return FakeResponse(200, content=json.dumps(
+                    {'id': 'w-' + board_id}).encode())
+
+            def delete_webhook(self, webhook_id):
+                self.webhooks.remove(webhook_id[2:])
+
+        App = app.TrelloApp()
+        App.Boards = app.TrelloApp.parse_boards_json(
+            [{'name': 'board1', 'id': 'b1', 'lists': []}])
+        App.tool = WebhookTool()
+        App.watch(CALLBACK_URL, 0, SECRET)
+        App.watch(CALLBACK_URL, 0, SECRET)
+        self.assertEqual(App.tool.webhooks, ['b1'])
+        self.assertEqual(App.webhooks, ['w-b1'])
+        App.unwatch()
+        self.assertEqual(App.tool.webhooks, [])
+
+    def test_echo_of_own_merge_changes_nothing(self):
+        App = app.TrelloApp()
+        App.Cards = app.TrelloApp.extract_cards([
+            {'name': 'card2', 'id': 'c2', 'idList': 'l2',
+             'labels': [{'name': 'bug', 'id': 'lb1'}]}])
+        App.index_cards()
+        App.apply_event(RECORDED[0]['action'])
+        self.assertEqual(App.card_map['c2'].label_dicts(),
+                         [{'name': 'bug', 'id': 'lb1'}])
+        self.assertEqual(App.index.cards_with('lb1'), ['c2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
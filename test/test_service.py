@@ -0,0 +1,243 @@
+import sys
+sys.path.append('ttags/')
+import json
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import requests
+import cluster
+import service
+from test.test_app import FakeTool, fake_account
+from test.test_merge import RecordingTool
+from test.test_model import FakeResponse
+
+
+def private_account():
+    """ A board of its own, only token tb can see. """
+    boards = [{'name': 'private', 'id': 'b9',
+               'dateLastActivity': '2017-01-01T00:00:00.000Z',
+               'lists': [{'name': 'secret', 'id': 'l9'}]}]
+    lists = {'l9': [{'name': 'card9', 'id': 'c9', 'desc': '',
+                     'labels': [{'name': 'salary', 'id': 'lb9'},
+                                {'name': 'salaries', 'id': 'lb10'}]}]}
+    return boards, lists
+
+
+class SharedTool(FakeTool, RecordingTool):
+    """
+    Every user sees the same board, but for token tb which sees only a
+    private one. Counts fetches across users.
+    """
+    BATCH_LIMIT = 10
+    fetches = 0
+    delay = 0
+
+    def __init__(self, credentials, **kwargs):
+        if credentials['token'] == 'tb':
+            boards, lists = private_account()
+        else:
+            boards, lists = fake_account()
+        boards[0]['dateLastActivity'] = '2017-01-01T00:00:00.000Z'
+        FakeTool.__init__(self, boards, lists)
+        RecordingTool.__init__(self)
+        self.token = credentials['token']
+
+    def get_member(self):
+        # every token of a user belongs to the same member
+        return FakeResponse(200, content=json.dumps(
+            {'id': 'member-' + self.token[:2]}).encode())
+
+    def iter_boards_cards(self, board_ids):
+        SharedTool.fetches += 1
+        time.sleep(SharedTool.delay)
+        return FakeTool.iter_boards_cards(self, board_ids)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_call(self):
+        flights = service.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'cards'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flights.do('b1', slow)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(
+            target=lambda: results.append(flights.do('b1', slow)))
+        follower.start()
+        while not flights.coalesced:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(results, ['cards', 'cards'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.flights, dict())
+
+
+class ServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        SharedTool.fetches = 0
+        SharedTool.delay = 0
+        patcher = mock.patch('model.TrelloTool', SharedTool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = service.Service(
+            lambda scores: cluster.BlockedEngine(scores=scores))
+        self.server = service.ServiceServer(self.service).start()
+        self.addCleanup(self.server.stop)
+        self.url = 'http://localhost:{}'.format(self.server.server_port)
+
+    def open_session(self, token):
+        response = requests.post(self.url + '/sessions',
+                                 json={'key': 'k', 'token': token})
+        return response.status_code, response.json()['session']
+
+    def test_users_share_fetched_boards(self):
+        status, first = self.open_session('t1')
+        self.assertEqual(status, 201)
+        status, second = self.open_session('t2')
+        self.assertEqual(status, 201)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.open_session('t1'), (200, first))
+
+        self.assertEqual(SharedTool.fetches, 1)
+        stats = requests.get(self.url + '/stats').json()
+        self.assertEqual(stats['sessions'], 2)
+        self.assertEqual(stats['boards']['hits'], 1)
+
+    def test_users_only_get_their_own_boards(self):
+        SharedTool.delay = 0.2
+        sessions = dict()
+
+        def open_session(token):
+            sessions[token] = self.open_session(token)[1]
+
+        threads = [threading.Thread(target=open_session, args=(token,))
+                   for token in ('ta', 'tb', 'tc')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        def seen(token):
+            the_app = self.service.sessions[sessions[token]].app
+            return ([board.id for board in the_app.Boards],
+                    sorted(the_app.card_map))
+
+        self.assertEqual(seen('ta'), (['b1'], ['c1', 'c2', 'c3']))
+        self.assertEqual(seen('tc'), (['b1'], ['c1', 'c2', 'c3']))
+        self.assertEqual(seen('tb'), (['b9'], ['c9']))
+        groups = requests.get('{}/sessions/{}/suggest'.format(
+            self.url, sessions['ta'])).json()['groups']
+        self.assertEqual([sorted(group) for group in groups],
+                         [['bug', 'bugs']])
+        # b1 fetched once for ta and tc, b9 once for tb
+        self.assertEqual(SharedTool.fetches, 2)
+        stats = requests.get(self.url + '/stats').json()
+        self.assertEqual(stats['boards']['misses'] + stats['boards']['hits'],
+                         3)
+
+    def test_concurrent_loads_of_a_board_are_coalesced(self):
+        SharedTool.delay = 0.2
+        threads = [threading.Thread(target=self.open_session,
+                                    args=('t{}'.format(n),))
+                   for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(SharedTool.fetches, 1)
+        self.assertEqual(len(self.service.sessions), 3)
+
+    def test_suggest_and_merge(self):
+        status, session = self.open_session('t1')
+        _, other = self.open_session('t2')
+        base = '{}/sessions/{}'.format(self.url, session)
+
+        groups = requests.get(base + '/suggest').json()['groups']
+        self.assertEqual([sorted(group) for group in groups],
+                         [['bug', 'bugs']])
+        planned = requests.post(base + '/merge', json={
+            'labels': ['bug', 'bugs'], 'into': 'bug', 'dry_run': True}).json()
+        self.assertEqual(planned['plan'][0], '1 cards, 2 operations:')
+
+        merged = requests.post(base + '/merge', json={
+            'labels': ['bug', 'bugs'], 'into': 'bug'}).json()
+        self.assertEqual(merged['failures'], [])
+        self.assertEqual(requests.get(base + '/suggest').json()['groups'], [])
+        # the other user's copy of the board is their own
+        other_app = self.service.sessions[other].app
+        self.assertEqual(other_app.index.names(), ['bug', 'bugs'])
+
+    def test_errors(self):
+        self.assertEqual(requests.get(
+            self.url + '/sessions/nope/suggest').status_code, 404)
+        self.assertEqual(requests.post(self.url + '/sessions',
+                                       data='[1').status_code, 400)
+        _, session = self.open_session('t1')
+        response = requests.post(
+            '{}/sessions/{}/merge'.format(self.url, session),
+            json={'labels': ['bugs'], 'into': 'missing'})
+        self.assertEqual(response.status_code, 400)
+        response = requests.post(
+            '{}/sessions/{}/merge'.format(self.url, session),
+            json={'labels': [['bugs']], 'into': 'bug'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unexpected_errors_are_answered(self):
+        _, session = self.open_session('t1')
+        with mock.patch.object(self.service, 'suggest',
+                               side_effect=RuntimeError('broken')):
+            response = requests.get(
+                '{}/sessions/{}/suggest'.format(self.url, session))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(), {'error': 'RuntimeError: broken'})
+
+    def test_merge_reloads_after_a_failed_merge(self):
+        _, session = self.open_session('t1')
+        the_app = self.service.sessions[session].app
+        the_app.dirty = True
+        fetches = SharedTool.fetches
+        merged = requests.post(
+            '{}/sessions/{}/merge'.format(self.url, session),
+            json={'labels': ['bug', 'bugs'], 'into': 'bug'}).json()
+        self.assertEqual(merged['failures'], [])
+        self.assertFalse(the_app.dirty)
+        # the board has not changed, the shared copy is reused
+        self.assertEqual(SharedTool.fetches, fetches)
+
+    def test_journals_follow_the_member_not_the_token(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.service.journal_dir = directory
+            _, first = self.open_session('t1-login1')
+            _, again = self.open_session('t1-login2')
+            _, other = self.open_session('t2-login1')
+            journals = [self.service.sessions[session].app.journal.path
+                        for session in (first, again, other)]
+        self.assertEqual(journals[0], journals[1])
+        self.assertNotEqual(journals[0], journals[2])
+
+    def test_prometheus_stats(self):
+        self.open_session('t1')
+        response = requests.get(self.url + '/stats?format=prometheus')
+        self.assertIn('ttags_phase_runs_total{phase="load"}',
+                      response.text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import sys
+sys.path.append('ttags/')
+import json
+import unittest
+import stream
+
+
+def chunked(document, size):
+    data = json.dumps(document, ensure_ascii=False).encode()
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+class IterValuesTest(unittest.TestCase):
+
+    def test_yields_array_items_across_chunk_boundaries(self):
+        cards = [{'name': 'café "quoted", [x]', 'id': 'c1',
+                  'labels': [{'name': 'a\\b', 'id': 'l1'}]},
+                 {'name': '{}', 'id': 'c2', 'labels': []}]
+        for size in (1, 2, 5, 1000):
+            values = list(stream.iter_values(chunked(cards, size)))
+            self.assertEqual(values, [((0,), cards[0]), ((1,), cards[1])])
+
+    def test_paths_and_shallow_scalars(self):
+        batch = [{'200': [{'id': 'c1'}]}, {'statusCode': 404}, {'200': []}]
+        values = list(stream.iter_values(chunked(batch, 3), depth=3))
+        self.assertEqual(values, [((0, '200', 0), {'id': 'c1'}),
+                                  ((1, 'statusCode'), 404)])
+
+    def test_empty_array(self):
+        self.assertEqual(list(stream.iter_values([b' [ ] '])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
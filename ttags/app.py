@@ -4,94 +4,132 @@ Class that contains the main application functionality.
 
 import auth
 import model
+import cluster
+import index
 import json
-from random import choice
-from fuzzywuzzy import fuzz
-from difflib import get_close_matches
+import merge
+import metrics
+import records
+import server
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
 
 class TrelloApp:
 
-    def __init__(self):
+    def __init__(self, engine=None, workers=8, bulk=True, cache=None,
+                 board_at_a_time=False, memory_budget=None,
+                 app_metrics=None, journal=None, lazy=False,
+                 journal_dir=None):
         self.credentials = None
         self.authenticated = False
         self.tool = None
         self.dirty = False
+        # groups similar label names, see cluster.py
+        self.engine = engine or cluster.BlockedEngine()
+        # number of requests for lists or boards made at the same time
+        self.workers = workers
+        # fetch cards board by board in batches instead of list by list
+        self.bulk = bulk
+        # cards of unchanged boards are read from here, see cache.py
+        self.cache = cache
+        # load one board at a time and keep only the label index, not the
+        # cards, for accounts too large to hold in memory
+        self.board_at_a_time = board_at_a_time
+        # bytes the index may use before it spills to disk, None for no limit
+        self.memory_budget = memory_budget
+        # load only the boards and their lists up front, and the cards of a
+        # board once a command needs them
+        self.lazy = lazy
+        # ids of the boards whose cards are loaded, when loading lazily, and
+        # whether they may come from the cache
+        self.loaded_boards = set()
+        self.lazy_use_cache = True
 
         self.Boards = []
         self.Lists = []
         self.Cards = []
+        # similar label groups kept between suggest runs, so later runs
+        # only look at labels that changed, see cluster.ClusterState
+        self.clusters = None
+        # label index and card id -> card dict, built from self.Cards
+        self.index = None
+        self.card_map = dict()
+        # card id -> position in self.Cards, so cards are dropped in O(1)
+        self.card_positions = dict()
+        # (list dict, error) for every list that could not be loaded
+        self.failed_lists = []
+        # wall time of loading, indexing, clustering and merging, and the
+        # requests the tool makes, see metrics.py
+        self.metrics = app_metrics or metrics.DEFAULT
+        # merges are written here as they run so they can be resumed,
+        # see merge.Journal
+        self.journal = journal
+        # or, given a directory, a journal per trello member is opened
+        # there on connecting, see merge.journal_path
+        self.journal_dir = journal_dir
+        # webhook actions received but not applied yet, the receiver runs
+        # on its own thread and only ever appends
+        self.events = deque()
+        # receiver of trello's webhook callbacks and the webhook ids, while
+        # watching
+        self.webhook_server = None
+        self.webhooks = []
 
     @staticmethod
     def parse_boards_json(boards_json):
         """
         Take an array (parsed from json) of boards and return
-        a more usable array of board items.
+        a more usable array of Board records.
         """
         board_arr = []
 
         for board in boards_json:
-            board_dict = dict()
-            board_dict["name"] = board.get('name')
-            board_dict["id"] = board.get('id')
-            board_dict["lists"] = [
-                {'name': l.get('name'), 'id': l.get('id')} for l in board.get(
-                    'lists')
-            ]
-
-            board_arr.append(board_dict)
+            board_arr.append(records.Board(
+                board.get('name'), board.get('id'),
+                TrelloApp.extract_lists(board),
+                board.get('dateLastActivity')))
 
         return board_arr
 
     @staticmethod
     def extract_lists(board_dict):
         """
-        Take a board and return the lists in that board in a useable format.
-        Returns a list of list dicts.
+        Take a board (parsed from json) and return the lists in that
+        board in a useable format. Returns a list of BoardList records.
         """
         list_arr = []
         for _list in board_dict.get('lists'):
-            list_dict = dict()
-            list_dict['name'] = _list.get('name')
-            list_dict['id'] = _list.get('id')
-            list_arr.append(list_dict)
+            list_arr.append(records.BoardList(_list.get('name'),
+                                              _list.get('id')))
         return list_arr
 
     @staticmethod
     def extract_cards(arr_of_cards):
         """
-        Take a list of cards and return the cards in a useable format.
-        Returns a list of card dicts with unused data removed.
+        Take a list of cards, or any iterable yielding them, and return
+        the cards in a useable format.
+        Returns a list of Card records with unused data removed.
         """
-        card_arr = []
-        for card in arr_of_cards:
-            card_dict = dict()
-            card_dict["name"] = card.get('name')
-            card_dict["id"] = card.get('id')
-            card_dict["labels"] = [
-                {'name': l.get('name'), 'id': l.get('id')} for l in card.get(
-                    'labels')
-            ]
-            card_arr.append(card_dict)
-
-        return card_arr
+        return [records.Card.from_json(card) for card in arr_of_cards]
 
     def prepare_labels(self, cards):
         """
         Process the cards into two dicts that keep track of:
         label_name -> (label_name, label_id) and
-        (label_name, label_id) -> [{card dict}].
+        (label_name, label_id) -> [Card].
         These will be helpfull when replacing the tags.
         """
-        # (label name, label id) -> [{card dict}]
+        # (label name, label id) -> [Card]
         label_card_map = dict()
 
         # label name -> (label name, label id)
         name_label_map = dict()
 
         for card in cards:
-            labels = card['labels']
+            labels = card.label_dicts()
             for label in labels:
                 label_tuple = (label.get('name'), label.get('id'))
                 if label_tuple not in label_card_map.keys():
@@ -111,64 +149,125 @@ class TrelloApp:
         Use python's builtin get_diff_lib function along with
         a bit of randomness to decide which words are similar
         """
-        # array to hold groups of labels with similar names
-        label_groups = []
-        # randomly select seed and group the names
-        while len(label_names) > 0:
-            seed = choice(label_names)
-            # get close matches, must be unique
-            similar_names = list(
-                set(get_close_matches(seed, label_names, cutoff=0.4)))
-            # add the seed to the close matches, add to label groups
-            label_groups.append(similar_names)
-            # Remove those names from the pool
-            label_names = [x for x in label_names if x not in similar_names]
-
-        # keep only those groups that have more than 1 element in it
-        label_groups = [group for group in label_groups if len(group) > 1]
-        return label_groups
+        return self.engine.simple(label_names)
 
     def get_similar_leven(self, label_names):
         """
         Get similar labels using levenshtein distance. No randomness here.
         """
-        # array to hold groups of labels with similar names
-        label_groups = []
-        # randomly select seed and group the names
-        while len(label_names) > 0:
-            label_names.sort()
-            seed = label_names[0]
-            # get close matches, make sure the list is unique
-            similar_names = list(set([name for name in label_names if
-                                      fuzz.ratio(seed, name.replace('_', ' ').
-                                                 replace('-', ' ')) > 40]))
-            # add the seed to the close matches, add to label groups
-            label_groups.append(similar_names)
-            # Remove those names from the pool
-            label_names = [name for name in label_names if
-                           name not in similar_names]
-
-        # keep only those groups that have more than 1 element in it
-        label_groups = [group for group in label_groups if len(group) > 1]
+        return self.engine.leven(label_names)
 
+    def changed_label_groups(self):
+        """
+        Groups of similar labels that changed since the last call. Only
+        labels added or removed since then are compared, the first call
+        compares every label.
+        """
+        if self.clusters is None:
+            self.clusters = cluster.ClusterState(self.engine.threshold,
+                                                 self.engine.ratio())
+        label_groups = self.clusters.update(self.index.names())
+        self.engine.save_scores()
         return label_groups
 
-    def suggest_similar(self):
+    @staticmethod
+    def matches(record, wanted):
+        """ Whether a board or list is called wanted or has it as id. """
+        return (record.id == wanted or
+                (record.name or '').lower() == wanted.lower())
+
+    def find_scope(self, board=None, board_list=None):
         """
-        Suggest sumilar labels and give the option to merge them.
+        The boards a command given a board and a list, each by name or
+        id, is limited to, and the ids of the lists it is limited to, None
+        for every list on them. Names are matched ignoring case.
+        Raises ValueError if nothing matches, or if loading a board at a
+        time, which keeps no cards to limit a command to.
+        """
+        if self.board_at_a_time and (board is not None or
+                                     board_list is not None):
+            raise ValueError('Loading a board at a time keeps no cards to '
+                             'limit a command to.')
+        boards = self.Boards
+        if board is not None:
+            boards = [found for found in boards
+                      if self.matches(found, board)]
+            if not boards:
+                raise ValueError('No board called {}.'.format(board))
+        list_ids = None
+        if board_list is not None:
+            list_ids = set(_list.id for found in boards
+                           for _list in found.lists
+                           if self.matches(_list, board_list))
+            if not list_ids:
+                raise ValueError('No list called {}.'.format(board_list))
+            boards = [found for found in boards
+                      if any(_list.id in list_ids for _list in found.lists)]
+        return boards, list_ids
+
+    def cards_in(self, boards, list_ids=None):
+        """ The loaded cards on boards, only those in list_ids if given. """
+        if list_ids is None:
+            list_ids = set(_list.id for board in boards
+                           for _list in board.lists)
+        return [card for card in self.Cards if card.list_id in list_ids]
+
+    def scoped_index(self, board=None, board_list=None):
+        """
+        Label index of the cards on a board and list, see find_scope, or
+        the index of every card without either.
+        """
+        if board is None and board_list is None:
+            return self.index
+        return index.LabelIndex.from_cards(
+            self.cards_in(*self.find_scope(board, board_list)))
+
+    def prepare(self, board=None, board_list=None):
+        """
+        Get the data ready for a command limited to a board and list, see
+        find_scope: reload it if dirty, load the cards still missing when
+        loading lazily and apply the webhook actions received.
+        Returns the label index of the cards in scope.
         """
         # if data is dirty, reinitialize
         if self.dirty:
             self.initialize()
+        if self.lazy:
+            self.load_cards_of(self.find_scope(board, board_list)[0])
 
-        # prepare the dicts that keep track card and label information
-        prepared_labels = self.prepare_labels(self.Cards)
-        label_names = list(prepared_labels[1].keys())
-        label_groups = self.get_similar_leven(label_names)
+        # the index keeps track of card and label information
+        if self.index is None:
+            self.index_cards()
+        self.apply_events()
+        return self.scoped_index(board, board_list)
 
-        label_card_map = prepared_labels[0]
-        label_list = label_card_map.keys()
-        name_label_map = prepared_labels[1]
+    def similar_groups(self, changed_only=False, label_index=None):
+        """
+        Groups of similar labels, or with changed_only those that changed
+        since the last such call. label_index, from prepare, limits the
+        groups to its labels, changed_only is ignored then. This is the
+        part of suggest_similar that asks nothing of the user.
+        """
+        if label_index is None:
+            label_index = self.prepare()
+        with self.metrics.phase('cluster'):
+            if changed_only and label_index is self.index:
+                return self.changed_label_groups()
+            return self.get_similar_leven(label_index.names())
+
+    def suggest_similar(self, dry_run=False, changed_only=False,
+                        label_groups=None, board=None, board_list=None):
+        """
+        Suggest sumilar labels and give the option to merge them.
+        With dry_run, merges are only planned and printed. With
+        changed_only, only groups that changed since the last such run
+        are suggested. label_groups, from similar_groups, skips looking
+        for them again. With a board or a list, by name or id, only the
+        labels and cards there are looked at and merged.
+        """
+        label_index = self.prepare(board, board_list)
+        if label_groups is None:
+            label_groups = self.similar_groups(changed_only, label_index)
 
         # for each group of similar tags, ask if you would like to replace them
         for group in label_groups:
@@ -192,94 +291,565 @@ class TrelloApp:
                     label_name = input(
                         "Choose from - {}:".format(label_options))
 
-                # Now that we have the label name we wish to use, find an id
-                # that matches
-                label_tuple_candidates = [label for label in label_list
-                                          if label[0] == label_name]
-
-                # Multiple labels may have the same name
-                # No way to deal with this without explicitly asking the user.
-                # Just pick the first one for now.
-                if len(label_tuple_candidates) > 1:
-                    print("Multiple labels found. Picking the first one.")
-
-                label_tuple_candidates = label_tuple_candidates[0]
-                # Get the (name, id) tuple from the name -> tuple dict
-                # This gives us the id of the Label that will do the replacing
-                replacing_id = label_tuple_candidates[1]
+                # Multiple labels may have the same name, one per board.
+                # plan_merge gives each card the one on its own board.
 
                 # Replace all other labels in the group with the chosen label
                 # after removing the chosen label from the group.
                 if label_name in group:
                     group.remove(label_name)
-                for replaced_name in group:
-
-                    # Find the label tuple that corresponds to the label being
-                    # replaced. This is the key of the tuple -> card dict.
-                    # there may be different labels with the same name
-                    replaced_label_arr = name_label_map[replaced_name]
-                    for replaced_label in replaced_label_arr:
-                        replaced_id = replaced_label[1]
-
-                        # Replace all the cards that have said label.
-                        # That is, all the cards found in the tuple -> card
-                        # dict.
-                        for card in label_card_map[replaced_label]:
-                            card_id = card.get('id')
-                            self.dirty = True
-                            self.tool.delete_card_label(card_id, replaced_id)
-                            self.tool.post_id_label(card_id, replacing_id)
+                plan = self.plan_merge(group, label_name, label_index)
+
+                if dry_run:
+                    print("Dry run, would merge {} into {}.".format(
+                        group, label_name))
+                    card_names = dict((card_id, card.name) for
+                                      card_id, card in self.card_map.items())
+                    for line in plan.describe(card_names):
+                        print(line)
+                    continue
+
+                failures = self.run_merge(plan)
+                # a scoped index is a copy, rebuild it from the patched cards
+                label_index = self.scoped_index(board, board_list)
+                print("Merged into {} with {} operations.".format(
+                    label_name, plan.operation_count()))
+                if plan.skipped:
+                    print("Left {} cards alone, their board has no label "
+                          "called {}.".format(len(plan.skipped), label_name))
+                for update, error in failures:
+                    card = self.card_map.get(update.card_id)
+                    print("  Could not update {} ({})".format(
+                        card.name if card else update.card_id, error))
+                if failures and self.journal is not None:
+                    print("Run resume to retry them.")
             else:
                 print("Not replacing, moving on.")
 
-    def initialize(self):
-        """Pull user's data from trello and process them for later use."""
+    def plan_merge(self, replaced_names, label_name, label_index=None):
+        """
+        The MergePlan putting the label called label_name on every card
+        carrying a label called one of replaced_names instead. Labels
+        belong to a board, so each card gets the one on its own board and
+        cards on boards without one are left alone. Only the cards in
+        label_index, from prepare, are planned for if given.
+        """
+        if label_index is None:
+            label_index = self.index
+        replacing_ids = label_index.ids_for(label_name)
+        # Find the labels being replaced, there may be different
+        # labels with the same name.
+        replaced_ids = [label_id for replaced_name in replaced_names
+                        if replaced_name != label_name
+                        for label_id in label_index.ids_for(replaced_name)]
+
+        list_boards = dict((_list.id, board.id) for board in self.Boards
+                           for _list in board.lists)
+
+        def board_of(card_id):
+            card = self.card_map.get(card_id)
+            return list_boards.get(card.list_id) if card else None
+
+        # board id -> the label called label_name there
+        board_labels = dict()
+        for label_id in replacing_ids:
+            for card_id in label_index.cards_with(label_id)[:1]:
+                board_labels.setdefault(board_of(card_id), label_id)
+
+        def replacing_for(card_id):
+            for label_id in replacing_ids:
+                if label_index.has_label(card_id, label_id):
+                    return label_id
+            board_id = board_of(card_id)
+            if board_id is None:
+                # boards are not known when loading a board at a time
+                return replacing_ids[0]
+            return board_labels.get(board_id)
+
+        return merge.compile_plan(label_index, replacing_ids[0], replaced_ids,
+                                  label_name, replacing_for)
+
+    def run_merge(self, plan):
+        """
+        Execute a plan. Cards and the index are patched as updates go
+        through. Only a failed update leaves the data out of step with
+        trello and calls for a reload.
+        Returns (update, error) for every update that failed.
+        """
+        with self.metrics.phase('merge'):
+            failures = merge.execute_plan(
+                self.tool, plan, on_success=lambda update: self.
+                record_update(update, plan.replacing_name),
+                journal=self.journal)
+        if failures:
+            self.dirty = True
+        return failures
+
+    def unfinished_merges(self):
+        """ (plan id, plan) for the journaled merges left unfinished. """
+        if self.journal is None:
+            return []
+        return self.journal.unfinished()
+
+    def resume_merges(self):
+        """
+        Run the steps of journaled merges that did not go through, and
+        nothing else. Returns (update, error) for those failing again.
+        """
+        failures = []
+        for plan_id, plan in self.unfinished_merges():
+            print("Resuming the merge into {}: {} operations left.".format(
+                plan.replacing_name, plan.operation_count()))
+            with self.metrics.phase('merge'):
+                failures += merge.execute_plan(
+                    self.tool, plan, on_success=lambda update, name=plan.
+                    replacing_name: self.record_update(update, name),
+                    journal=self.journal, plan_id=plan_id)
+        if failures:
+            self.dirty = True
+        return failures
+
+    def new_index(self):
+        """ An empty label index, spilling to disk past memory_budget. """
+        if self.memory_budget is None:
+            return index.LabelIndex()
+        return index.SpillingLabelIndex(self.memory_budget)
+
+    def index_cards(self):
+        """ Build the label index and card lookup for the current cards. """
+        with self.metrics.phase('index'):
+            self.index = self.new_index()
+            for card in self.Cards:
+                self.index.add_card(card)
+            self.card_map = dict((card.id, card) for card in self.Cards)
+            self.card_positions = dict((card.id, position) for position, card
+                                       in enumerate(self.Cards))
+
+    def record_update(self, update, replacing_name):
+        """
+        Bring the index and the in-memory card in line with a card update
+        that went through, so later groups in the same session see it.
+        """
+        card_id = update.card_id
+        for label_id in update.removes:
+            self.index.remove_label(card_id, label_id)
+        if update.add:
+            self.index.add_label(card_id, update.add, replacing_name)
+
+        card = self.card_map.get(card_id)
+        if card is not None:
+            labels = [handle for handle in card.labels
+                      if records.LABELS.ids[handle] not in update.removes]
+            # trello echoes our own changes back through webhooks
+            if update.add and update.add not in [
+                    records.LABELS.ids[handle] for handle in labels]:
+                labels.append(records.LABELS.intern(update.add,
+                                                    replacing_name))
+            card.labels = tuple(labels)
+
+    def watch(self, callback_url, port, secret):
+        """
+        Receive trello's webhook callbacks on port and register a webhook
+        for every board, so changes made elsewhere reach the cards and
+        the index without a reload. callback_url is where trello posts,
+        it has to reach port. Webhooks of an earlier watch are deleted
+        first. Returns the boards trello refused.
+        """
+        self.unwatch()
+        if self.webhook_server is None:
+            self.webhook_server = server.WebhookServer(
+                port, secret, callback_url, self.events.append).start()
+        refused = []
+        for board in self.Boards:
+            response = self.tool.post_webhook(board.id, callback_url)
+            if response.status_code == 200:
+                self.webhooks.append(
+                    json.loads(response.content.decode())['id'])
+            else:
+                refused.append(board)
+        return refused
+
+    def unwatch(self):
+        """ Delete the webhooks and stop receiving callbacks. """
+        for webhook_id in self.webhooks:
+            self.tool.delete_webhook(webhook_id)
+        self.webhooks = []
+        if self.webhook_server is not None:
+            self.webhook_server.stop()
+            self.webhook_server = None
+
+    def apply_events(self):
+        """ Apply the webhook actions received so far, in order. """
+        applied = 0
+        while self.events:
+            if self.apply_event(self.events.popleft()):
+                applied += 1
+        return applied
+
+    def apply_event(self, action):
+        """
+        Bring the cards and the index in line with a trello webhook
+        action. Returns whether the action changed anything kept here.
+        Cards showing up with labels not in the action, such as copied
+        ones, mark the data dirty instead.
+        """
+        if self.index is None:
+            return False
+        kind = action.get('type')
+        data = action.get('data') or dict()
+        card = data.get('card') or dict()
+        label = data.get('label') or dict()
+        board_id = (data.get('board') or dict()).get('id')
+        if self.lazy and board_id not in self.loaded_boards:
+            # the board changed since its activity date was read, forget the
+            # date so its cards are fetched fresh, not read from the cache,
+            # once it is loaded
+            for board in self.Boards:
+                if board.id == board_id:
+                    board.last_activity = None
+            return False
+
+        if kind == 'addLabelToCard':
+            update = merge.CardUpdate(card['id'])
+            update.add = label['id']
+            self.record_update(update, label.get('name'))
+        elif kind == 'removeLabelFromCard':
+            update = merge.CardUpdate(card['id'])
+            update.removes = [label['id']]
+            self.record_update(update, None)
+        elif kind == 'createCard':
+            self.add_card(records.Card(card.get('name'), card['id'], (),
+                                       (data.get('list') or dict()).get('id')))
+        elif kind in ('deleteCard', 'moveCardFromBoard'):
+            self.drop_card(card['id'])
+        elif kind == 'updateCard' and card.get('closed'):
+            # archived cards are not loaded either
+            self.drop_card(card['id'])
+        elif kind == 'updateCard':
+            if 'closed' in (data.get('old') or dict()):
+                # taken out of the archive, with labels not sent along
+                self.dirty = True
+                return False
+            kept = self.card_map.get(card['id'])
+            if kept is None:
+                return False
+            if 'name' in card:
+                kept.name = card['name']
+            if data.get('listAfter'):
+                kept.list_id = data['listAfter']['id']
+        elif kind == 'updateLabel':
+            handle = records.LABELS.intern(label['id'], label.get('name'))
+            for card_id in self.index.cards_with(label['id']):
+                kept = self.card_map.get(card_id)
+                if kept is not None:
+                    kept.labels = tuple(
+                        handle if records.LABELS.ids[old] == label['id']
+                        else old for old in kept.labels)
+            self.index.rename_label(label['id'], label.get('name'))
+        elif kind == 'deleteLabel':
+            for card_id in self.index.cards_with(label['id']):
+                update = merge.CardUpdate(card_id)
+                update.removes = [label['id']]
+                self.record_update(update, None)
+        elif kind in ('copyCard', 'moveCardToBoard',
+                      'convertToCardFromCheckItem'):
+            self.dirty = True
+            return False
+        else:
+            return False
+        return True
+
+    def add_card(self, card):
+        """ Keep a card that was created after loading. """
+        if card.id in self.card_map:
+            return
+        if not self.board_at_a_time:
+            self.card_positions[card.id] = len(self.Cards)
+            self.Cards.append(card)
+            self.card_map[card.id] = card
+        self.index.add_card(card)
+
+    def drop_card(self, card_id):
+        """
+        Forget a card that was deleted, archived or moved away. The last
+        card takes its place in self.Cards, so the cost does not grow
+        with the account.
+        """
+        self.index.remove_card(card_id)
+        card = self.card_map.pop(card_id, None)
+        if card is None:
+            return
+        position = self.card_positions.pop(card_id)
+        last = self.Cards.pop()
+        if last is not card:
+            self.Cards[position] = last
+            self.card_positions[last.id] = position
+
+    def initialize(self, use_cache=True):
+        """
+        Pull user's data from trello and process them for later use.
+        Boards that have not changed since they were cached are not
+        fetched again, unless use_cache is False.
+        """
         if self.authenticated:
             # remove stale data
             self.Boards = list()
             self.Cards = list()
             self.Lists = list()
 
+            # one load phase for the whole reload, less any indexing done
+            # along the way
+            start = time.perf_counter()
+            indexing = 0
+
             # Retrive all the boards of the user
-            self.Boards = json.loads(self.tool.get_boards().content.decode())
+            self.Boards = self.parse_boards_json(
+                json.loads(self.tool.get_boards().content.decode()))
 
             # For each board, extract the information on their lists.
             for board in self.Boards:
-                self.Lists += self.extract_lists(board)
+                self.Lists += board.lists
+
+            self.failed_lists = list()
+            if self.lazy:
+                # cards are loaded board by board, see load_cards_of
+                self.loaded_boards = set()
+                self.lazy_use_cache = use_cache
+                self.index = self.new_index()
+                self.card_map = dict()
+                self.card_positions = dict()
+            elif self.board_at_a_time:
+                indexing = self.index_boards(use_cache)
+            else:
+                loaded, cached = self.load_stale(use_cache)
+
+                for board in self.Boards:
+                    board_id = board.id
+                    if board_id in cached:
+                        self.Cards += cached[board_id]
+                    else:
+                        self.Cards += loaded[board_id]
+            self.metrics.record_phase(
+                'load', time.perf_counter() - start - indexing)
+            if not self.lazy and not self.board_at_a_time:
+                self.index_cards()
 
-            # for each list, extract the information on their cards
-            for _list in self.Lists:
-                _list_id = _list.get('id')
-                list_json = json.loads(
-                    self.tool.get_list(_list_id).content.decode())
-                cards_list = self.extract_cards(list_json)
-                self.Cards += cards_list
+            self.report_failed_lists(self.failed_lists)
 
             # Data is now up to date
             self.dirty = False
 
+    def report_failed_lists(self, failed_lists):
+        if failed_lists:
+            print("Could not load {} of {} lists:".format(
+                len(failed_lists), len(self.Lists)))
+            for _list, error in failed_lists:
+                print("  {} ({})".format(_list.name, error))
+            print("Run reinit to try again.")
+
+    def load_cards_of(self, boards):
+        """
+        Load the cards of those boards that are not loaded yet, when
+        loading lazily. Returns how many boards were loaded.
+        """
+        missing = [board for board in boards
+                   if board.id not in self.loaded_boards]
+        if not missing:
+            return 0
+        failed_before = len(self.failed_lists)
+        with self.metrics.phase('load'):
+            loaded, cached = self.load_stale(self.lazy_use_cache, missing)
+        with self.metrics.phase('index'):
+            for board in missing:
+                for card in cached.get(board.id, loaded.get(board.id)):
+                    self.add_card(card)
+                self.loaded_boards.add(board.id)
+        self.report_failed_lists(self.failed_lists[failed_before:])
+        return len(missing)
+
+    def load_stale(self, use_cache=True, boards=None):
+        """
+        Read the cards of the boards, every board by default, from the
+        cache if it is still good for them, fetch and cache the others.
+        Returns board id -> fetched cards and board id -> cached cards.
+        """
+        if boards is None:
+            boards = self.Boards
+        # board id -> cards, for the boards the cache is still good for
+        cached = dict()
+        if self.cache is not None and use_cache:
+            for board in boards:
+                cards = self.cache.cards(board)
+                if cards is not None:
+                    cached[board.id] = cards
+        stale = [board for board in boards if board.id not in cached]
+
+        # extract the information on the cards of every list
+        loaded, failed = self.fetch_boards(stale)
+
+        if self.cache is not None:
+            for board in stale:
+                if board.id not in failed:
+                    self.cache.store(board, loaded[board.id])
+        return loaded, cached
+
+    def index_boards(self, use_cache=True):
+        """
+        Build the label index one board at a time. Only the card id and
+        labels of each card go into the index, and every board's cards
+        are let go of before the next board is loaded, so self.Cards
+        stays empty. Returns the seconds spent indexing, recorded as one
+        index phase.
+        """
+        self.index = self.new_index()
+        self.card_map = dict()
+        self.card_positions = dict()
+        indexing = 0
+        for board in self.Boards:
+            cards = None
+            if self.cache is not None and use_cache:
+                cards = self.cache.cards(board)
+            if cards is None:
+                loaded, failed = self.fetch_boards([board])
+                cards = loaded[board.id]
+                if self.cache is not None and board.id not in failed:
+                    self.cache.store(board, cards)
+            start = time.perf_counter()
+            for card in cards:
+                for handle in card.labels:
+                    self.index.add_label(
+                        card.id, records.LABELS.ids[handle],
+                        records.LABELS.names[handle])
+            indexing += time.perf_counter() - start
+        self.metrics.record_phase('index', indexing)
+        return indexing
+
+    def fetch_boards(self, boards):
+        """
+        Fetch the cards of boards from trello, board by board in batches
+        or list by list.
+        Returns board id -> cards and the set of ids of failed boards.
+        """
+        if self.bulk:
+            return self.load_boards(boards)
+        return self.load_lists(boards)
+
+    def load_lists(self, boards):
+        """
+        Fetch the cards of every list on the boards, one request per list,
+        several lists at a time.
+        Returns board id -> cards and the set of ids of incomplete boards.
+        """
+        lists = [(board.id, _list) for board in boards
+                 for _list in board.lists]
+        loaded = dict((board.id, list()) for board in boards)
+        failed = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.load_list, _list.id)
+                       for board_id, _list in lists]
+            # collect in list order so the cards always come out the same
+            for (board_id, _list), future in zip(lists, futures):
+                try:
+                    loaded[board_id] += future.result()
+                except Exception as error:
+                    self.failed_lists.append((_list, error))
+                    failed.add(board_id)
+        return loaded, failed
+
+    def load_list(self, list_id):
+        """
+        Fetch a single list from trello and return its cards.
+        Raises if the request fails.
+        """
+        return self.extract_cards(self.tool.iter_list_cards(list_id))
+
+    def load_boards(self, boards):
+        """
+        Fetch the cards of the boards through trello's batch endpoint,
+        so one request covers several boards and all of their lists.
+        Cards are put back in list order.
+        Returns board id -> cards and the set of ids of failed boards.
+        """
+        limit = model.TrelloTool.BATCH_LIMIT
+        batches = [boards[start:start + limit]
+                   for start in range(0, len(boards), limit)]
+        loaded = dict((board.id, list()) for board in boards)
+        failed = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self.load_batch, batch)
+                       for batch in batches]
+            for batch, future in zip(batches, futures):
+                try:
+                    results = future.result()
+                except Exception as error:
+                    results = [error] * len(batch)
+                for board, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        self.failed_lists += [(_list, result)
+                                              for _list in board.lists]
+                        failed.add(board.id)
+                        continue
+                    list_order = dict((_list.id, pos) for pos, _list in
+                                      enumerate(board.lists))
+                    # sort is stable, so cards keep their order in a list
+                    result.sort(key=lambda card: list_order.get(
+                        card.list_id, len(list_order)))
+                    loaded[board.id] = result
+        return loaded, failed
+
+    def load_batch(self, boards):
+        """
+        Fetch the cards of up to BATCH_LIMIT boards with one batch
+        request, turning each into a Card as soon as it is read.
+        Returns, for each board, its cards or the error trello answered
+        its route with.
+        """
+        results = [list() for board in boards]
+        for position, card in self.tool.iter_boards_cards(
+                [board.id for board in boards]):
+            if isinstance(card, Exception):
+                results[position] = card
+            else:
+                results[position].append(records.Card.from_json(card))
+        return results
+
     def login(self):
         """
         Login process. Authroizes a user, setup the trello
         connector then initializes their data.
         """
         print("Authorize application by loggin in at your browser.")
-        self.credentials = auth.authorize(8080)
-        if 'key' in self.credentials and 'token' in self.credentials:
-            self.authenticated = True
-            self.tool = model.TrelloTool(self.credentials)
+        credentials = auth.authorize(8080)
+        if 'key' in credentials and 'token' in credentials:
+            self.connect(credentials)
             print("Connected with Trello")
             self.initialize()
             print("Retrieved data")
             return True
         return False
 
+    def connect(self, credentials, base_url=None):
+        """ Use credentials already authorized, without logging in. """
+        self.credentials = credentials
+        self.authenticated = True
+        self.tool = model.TrelloTool(credentials, base_url=base_url,
+                                     request_metrics=self.metrics)
+        if self.journal_dir is not None:
+            response = self.tool.get_member()
+            response.raise_for_status()
+            member_id = json.loads(response.content.decode())['id']
+            self.journal = merge.Journal(merge.journal_path(
+                self.journal_dir, credentials['key'], member_id))
+
     def logout(self):
         """
         Logout process. Removes logged in user's credentials
         then sets authenticated status to false.
         """
         if self.authenticated:
+            self.unwatch()
             self.credentials.clear()
             self.authenticated = False
         else:
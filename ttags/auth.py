@@ -88,5 +88,7 @@ def authorize(port):
     return {
         'key': client_key,
         'token': access_token,
-        'token_secret': access_token_secret
+        'token_secret': access_token_secret,
+        # signs trello's webhook callbacks
+        'secret': client_secret
     }
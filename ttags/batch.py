@@ -0,0 +1,205 @@
+"""
+Headless label deduplication across many accounts.
+
+run_batch takes a list of accounts, each a set of credentials with a
+name, and a Policy saying which label of a group wins and how similar
+labels have to be. For every account it loads the boards, finds groups
+of similar labels and merges each group into the label the policy picks,
+without asking anything. Accounts are processed a bounded number at a
+time, each on its own thread with its own TrelloApp, so a batch takes
+about as long as its slowest accounts rather than all of them added up.
+Every account gets a JSON report of what was merged, what failed and how
+long it took, and one account failing does not stop the others.
+
+Board and score caches are not used: they are single SQLite files that
+concurrent accounts would contend for.
+"""
+import app
+import cluster
+import json
+import math
+import metrics
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Ways of picking the label a group is merged into.
+WINNERS = ('most_cards', 'shortest', 'longest', 'alphabetical', 'first')
+
+
+class Policy:
+    """
+    How groups are merged. winner is one of WINNERS, min_score the
+    lowest fuzz.ratio a label can have against its group's first label
+    and still join it.
+    Labels named in keep are never merged into another label, groups
+    needing more than max_operations label changes are left alone and
+    with dry_run nothing is changed at all.
+    """
+
+    def __init__(self, winner='most_cards',
+                 min_score=cluster.LEVEN_THRESHOLD + 1,
+                 dry_run=False, max_operations=None, keep=(),
+                 engine='blocked'):
+        if winner not in WINNERS:
+            raise ValueError('unknown winner {}, pick one of {}'.format(
+                winner, ', '.join(WINNERS)))
+        if engine not in cluster.ENGINES:
+            raise ValueError('unknown engine {}, pick one of {}'.format(
+                engine, ', '.join(sorted(cluster.ENGINES))))
+        self.winner = winner
+        self.min_score = min_score
+        self.dry_run = dry_run
+        self.max_operations = max_operations
+        self.keep = set(keep)
+        self.engine = engine
+
+    @classmethod
+    def load(cls, path):
+        """ Read a policy from a JSON object with the same fields. """
+        with open(path) as policy_file:
+            fields = json.load(policy_file)
+        try:
+            return cls(**fields)
+        except TypeError as error:
+            raise ValueError('bad policy {}: {}'.format(path, error))
+
+    def make_engine(self):
+        # engines take scores above their threshold, and scores are whole
+        return cluster.ENGINES[self.engine](
+            threshold=math.ceil(self.min_score) - 1)
+
+    def choose(self, group, label_index):
+        """
+        The name in group the others are merged into, and the names
+        merged into it. Ties go to the name listed first.
+        """
+        candidates = [name for name in group if name in self.keep] or group
+        if self.winner == 'first':
+            winner = candidates[0]
+        elif self.winner == 'alphabetical':
+            winner = min(candidates)
+        elif self.winner == 'shortest':
+            winner = min(candidates, key=len)
+        elif self.winner == 'longest':
+            winner = max(candidates, key=len)
+        else:
+            winner = max(candidates, key=lambda name: sum(
+                len(label_index.cards_with(label_id))
+                for label_id in label_index.ids_for(name)))
+        replaced = [name for name in group
+                    if name != winner and name not in self.keep]
+        return winner, replaced
+
+
+def merge_group(the_app, group, policy):
+    """ Merge one group as the policy says. Returns its report entry. """
+    winner, replaced = policy.choose(group, the_app.index)
+    entry = {'labels': sorted(group), 'winner': winner, 'replaced': replaced}
+    if not replaced:
+        entry['status'] = 'kept'
+        return entry
+
+    plan = the_app.plan_merge(replaced, winner)
+    entry['cards'] = len(plan.updates)
+    entry['operations'] = plan.operation_count()
+    entry['skipped'] = len(plan.skipped)
+    if (policy.max_operations is not None and
+            plan.operation_count() > policy.max_operations):
+        entry['status'] = 'too_large'
+    elif policy.dry_run:
+        entry['status'] = 'dry_run'
+    else:
+        failures = the_app.run_merge(plan)
+        entry['status'] = 'failed' if failures else 'merged'
+        entry['failures'] = [{'card': update.card_id, 'error': str(error)}
+                             for update, error in failures]
+    return entry
+
+
+def process_account(account, policy):
+    """ Deduplicate one account. Returns its report. """
+    start = time.perf_counter()
+    report = {'account': account['name'],
+              'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'dry_run': policy.dry_run,
+              'groups': [],
+              'failed_lists': [],
+              'error': None}
+    the_app = app.TrelloApp(engine=policy.make_engine(),
+                            app_metrics=metrics.Metrics())
+    try:
+        the_app.connect(account, base_url=account.get('base_url'))
+        the_app.initialize(use_cache=False)
+        report['boards'] = len(the_app.Boards)
+        report['cards'] = len(the_app.card_map)
+        report['labels'] = len(the_app.index.names())
+        report['failed_lists'] = [
+            {'list': _list.id, 'name': _list.name, 'error': str(error)}
+            for _list, error in the_app.failed_lists]
+        for group in the_app.similar_groups():
+            report['groups'].append(merge_group(the_app, group, policy))
+    except Exception as error:
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    report['metrics'] = json.loads(the_app.metrics.to_json())
+    return report
+
+
+def report_path(report_dir, name):
+    """ Where an account's report goes, its name made safe for a file. """
+    return os.path.join(report_dir,
+                        re.sub(r'[^\w.-]', '_', name) + '.json')
+
+
+def load_accounts(path):
+    """
+    Read accounts from a JSON list of objects with a key, a token and
+    optionally a name and a base_url. Unnamed accounts are numbered.
+    """
+    with open(path) as accounts_file:
+        accounts = json.load(accounts_file)
+    for number, account in enumerate(accounts):
+        if 'key' not in account or 'token' not in account:
+            raise ValueError('account {} in {} needs a key and a '
+                             'token'.format(number, path))
+        account.setdefault('name', 'account-{}'.format(number))
+    names = [account['name'] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError('account names in {} are not unique, their reports '
+                         'would overwrite each other'.format(path))
+    return accounts
+
+
+def run_batch(accounts, policy, report_dir, workers=4):
+    """
+    Process accounts, up to workers at a time, writing a report for each
+    into report_dir as soon as it is done. Returns the reports in the
+    order of accounts.
+    """
+    os.makedirs(report_dir, exist_ok=True)
+
+    def run(account):
+        report = process_account(account, policy)
+        with open(report_path(report_dir, account['name']), 'w') as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        return report
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run, accounts))
+
+
+def summary(reports):
+    """ One line per account, for people. """
+    lines = []
+    for report in reports:
+        if report['error']:
+            lines.append('{}: failed after {}s, {}'.format(
+                report['account'], report['seconds'], report['error']))
+            continue
+        statuses = [group['status'] for group in report['groups']]
+        lines.append('{}: {} groups, {} merged, {} failed in {}s'.format(
+            report['account'], len(statuses), statuses.count('merged'),
+            statuses.count('failed'), report['seconds']))
+    return lines
@@ -0,0 +1,147 @@
+"""
+On-disk caches.
+
+BoardCache keeps the cards on each board. Cards are stored per board,
+trimmed to what extract_cards keeps, together with the board's
+dateLastActivity. Trello bumps that date whenever anything on the board
+changes, so a board whose date still matches can be served from the cache
+without asking trello for its cards again.
+
+ScoreCache keeps label similarity scores between suggest runs, so only
+pairs involving new or renamed labels are scored again.
+"""
+import json
+import os
+import records
+import sqlite3
+from collections import OrderedDict
+
+# Bump when the stored card format changes, older caches are then dropped.
+SCHEMA_VERSION = 2
+
+
+def default_path(name='cache.sqlite3'):
+    """ A file called name in the user's cache directory. """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ttags', name)
+
+
+def connect(path):
+    """
+    Open an SQLite database, creating its directory if needed. The
+    connection may be used from any thread, one at a time.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+class BoardCache:
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.connection = connect(self.path)
+        version = self.connection.execute('PRAGMA user_version').fetchone()
+        if version[0] != SCHEMA_VERSION:
+            self.connection.execute('DROP TABLE IF EXISTS boards')
+            self.connection.execute(
+                'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS boards ('
+            'id TEXT PRIMARY KEY, last_activity TEXT, cards TEXT)')
+        self.connection.commit()
+
+    def cards(self, board):
+        """
+        The cached Card records of a Board, or None if they are missing or
+        the board changed since they were stored.
+        """
+        if board.last_activity is None:
+            return None
+        row = self.connection.execute(
+            'SELECT last_activity, cards FROM boards WHERE id = ?',
+            (board.id,)).fetchone()
+        if row is None or row[0] != board.last_activity:
+            return None
+        return [records.Card.from_json(card) for card in json.loads(row[1])]
+
+    def store(self, board, cards):
+        """ Remember the cards of a board as of its current activity date. """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO boards VALUES (?, ?, ?)',
+            (board.id, board.last_activity,
+             json.dumps([card.to_json() for card in cards])))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM boards')
+        self.connection.commit()
+
+
+class ScoreCache:
+    """
+    Scores of (first, second) string pairs for one scoring algorithm,
+    evicting the least recently used pairs past capacity.
+
+    Scores are served from memory while clustering, since a lookup has to
+    be cheaper than the score it saves. They are read from disk when the
+    cache is opened and written back by save. Scores stored under another
+    version of the algorithm are dropped on opening.
+    """
+
+    def __init__(self, version, path=None, capacity=200000):
+        self.version = version
+        self.capacity = capacity
+        self.path = path or default_path('scores.sqlite3')
+        self.connection = connect(self.path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS scores (version TEXT, used INTEGER, '
+            'first TEXT, second TEXT, score INTEGER)')
+        self.connection.execute('DELETE FROM scores WHERE version != ?',
+                                (version,))
+        self.connection.commit()
+
+        # (first, second) -> score, least recently used first
+        self.entries = OrderedDict(
+            ((first, second), score) for first, second, score in
+            self.connection.execute(
+                'SELECT first, second, score FROM scores ORDER BY used'))
+        self.hits = 0
+        self.misses = 0
+        # scores were added since the cache was read or saved
+        self.changed = False
+
+    def score(self, first, second, compute):
+        """ The cached score of a pair, or compute(first, second). """
+        key = (first, second)
+        score = self.entries.get(key)
+        if score is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return score
+        self.misses += 1
+        self.changed = True
+        score = self.entries[key] = compute(first, second)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return score
+
+    def save(self):
+        """ Write the scores back to disk, if any were added. """
+        if not self.changed:
+            return
+        with self.connection:
+            self.connection.execute('DELETE FROM scores')
+            self.connection.executemany(
+                'INSERT INTO scores VALUES (?, ?, ?, ?, ?)',
+                ((self.version, used, first, second, score)
+                 for used, ((first, second), score) in
+                 enumerate(self.entries.items())))
+        self.changed = False
+
+    def clear(self):
+        self.entries.clear()
+        self.connection.execute('DELETE FROM scores')
+        self.connection.commit()
@@ -0,0 +1,620 @@
+"""
+Label clustering engines.
+
+An engine groups label names by similarity. TrelloApp hands
+get_similar_leven and get_similar_simple off to its engine, so the
+grouping strategy can be swapped without touching the rest of the app.
+"""
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from functools import lru_cache
+from difflib import get_close_matches
+from random import choice
+from fuzzywuzzy import fuzz
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A name joins a group when fuzz.ratio against the seed is above this.
+LEVEN_THRESHOLD = 40
+# Cutoff handed to difflib's get_close_matches.
+SIMPLE_CUTOFF = 0.4
+# Names whose normalized form is remembered by normalize.
+NORMALIZE_CACHE_SIZE = 1 << 16
+# Identifies how leven scores pairs, for caches of scores. fuzzywuzzy
+# scores differently when python-Levenshtein is missing, so the backend
+# it uses is part of it.
+SCORE_VERSION = 'ratio-1/{}'.format(fuzz.SequenceMatcher.__module__)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(name):
+    """ Treat underscores and dashes as spaces when comparing names. """
+    return name.replace('_', ' ').replace('-', ' ')
+
+
+def tokenize(name):
+    """
+    Split a name into (character, occurrence) tokens. Two names share
+    exactly as many tokens as they have characters in common, repeats
+    included.
+    """
+    return [(char, k) for char, count in Counter(name).items()
+            for k in range(count)]
+
+
+class UnionFind:
+    """
+    Disjoint sets over the positions 0 to size - 1. The smallest position
+    of a set is always its root, so the result does not depend on the
+    order in which unions are made.
+    """
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, pos):
+        root = pos
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[pos] != root:
+            self.parent[pos], pos = root, self.parent[pos]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            if second < first:
+                first, second = second, first
+            self.parent[second] = first
+
+    def groups(self):
+        """ Every set as a sorted list of positions, ordered by root. """
+        members = dict()
+        for pos in range(len(self.parent)):
+            members.setdefault(self.find(pos), []).append(pos)
+        return [members[root] for root in sorted(members)]
+
+
+class CandidateIndex:
+    """
+    Inverted index from character tokens to the positions of names.
+
+    Both fuzz.ratio and difflib's ratio are 2 * matches / total length,
+    and two names can never match on more characters than they have in
+    common. Counting shared tokens through the index gives that upper
+    bound for every name at once, so candidates() can drop the names that
+    cannot reach min_ratio without ever scoring them.
+    """
+
+    def __init__(self, names, min_ratio, key=normalize):
+        self.min_ratio = Fraction(min_ratio).limit_denominator(1000)
+        self.key = key
+        self.lengths = []
+        self.tokens = []
+        # (char, occurrence) -> set of name positions
+        self.postings = dict()
+
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """ Index one more name. Returns its position. """
+        pos = len(self.lengths)
+        tokens = tokenize(self.key(name))
+        self.lengths.append(len(tokens))
+        self.tokens.append(tokens)
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(pos)
+        return pos
+
+    def remove(self, pos):
+        """ Stop returning the name at pos as a candidate. """
+        for token in self.tokens[pos]:
+            self.postings[token].discard(pos)
+
+    def candidates(self, query):
+        """
+        Positions of names that share enough characters with query to
+        possibly reach min_ratio.
+        """
+        numerator = self.min_ratio.numerator
+        denominator = self.min_ratio.denominator
+        length = len(query)
+        # 2 * shared >= ratio * (length + other) and shared <= other
+        least_shared = max(1, -(-numerator * length //
+                                (2 * denominator - numerator)))
+
+        shared = Counter()
+        for token in tokenize(query):
+            posting = self.postings.get(token)
+            if posting:
+                shared.update(posting)
+
+        lengths = self.lengths
+        found = []
+        for pos, count in shared.most_common():
+            if count < least_shared:
+                break
+            if (2 * denominator * count >=
+                    numerator * (length + lengths[pos])):
+                found.append(pos)
+        return found
+
+
+def leven_index(normalized, threshold):
+    """ CandidateIndex over normalized names for fuzz.ratio > threshold. """
+    # score > threshold needs 100 * 2 * matches / total >= threshold + .5
+    return CandidateIndex(normalized, Fraction(2 * threshold + 1, 200),
+                          key=str)
+
+
+class ScanEngine:
+    """
+    Reference engine. Compares each seed with every name left in the pool.
+    Quadratic in the number of names, kept for comparison and benchmarks.
+    """
+
+    def __init__(self, threshold=LEVEN_THRESHOLD, cutoff=SIMPLE_CUTOFF,
+                 scores=None):
+        self.threshold = threshold
+        self.cutoff = cutoff
+        # a cache.ScoreCache for SCORE_VERSION, kept across runs
+        self.scores = scores
+
+    def ratio(self):
+        """
+        The function leven scores pairs with: fuzz.ratio, through the
+        score cache if there is one.
+        """
+        if self.scores is None:
+            return fuzz.ratio
+        scores = self.scores
+        return lambda seed, name: scores.score(seed, name, fuzz.ratio)
+
+    def save_scores(self):
+        if self.scores is not None:
+            self.scores.save()
+
+    def simple(self, label_names):
+        """
+        Use python's builtin get_diff_lib function along with
+        a bit of randomness to decide which words are similar
+        """
+        # array to hold groups of labels with similar names
+        label_groups = []
+        # randomly select seed and group the names
+        while len(label_names) > 0:
+            seed = choice(label_names)
+            # get close matches, must be unique
+            similar_names = list(
+                set(get_close_matches(seed, label_names,
+                                      cutoff=self.cutoff)))
+            # add the seed to the close matches, add to label groups
+            label_groups.append(similar_names)
+            # Remove those names from the pool
+            label_names = [x for x in label_names if x not in similar_names]
+
+        # keep only those groups that have more than 1 element in it
+        label_groups = [group for group in label_groups if len(group) > 1]
+        return label_groups
+
+    def leven(self, label_names):
+        """
+        Get similar labels using levenshtein distance. No randomness here.
+        """
+        ratio = self.ratio()
+        # array to hold groups of labels with similar names
+        label_groups = []
+        # randomly select seed and group the names
+        while len(label_names) > 0:
+            label_names.sort()
+            seed = label_names[0]
+            # get close matches, make sure the list is unique
+            similar_names = list(set([name for name in label_names if
+                                      ratio(seed, normalize(name)) >
+                                      self.threshold]))
+            # add the seed to the close matches, add to label groups
+            label_groups.append(similar_names)
+            # Remove those names from the pool
+            label_names = [name for name in label_names if
+                           name not in similar_names]
+
+        # keep only those groups that have more than 1 element in it
+        label_groups = [group for group in label_groups if len(group) > 1]
+        self.save_scores()
+
+        return label_groups
+
+
+class BlockedEngine(ScanEngine):
+    """
+    Produces the same groups as ScanEngine, but only scores names that
+    share enough characters with the seed to possibly pass the threshold.
+    Names are sorted once and grouped names are dropped from the index,
+    so the pool shrinks without being rebuilt.
+    """
+
+    def simple(self, label_names):
+        """
+        Same random seeding as ScanEngine.simple, so a given random state
+        yields the same groups, with get_close_matches only shown
+        candidates that can reach the cutoff.
+        """
+        names = list(label_names)
+        index = CandidateIndex(names, self.cutoff, key=lambda name: name)
+        positions = dict()
+        for pos, name in enumerate(names):
+            positions.setdefault(name, []).append(pos)
+
+        cutoff = self.cutoff
+        label_groups = []
+        pool = names
+        while len(pool) > 0:
+            seed = choice(pool)
+            candidates = [names[pos] for pos in index.candidates(seed)]
+            if not seed:
+                # shares no characters with anything, but matches itself
+                candidates.append(seed)
+            similar_names = set(get_close_matches(seed, candidates,
+                                                  cutoff=cutoff))
+            similar_names.add(seed)
+            for name in similar_names:
+                for pos in positions[name]:
+                    index.remove(pos)
+            label_groups.append(list(similar_names))
+            pool = [name for name in pool if name not in similar_names]
+
+        return [group for group in label_groups if len(group) > 1]
+
+    def leven(self, label_names):
+        """
+        Walk seeds in sorted order, grouping each with the remaining names
+        whose normalized form scores above the threshold against it.
+        """
+        names = sorted(set(label_names))
+        normalized = [normalize(name) for name in names]
+        index = leven_index(normalized, self.threshold)
+        grouped = [False] * len(names)
+        ratio = self.ratio()
+
+        label_groups = []
+        for seed_pos, seed in enumerate(names):
+            if grouped[seed_pos]:
+                continue
+            group = [pos for pos in index.candidates(seed)
+                     if ratio(seed, normalized[pos]) > self.threshold]
+            # A seed never scores against itself when it is empty or made
+            # up of dashes; ScanEngine would loop forever on those.
+            if seed_pos not in group:
+                group.append(seed_pos)
+            for pos in group:
+                grouped[pos] = True
+                index.remove(pos)
+            if len(group) > 1:
+                label_groups.append([names[pos] for pos in sorted(group)])
+
+        self.save_scores()
+        return label_groups
+
+
+class ClusterState:
+    """
+    Greedy leven groups kept up to date as label names come and go.
+
+    Every group has a seed, the name its other members scored above the
+    threshold against. A name placed in the groups joins the first seed,
+    in sorted order, that it scores above the threshold against, or
+    becomes a seed itself. Placing names in sorted order from nothing
+    gives exactly BlockedEngine's groups. After that, update only scores
+    the added names, and the members of groups whose seed went away,
+    against the seeds sharing enough characters with them. The cost of an
+    update grows with the change, not with the whole vocabulary.
+    """
+
+    def __init__(self, threshold=LEVEN_THRESHOLD, ratio=fuzz.ratio):
+        self.threshold = threshold
+        # scores a seed against a normalized name, see ScanEngine.ratio
+        self.ratio = ratio
+        # seed names by position, None once a seed is gone
+        self.seeds = []
+        self.seed_index = leven_index([], threshold)
+        # seed position -> {name: None} of the group, seed included
+        self.members = dict()
+        # name -> seed position of its group
+        self.group_of = dict()
+
+    def groups(self, positions=None):
+        """
+        Groups of more than one name, by seed order, each sorted. Only the
+        groups of the given seed positions if there are any.
+        """
+        if positions is None:
+            positions = self.members
+        positions = sorted((pos for pos in positions if pos in self.members),
+                           key=lambda pos: self.seeds[pos])
+        return [sorted(self.members[pos]) for pos in positions
+                if len(self.members[pos]) > 1]
+
+    def update(self, label_names):
+        """
+        Bring the groups in line with label_names. Returns the groups,
+        as in groups, that gained or lost names.
+        """
+        names = set(label_names)
+        changed = set()
+
+        for name in [name for name in self.group_of if name not in names]:
+            pos = self.group_of.pop(name, None)
+            if pos is None:
+                # let go of already, along with its group's seed
+                continue
+            members = self.members[pos]
+            del members[name]
+            changed.add(pos)
+            if self.seeds[pos] == name:
+                # the others only joined because of the seed, so they
+                # are placed again
+                self.seed_index.remove(pos)
+                self.seeds[pos] = None
+                del self.members[pos]
+                for member in members:
+                    del self.group_of[member]
+
+        for name in sorted(name for name in names
+                           if name not in self.group_of):
+            changed.add(self.place(name))
+
+        return self.groups(changed)
+
+    def place(self, name):
+        """ Put a name in the first group it fits. Returns the seed. """
+        query = normalize(name)
+        matches = [pos for pos in self.seed_index.candidates(query)
+                   if self.ratio(self.seeds[pos], query) > self.threshold]
+        if matches:
+            pos = min(matches, key=lambda pos: self.seeds[pos])
+        else:
+            pos = self.seed_index.add(name)
+            self.seeds.append(name)
+            self.members[pos] = dict()
+        self.members[pos][name] = None
+        self.group_of[name] = pos
+        return pos
+
+
+# Set in every scoring process by init_scorer: the names, their
+# normalized forms, the threshold and a CandidateIndex over them. The
+# table is handed over once per process rather than with every task.
+scorer = None
+
+
+def init_scorer(names, normalized, threshold):
+    global scorer
+    scorer = (names, normalized, threshold,
+              leven_index(normalized, threshold))
+
+
+def score_rows(start, stop):
+    """
+    For every seed position from start up to stop, the later positions
+    whose normalized name scores above the threshold against the seed.
+    """
+    names, normalized, threshold, index = scorer
+    rows = []
+    for seed_pos in range(start, stop):
+        seed = names[seed_pos]
+        rows.append([pos for pos in index.candidates(seed)
+                     if pos > seed_pos and
+                     fuzz.ratio(seed, normalized[pos]) > threshold])
+    return rows
+
+
+class ParallelEngine(BlockedEngine):
+    """
+    Produces the same groups as BlockedEngine with the scoring spread
+    over several processes.
+
+    Sorted seeds are cut into blocks of rows and each worker process
+    scores whole blocks against the names after them. The grouping walk
+    then runs as in BlockedEngine, reading scores from the finished rows.
+    It scores every seed, including ones the walk would have skipped as
+    already grouped, which costs some extra work but lets all blocks run
+    at once. Worker processes do not see the score cache, it is only used
+    for inputs small enough to be scored in this process.
+    """
+
+    def __init__(self, threshold=LEVEN_THRESHOLD, cutoff=SIMPLE_CUTOFF,
+                 workers=None, block=64, min_parallel=2000, scores=None):
+        super(ParallelEngine, self).__init__(threshold, cutoff, scores)
+        # processes to score with, one per core by default
+        self.workers = workers or os.cpu_count() or 1
+        # seed rows per task
+        self.block = block
+        # fewer names than this are scored in this process, starting
+        # workers would cost more than it saves
+        self.min_parallel = min_parallel
+
+    def leven(self, label_names):
+        """
+        Walk seeds in sorted order, grouping each with the remaining names
+        whose normalized form scores above the threshold against it.
+        """
+        names = sorted(set(label_names))
+        if len(names) < self.min_parallel or self.workers < 2:
+            return super(ParallelEngine, self).leven(names)
+
+        normalized = [normalize(name) for name in names]
+        blocks = [(start, min(start + self.block, len(names)))
+                  for start in range(0, len(names), self.block)]
+        with ProcessPoolExecutor(
+                max_workers=self.workers, initializer=init_scorer,
+                initargs=(names, normalized, self.threshold)) as pool:
+            futures = [pool.submit(score_rows, start, stop)
+                       for start, stop in blocks]
+            # rows are put together in block order, whichever finished first
+            similar = [row for future in futures for row in future.result()]
+
+        grouped = [False] * len(names)
+        label_groups = []
+        for seed_pos in range(len(names)):
+            if grouped[seed_pos]:
+                continue
+            # earlier positions are all grouped by now, later ones only
+            # join if no earlier seed took them
+            group = [seed_pos] + [pos for pos in similar[seed_pos]
+                                  if not grouped[pos]]
+            for pos in group:
+                grouped[pos] = True
+            if len(group) > 1:
+                label_groups.append([names[pos] for pos in sorted(group)])
+
+        return label_groups
+
+
+# Names are scored with a single 64 bit word per row string.
+WORD_BITS = 64
+
+
+def popcount(words):
+    """ Number of set bits in each element of a uint64 array. """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return np.unpackbits(as_bytes, axis=-1).sum(axis=-1)
+
+
+class MatrixEngine(BlockedEngine):
+    """
+    Scores every pair of normalized names at once in NumPy tiles and
+    groups names linked by a score above the threshold with union-find.
+
+    Scores are exactly fuzz.ratio backed by python-Levenshtein, which is
+    2 * longest common subsequence / total length. The subsequence length
+    of a whole tile of pairs comes from the bit-parallel algorithm of
+    Hyyro, one vector operation per character of the column names.
+    Groups are connected components, so they do not depend on which name
+    is picked as a seed, but they can be larger than the greedy engines'
+    groups when similarity chains through several names.
+    """
+
+    def __init__(self, threshold=LEVEN_THRESHOLD, cutoff=SIMPLE_CUTOFF,
+                 tile=128):
+        if np is None:
+            raise ImportError('MatrixEngine needs numpy installed.')
+        super(MatrixEngine, self).__init__(threshold, cutoff)
+        # rows and columns scored per tile; memory stays at a few
+        # tile x tile arrays of 64 bit integers, small enough for cache
+        self.tile = tile
+
+    def leven(self, label_names):
+        """
+        Group the names that are connected through pairs of normalized
+        names scoring above the threshold.
+        """
+        names = sorted(set(label_names))
+        sets = UnionFind(len(names))
+        for first, second in self.similar_pairs(
+                [normalize(name) for name in names]):
+            sets.union(first, second)
+        return [[names[pos] for pos in group] for group in sets.groups()
+                if len(group) > 1]
+
+    def similar_pairs(self, names):
+        """
+        Yield every (i, j) with i < j whose names score above the
+        threshold.
+        """
+        lengths = np.array([len(name) for name in names], dtype=np.int64)
+        codes, alphabet_size = self.encode(names, lengths)
+        long_rows = np.flatnonzero(lengths > WORD_BITS).tolist()
+
+        # Names too long for one word are rare, score them one by one.
+        for first in long_rows:
+            for second in range(first + 1, len(names)):
+                if fuzz.ratio(names[first], names[second]) > self.threshold:
+                    yield first, second
+
+        for row_start in range(0, len(names), self.tile):
+            rows = slice(row_start, min(row_start + self.tile, len(names)))
+            masks = self.row_masks(codes[rows], lengths[rows], alphabet_size)
+            for col_start in range(row_start, len(names), self.tile):
+                cols = slice(col_start, min(col_start + self.tile,
+                                            len(names)))
+                similar = self.similar_tile(masks, lengths[rows],
+                                            codes[cols], lengths[cols])
+                if col_start == row_start:
+                    similar = np.triu(similar, k=1)
+                similar[lengths[rows] > WORD_BITS] = False
+                for first, second in zip(*np.nonzero(similar)):
+                    yield int(row_start + first), int(col_start + second)
+
+    @staticmethod
+    def encode(names, lengths):
+        """
+        Map every character to a small integer. Shorter names are padded
+        with one past the largest code, which never matches anything.
+        Returns the codes and the number of codes including padding.
+        """
+        alphabet = dict()
+        for name in names:
+            for char in name:
+                alphabet.setdefault(char, len(alphabet))
+        width = int(lengths.max(initial=0))
+        codes = np.full((len(names), width), len(alphabet), dtype=np.int64)
+        for pos, name in enumerate(names):
+            codes[pos, :len(name)] = [alphabet[char] for char in name]
+        return codes, len(alphabet) + 1
+
+    @staticmethod
+    def row_masks(codes, lengths, alphabet_size):
+        """
+        For each row name and character code, the bit set of positions
+        where the name has that character. Padding gets no bits.
+        """
+        masks = np.zeros((len(codes), alphabet_size), dtype=np.uint64)
+        for pos in range(min(codes.shape[1], WORD_BITS)):
+            present = np.flatnonzero(lengths > pos)
+            np.bitwise_or.at(masks, (present, codes[present, pos]),
+                             np.uint64(1) << np.uint64(pos))
+        return masks
+
+    def similar_tile(self, masks, row_lengths, col_codes, col_lengths):
+        """ Boolean matrix of row/column pairs scoring above threshold. """
+        shape = (len(masks), len(col_codes))
+        vector = np.full(shape, np.iinfo(np.uint64).max, dtype=np.uint64)
+        kept = np.empty(shape, dtype=np.uint64)
+        added = np.empty(shape, dtype=np.uint64)
+        for pos in range(int(col_lengths.max(initial=0))):
+            # vector = (vector + kept) | (vector - kept), kept = vector & match
+            np.take(masks, col_codes[:, pos], axis=1, out=kept)
+            np.bitwise_and(vector, kept, out=kept)
+            np.add(vector, kept, out=added)
+            np.subtract(vector, kept, out=vector)
+            np.bitwise_or(vector, added, out=vector)
+
+        low_bits = np.array([(1 << int(length)) - 1 if length <= WORD_BITS
+                             else 0 for length in row_lengths],
+                            dtype=np.uint64)
+        common = row_lengths[:, None] - popcount(
+            vector & low_bits[:, None]).astype(np.int64)
+        total = row_lengths[:, None] + col_lengths[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # same operations as python-Levenshtein, so rounding agrees
+            scores = np.rint(100 * ((2 * common) / total))
+        nonempty = (row_lengths > 0)[:, None] & (col_lengths > 0)[None, :]
+        return nonempty & (scores > self.threshold)
+
+
+# Engines by the name users can pick them with.
+ENGINES = {
+    'scan': ScanEngine,
+    'blocked': BlockedEngine,
+    'matrix': MatrixEngine,
+    'parallel': ParallelEngine
+}
@@ -0,0 +1,193 @@
+"""
+Index of which labels are on which cards.
+
+LabelIndex keeps label name -> label ids, label id -> card ids and
+card id -> label ids, holding ids only. It is built once when cards are
+loaded and then kept up to date one card change at a time, so merges can
+look up everything they need without scanning the cards.
+
+SpillingLabelIndex is the same index for accounts too large to keep in
+memory: once its card memberships outgrow a budget they move to a
+temporary SQLite database.
+"""
+import records
+import sqlite3
+
+
+class LabelIndex:
+    """
+    Every mapping is a dict used as an insertion ordered set, so lookups
+    and updates are O(1) and iteration order is stable.
+    """
+
+    def __init__(self):
+        # label name -> {label id: None}
+        self.name_ids = dict()
+        # label id -> label name
+        self.label_names = dict()
+        # label id -> {card id: None}
+        self.label_cards = dict()
+        # card id -> {label id: None}
+        self.card_labels = dict()
+
+    @classmethod
+    def from_cards(cls, cards):
+        """ Index Card records as produced by TrelloApp.extract_cards. """
+        index = cls()
+        for card in cards:
+            index.add_card(card)
+        return index
+
+    def add_card(self, card):
+        self.card_labels.setdefault(card.id, dict())
+        for handle in card.labels:
+            self.add_label(card.id, records.LABELS.ids[handle],
+                           records.LABELS.names[handle])
+
+    def remove_card(self, card_id):
+        for label_id in list(self.card_labels.get(card_id, ())):
+            self.remove_label(card_id, label_id)
+        self.card_labels.pop(card_id, None)
+
+    def add_label(self, card_id, label_id, name):
+        """ Record that a card carries a label. """
+        self.label_names[label_id] = name
+        self.name_ids.setdefault(name, dict())[label_id] = None
+        self.label_cards.setdefault(label_id, dict())[card_id] = None
+        self.card_labels.setdefault(card_id, dict())[label_id] = None
+
+    def remove_label(self, card_id, label_id):
+        """
+        Record that a card no longer carries a label. Labels left on no
+        card are dropped, and so are names left without labels.
+        """
+        self.card_labels.get(card_id, dict()).pop(label_id, None)
+        cards = self.label_cards.get(label_id)
+        if cards is None:
+            return
+        cards.pop(card_id, None)
+        if not cards:
+            del self.label_cards[label_id]
+            self.forget_label(label_id)
+
+    def forget_label(self, label_id):
+        """ Drop a label that is on no card from its name. """
+        name = self.label_names[label_id]
+        ids = self.name_ids[name]
+        ids.pop(label_id, None)
+        if not ids:
+            del self.name_ids[name]
+
+    def rename_label(self, label_id, name):
+        """ Give a label on some cards a new name, keeping its cards. """
+        old_name = self.label_names.get(label_id)
+        if label_id not in self.name_ids.get(old_name, ()):
+            return
+        self.forget_label(label_id)
+        self.label_names[label_id] = name
+        self.name_ids.setdefault(name, dict())[label_id] = None
+
+    def names(self):
+        """ Names of the labels that are on at least one card. """
+        return list(self.name_ids)
+
+    def ids_for(self, name):
+        """ Ids of the labels called name, in the order they were seen. """
+        return list(self.name_ids.get(name, ()))
+
+    def cards_with(self, label_id):
+        """ Ids of the cards carrying a label. """
+        return list(self.label_cards.get(label_id, ()))
+
+    def has_label(self, card_id, label_id):
+        return label_id in self.card_labels.get(card_id, ())
+
+
+class SpillingLabelIndex(LabelIndex):
+    """
+    A LabelIndex whose card memberships move to disk once they would take
+    more than budget bytes. Label names and ids always stay in memory.
+    Lookups answer the same, in the same order, before and after.
+    """
+    # rough bytes one card-label pair takes in label_cards and card_labels
+    PAIR_BYTES = 200
+
+    def __init__(self, budget):
+        super().__init__()
+        self.budget = budget
+        # card-label pairs held in memory
+        self.pairs = 0
+        # connection to the database holding the pairs, once spilled
+        self.store = None
+
+    def spill(self):
+        """ Move every card-label pair into a temporary SQLite database. """
+        # an empty name gives a private on-disk database, deleted on close
+        self.store = sqlite3.connect('')
+        self.store.execute(
+            'CREATE TABLE pairs (label_id TEXT, card_id TEXT, '
+            'UNIQUE (label_id, card_id))')
+        self.store.execute('CREATE INDEX pairs_card ON pairs (card_id)')
+        # rowids keep each label's cards in the order they were added
+        self.store.executemany(
+            'INSERT INTO pairs VALUES (?, ?)',
+            ((label_id, card_id) for label_id, cards in
+             self.label_cards.items() for card_id in cards))
+        self.label_cards = dict()
+        self.card_labels = dict()
+        self.pairs = 0
+
+    def add_card(self, card):
+        if self.store is None:
+            return super().add_card(card)
+        for handle in card.labels:
+            self.add_label(card.id, records.LABELS.ids[handle],
+                           records.LABELS.names[handle])
+
+    def remove_card(self, card_id):
+        if self.store is None:
+            return super().remove_card(card_id)
+        for row in self.store.execute(
+                'SELECT label_id FROM pairs WHERE card_id = ?',
+                (card_id,)).fetchall():
+            self.remove_label(card_id, row[0])
+
+    def add_label(self, card_id, label_id, name):
+        if self.store is None:
+            if card_id not in self.label_cards.get(label_id, ()):
+                self.pairs += 1
+            super().add_label(card_id, label_id, name)
+            if self.pairs * SpillingLabelIndex.PAIR_BYTES > self.budget:
+                self.spill()
+            return
+        self.label_names[label_id] = name
+        self.name_ids.setdefault(name, dict())[label_id] = None
+        self.store.execute('INSERT OR IGNORE INTO pairs VALUES (?, ?)',
+                           (label_id, card_id))
+
+    def remove_label(self, card_id, label_id):
+        if self.store is None:
+            if card_id in self.label_cards.get(label_id, ()):
+                self.pairs -= 1
+            return super().remove_label(card_id, label_id)
+        removed = self.store.execute(
+            'DELETE FROM pairs WHERE label_id = ? AND card_id = ?',
+            (label_id, card_id)).rowcount
+        if removed and self.store.execute(
+                'SELECT 1 FROM pairs WHERE label_id = ? LIMIT 1',
+                (label_id,)).fetchone() is None:
+            self.forget_label(label_id)
+
+    def cards_with(self, label_id):
+        if self.store is None:
+            return super().cards_with(label_id)
+        return [row[0] for row in self.store.execute(
+            'SELECT card_id FROM pairs WHERE label_id = ? ORDER BY rowid',
+            (label_id,))]
+
+    def has_label(self, card_id, label_id):
+        if self.store is None:
+            return super().has_label(card_id, label_id)
+        return self.store.execute(
+            'SELECT 1 FROM pairs WHERE label_id = ? AND card_id = ?',
+            (label_id, card_id)).fetchone() is not None
@@ -0,0 +1,267 @@
+"""
+Planning and running label merges.
+
+A merge is compiled into a MergePlan first: one CardUpdate per affected
+card, holding the labels to remove and the label to add, if any. Cards
+carrying several labels of the group get the replacing label once, and
+cards that already have it are not given it again. The plan can then be
+printed as a dry run or executed. Executing hands each update that goes
+through to a callback, so the caller can patch its in-memory data and
+skip refetching it.
+
+With a Journal, a plan is written down before it runs and every label
+added or removed is marked done as it goes through, so a merge cut short
+by a crash or a dropped connection can be resumed where it stopped.
+Adding a label a card already has and removing one it no longer has both
+count as done, so running a step twice is harmless.
+"""
+import hashlib
+import json
+import os
+import uuid
+from threading import Lock
+
+
+class CardUpdate:
+    """ The label changes for a single card. """
+
+    def __init__(self, card_id):
+        self.card_id = card_id
+        self.add = None
+        self.removes = []
+
+    def operation_count(self):
+        return len(self.removes) + (1 if self.add else 0)
+
+    def describe(self, card_name=None):
+        changes = []
+        if self.add:
+            changes.append("add {}".format(self.add))
+        if self.removes:
+            changes.append("remove {}".format(', '.join(self.removes)))
+        return "{} ({}): {}".format(card_name, self.card_id,
+                                    '; '.join(changes))
+
+
+class MergePlan:
+    """ Every card update needed to merge some labels into one. """
+
+    def __init__(self, replacing_id, replacing_name=None):
+        self.replacing_id = replacing_id
+        self.replacing_name = replacing_name
+        self.updates = []
+        # ids of the cards left alone, having no replacing label to get
+        self.skipped = []
+
+    def operation_count(self):
+        return sum(update.operation_count() for update in self.updates)
+
+    def describe(self, card_names=None):
+        """
+        Lines describing the plan, for a dry run. card_names maps card ids
+        to names to show alongside them.
+        """
+        card_names = card_names or dict()
+        lines = ["{} cards, {} operations:".format(len(self.updates),
+                                                   self.operation_count())]
+        lines += ["  " + update.describe(card_names.get(update.card_id))
+                  for update in self.updates]
+        if self.skipped:
+            lines.append("  {} cards left alone, their board has no label "
+                         "called {}".format(len(self.skipped),
+                                            self.replacing_name))
+        return lines
+
+
+def compile_plan(index, replacing_id, replaced_ids, replacing_name=None,
+                 replacing_for=None):
+    """
+    Build the plan that replaces the labels replaced_ids with the label
+    replacing_id, looking up their cards in a LabelIndex. Trello labels
+    belong to a board, so replacing_for, if given, picks the label for
+    each card id instead, or None for cards to leave alone.
+    """
+    plan = MergePlan(replacing_id, replacing_name)
+    by_card = dict()
+    # card id -> the label replacing on it
+    card_replacing = dict()
+
+    for label_id in replaced_ids:
+        for card_id in index.cards_with(label_id):
+            if card_id not in card_replacing:
+                card_replacing[card_id] = (
+                    replacing_id if replacing_for is None
+                    else replacing_for(card_id))
+                if card_replacing[card_id] is None:
+                    plan.skipped.append(card_id)
+            target = card_replacing[card_id]
+            if target is None or label_id == target:
+                continue
+            update = by_card.get(card_id)
+            if update is None:
+                update = by_card[card_id] = CardUpdate(card_id)
+                if not index.has_label(card_id, target):
+                    update.add = target
+                plan.updates.append(update)
+            if label_id not in update.removes:
+                update.removes.append(label_id)
+
+    return plan
+
+
+def apply_update(tool, update, journal=None, plan_id=None):
+    """
+    Run one card's update. The replacing label goes on before the old
+    ones come off, so the card is never left without either. Each step
+    is marked done in the journal, if any, once it went through.
+    """
+    if update.add:
+        response = tool.post_id_label(update.card_id, update.add)
+        # trello answers 400 when the card already has the label
+        if not (response.status_code == 400 and
+                b'already' in response.content):
+            response.raise_for_status()
+        if journal is not None:
+            journal.done(plan_id, update.card_id, 'add', update.add)
+    for label_id in update.removes:
+        response = tool.delete_card_label(update.card_id, label_id)
+        # and 404 when the label is not on the card any more
+        if response.status_code != 404:
+            response.raise_for_status()
+        if journal is not None:
+            journal.done(plan_id, update.card_id, 'remove', label_id)
+
+
+def execute_plan(tool, plan, on_success=None, journal=None, plan_id=None):
+    """
+    Run the plan's card updates concurrently through the tool's scheduler.
+    Each update that goes through is handed to on_success on the calling
+    thread. With a journal the plan is written to it first, unless it is
+    already there as plan_id, and marked finished once every update went
+    through.
+    Returns a list of (update, error) for the updates that failed.
+    """
+    if journal is not None and plan_id is None:
+        plan_id = journal.begin(plan)
+    futures = [tool.submit(apply_update, tool, update, journal, plan_id)
+               for update in plan.updates]
+    failures = []
+    for update, future in zip(plan.updates, futures):
+        try:
+            future.result()
+        except Exception as error:
+            failures.append((update, error))
+        else:
+            if on_success:
+                on_success(update)
+    if journal is not None and not failures:
+        journal.finish(plan_id)
+    return failures
+
+
+def journal_path(directory, key, member_id):
+    """
+    The journal of a trello member using an API key, in directory. It is
+    named after a hash of the two, which unlike the token stay the same
+    from one login to the next.
+    """
+    user = hashlib.sha256('{}:{}'.format(key, member_id).encode()).hexdigest()
+    return os.path.join(directory, '{}.journal'.format(user[:32]))
+
+
+class Journal:
+    """
+    Append-only file of merge plans and the steps of them that are done,
+    one JSON object per line. Each line is synced to disk before the step
+    it records is taken or reported done. The file is emptied whenever no
+    plan is left unfinished, so reading it back only costs as much as the
+    work still to do.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def append(self, entry):
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(json.dumps(entry) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def begin(self, plan):
+        """ Write a plan down before any of it runs. Returns its id. """
+        plan_id = uuid.uuid4().hex
+        self.append({'plan': plan_id, 'replacing': plan.replacing_id,
+                     'name': plan.replacing_name,
+                     'updates': [[update.card_id, update.add, update.removes]
+                                 for update in plan.updates]})
+        return plan_id
+
+    def done(self, plan_id, card_id, step, label_id):
+        """ Record that one label was added to or removed from a card. """
+        self.append({'done': plan_id, 'card': card_id, 'step': step,
+                     'label': label_id})
+
+    def finish(self, plan_id):
+        """ Mark a plan finished, emptying the journal if all are. """
+        self.append({'finished': plan_id})
+        if not self.unfinished():
+            self.clear()
+
+    def clear(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def entries(self):
+        """ Every entry in order. A line cut short by a crash is skipped. """
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path) as journal_file:
+                lines = journal_file.readlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+    def unfinished(self):
+        """
+        (plan id, plan) for every plan not finished, the plans holding
+        only the steps that are not done yet.
+        """
+        plans = dict()
+        done = set()
+        finished = set()
+        for entry in self.entries():
+            if 'plan' in entry:
+                plans[entry['plan']] = entry
+            elif 'done' in entry:
+                done.add((entry['done'], entry['card'], entry['step'],
+                          entry['label']))
+            elif 'finished' in entry:
+                finished.add(entry['finished'])
+
+        outstanding = []
+        for plan_id, entry in plans.items():
+            if plan_id in finished:
+                continue
+            plan = MergePlan(entry['replacing'], entry['name'])
+            for card_id, add, removes in entry['updates']:
+                update = CardUpdate(card_id)
+                if add and (plan_id, card_id, 'add', add) not in done:
+                    update.add = add
+                update.removes = [
+                    label_id for label_id in removes
+                    if (plan_id, card_id, 'remove', label_id) not in done]
+                if update.operation_count():
+                    plan.updates.append(update)
+            outstanding.append((plan_id, plan))
+        return outstanding
@@ -0,0 +1,239 @@
+"""
+Instrumentation of requests to trello and of the app's phases.
+
+Metrics records, per endpoint, how many requests were made, how many
+failed, how many bytes came back and a histogram of their latency, and
+the wall time spent in each phase of TrelloApp such as loading, indexing,
+clustering and merging. The numbers can be read as a dict, JSON or the
+Prometheus text format. A disabled Metrics records nothing and costs a
+single attribute check per call.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   float('inf'))
+
+
+class Histogram:
+    """ Counts of observations per bucket, with their sum. """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for pos, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[pos] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ (bound, observations at or below it) for every bucket. """
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, share):
+        """ Upper bound of the bucket holding the share-th observation. """
+        if not self.count:
+            return 0
+        for bound, total in self.cumulative():
+            if total >= share * self.count:
+                return bound
+        return self.bounds[-1]
+
+
+class EndpointStats:
+    """ What happened to the requests made to one endpoint. """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+class Metrics:
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = Lock()
+        # endpoint name -> EndpointStats
+        self.endpoints = dict()
+        # phase name -> [runs, seconds]
+        self.phases = dict()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = dict()
+            self.phases = dict()
+
+    def endpoint(self, name):
+        stats = self.endpoints.get(name)
+        if stats is None:
+            stats = self.endpoints[name] = EndpointStats()
+        return stats
+
+    def record_request(self, name, seconds, status, size=0):
+        """
+        Record one request. status is the HTTP status, or None when no
+        response came back.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.endpoint(name)
+            stats.requests += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.bytes += size
+            stats.latency.observe(seconds)
+
+    def record_bytes(self, name, size):
+        """ Count bytes read from a response after it was recorded. """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.endpoint(name).bytes += size
+
+    def record_phase(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            totals = self.phases.setdefault(name, [0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextmanager
+    def timed_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def phase(self, name):
+        """ Context manager adding the time spent inside it to a phase. """
+        if not self.enabled:
+            return NO_PHASE
+        return self.timed_phase(name)
+
+    def snapshot(self):
+        """ Everything recorded so far, as plain data. """
+        with self.lock:
+            endpoints = dict(
+                (name, {'requests': stats.requests,
+                        'errors': stats.errors,
+                        'bytes': stats.bytes,
+                        'seconds': stats.latency.sum,
+                        'p50': stats.latency.quantile(0.5),
+                        'p95': stats.latency.quantile(0.95),
+                        'buckets': [[bound, count] for bound, count in
+                                    stats.latency.cumulative()]})
+                for name, stats in self.endpoints.items())
+            phases = dict((name, {'runs': runs, 'seconds': seconds})
+                          for name, (runs, seconds) in self.phases.items())
+        return {'endpoints': endpoints, 'phases': phases}
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        # JSON has no infinity, the last bucket is open ended anyway
+        for stats in snapshot['endpoints'].values():
+            stats['buckets'][-1][0] = '+Inf'
+            for key in ('p50', 'p95'):
+                if stats[key] == float('inf'):
+                    stats[key] = '+Inf'
+        return json.dumps(snapshot, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """ The metrics in Prometheus' text exposition format. """
+        snapshot = self.snapshot()
+        endpoints = sorted(snapshot['endpoints'].items())
+        phases = sorted(snapshot['phases'].items())
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{{{}}} {}'.format(name, labels, value))
+
+        family('ttags_requests_total', 'counter', 'Requests sent to trello.',
+               [('endpoint="{}"'.format(name), stats['requests'])
+                for name, stats in endpoints])
+        family('ttags_request_errors_total', 'counter',
+               'Requests that failed or were answered with an error.',
+               [('endpoint="{}"'.format(name), stats['errors'])
+                for name, stats in endpoints])
+        family('ttags_response_bytes_total', 'counter',
+               'Bytes of response bodies read.',
+               [('endpoint="{}"'.format(name), stats['bytes'])
+                for name, stats in endpoints])
+
+        lines.append('# HELP ttags_request_seconds Latency of requests.')
+        lines.append('# TYPE ttags_request_seconds histogram')
+        for name, stats in endpoints:
+            for bound, count in stats['buckets']:
+                bound = '+Inf' if bound == float('inf') else repr(
+                    float(bound))
+                lines.append('ttags_request_seconds_bucket{{endpoint="{}",'
+                             'le="{}"}} {}'.format(name, bound, count))
+            lines.append('ttags_request_seconds_sum{{endpoint="{}"}} '
+                         '{}'.format(name, stats['seconds']))
+            lines.append('ttags_request_seconds_count{{endpoint="{}"}} '
+                         '{}'.format(name, stats['requests']))
+
+        family('ttags_phase_seconds_total', 'counter',
+               'Wall time spent in each phase of the app.',
+               [('phase="{}"'.format(name), stats['seconds'])
+                for name, stats in phases])
+        family('ttags_phase_runs_total', 'counter',
+               'Times each phase of the app ran.',
+               [('phase="{}"'.format(name), stats['runs'])
+                for name, stats in phases])
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ Lines describing the metrics, for people. """
+        snapshot = self.snapshot()
+        lines = ['{:<18} {:>8} {:>7} {:>12} {:>8} {:>8}'.format(
+            'endpoint', 'requests', 'errors', 'bytes', 'p50 (s)', 'p95 (s)')]
+        for name, stats in sorted(snapshot['endpoints'].items()):
+            lines.append('{:<18} {:>8} {:>7} {:>12} {:>8} {:>8}'.format(
+                name, stats['requests'], stats['errors'], stats['bytes'],
+                stats['p50'], stats['p95']))
+        lines.append('{:<18} {:>8} {:>12}'.format('phase', 'runs',
+                                                  'seconds'))
+        for name, stats in sorted(snapshot['phases'].items()):
+            lines.append('{:<18} {:>8} {:>12.3f}'.format(
+                name, stats['runs'], stats['seconds']))
+        return lines
+
+
+class NoPhase:
+    """ Stands in for a phase when metrics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+# Shared by TrelloTool and TrelloApp unless they are given their own.
+# TTAGS_METRICS=0 turns it off.
+DEFAULT = Metrics(enabled=os.environ.get('TTAGS_METRICS', '1') != '0')
@@ -1,49 +1,320 @@
 """
 Main class for interfacing with trello api.
 """
+import metrics
 import requests
+import scheduler
+import stream
+import time
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from urllib.parse import urlencode
 
 
 class TrelloTool:
+    TRELLO_API = 'https://api.trello.com/1'
+    # Paths under the API's base URL.
     TRELLO_ENDPOINTS = {
-        'get_boards': 'https://api.trello.com/1/members/me/boards',
-        'get_list': 'https://api.trello.com/1/lists/{}/cards',
-        'post_label': 'https://api.trello.com/1/cards/{}/idLabels',
-        'delete_label': 'https://api.trello.com/1/cards/{}/idLabels/{}'
+        'get_member': '/members/me',
+        'get_boards': '/members/me/boards',
+        'get_list': '/lists/{}/cards',
+        'get_board_cards': '/boards/{}/cards',
+        'batch': '/batch',
+        'post_label': '/cards/{}/idLabels',
+        'delete_label': '/cards/{}/idLabels/{}',
+        'post_webhook': '/webhooks',
+        'delete_webhook': '/webhooks/{}'
     }
+    # Card fields extract_cards uses. The id is always sent.
+    CARD_FIELDS = 'name,idList,labels'
+    # Most routes trello accepts in one batch request.
+    BATCH_LIMIT = 10
+    # Bytes read off the socket at a time when streaming a response.
+    CHUNK_SIZE = 64 * 1024
+    # Responses worth trying again: rate limited or a server hiccup.
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # Trello's rate limit headers, for when Retry-After is missing.
+    RATE_LIMIT_HEADERS = [
+        ('x-rate-limit-api-token-remaining',
+         'x-rate-limit-api-token-interval-ms'),
+        ('x-rate-limit-api-key-remaining',
+         'x-rate-limit-api-key-interval-ms')
+    ]
 
-    def __init__(self, credentials):
+    def __init__(self, credentials, pool_size=16, retries=5, backoff=0.5,
+                 max_backoff=30, request_scheduler=None, base_url=None,
+                 request_metrics=None):
         self.key = credentials.get('key')
         self.token = credentials.get('token')
+        # where the API is, another server such as a local fake can stand in
+        self.base_url = (base_url or TrelloTool.TRELLO_API).rstrip('/')
+
+        # one session so connections to trello are kept alive and reused
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # paces every request to stay within trello's rate limits
+        self.scheduler = (request_scheduler or
+                          scheduler.Scheduler.for_credentials(
+                              self.key, self.token, workers=pool_size))
+
+        self.lock = Lock()
+        self.counts = {'requests': 0, 'retries': 0, 'failures': 0}
+        # latency, errors and bytes per endpoint
+        self.metrics = request_metrics or metrics.DEFAULT
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """
+        Make a request on the shared session. Rate limited and server
+        error responses, as well as dropped connections, are retried with
+        exponential backoff. Returns the last response. Every attempt is
+        recorded in the metrics under endpoint, or the method if not given.
+        """
+        attempt = 0
+        while True:
+            self.scheduler.wait_turn()
+            self.count('requests')
+            try:
+                response = self.timed_request(method, url, endpoint, kwargs)
+            except requests.ConnectionError:
+                if attempt >= self.retries:
+                    self.count('failures')
+                    raise
+                response = None
+            if (response is not None and
+                    response.status_code not in TrelloTool.RETRY_STATUSES):
+                self.scheduler.succeeded()
+                return response
+            if attempt >= self.retries:
+                self.count('failures')
+                return response
+            if response is not None:
+                # hand a streamed response's connection back to the pool
+                response.close()
+
+            self.count('retries')
+            delay = self.retry_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                # the quota is shared, so every caller has to wait
+                self.scheduler.pause(delay)
+            else:
+                self.scheduler.sleep(delay)
+            attempt += 1
+
+    def timed_request(self, method, url, endpoint, kwargs):
+        """ One attempt at a request, recorded if metrics are enabled. """
+        if not self.metrics.enabled:
+            return self.session.request(method, url, **kwargs)
+
+        name = endpoint or method
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.ConnectionError:
+            self.metrics.record_request(name, time.perf_counter() - start,
+                                        None)
+            raise
+        # a streamed body is counted as it is read, see counted
+        size = 0 if kwargs.get('stream') else len(response.content or b'')
+        self.metrics.record_request(name, time.perf_counter() - start,
+                                    response.status_code, size)
+        return response
+
+    def counted(self, chunks, endpoint):
+        """ Pass chunks of a streamed body on, counting their bytes. """
+        if not self.metrics.enabled:
+            return chunks
+        return self.count_chunks(chunks, endpoint)
+
+    def count_chunks(self, chunks, endpoint):
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.metrics.record_bytes(endpoint, size)
+
+    def endpoint(self, name, *args):
+        """ The URL of one of the TRELLO_ENDPOINTS, filled in with args. """
+        return self.base_url + TrelloTool.TRELLO_ENDPOINTS[name].format(*args)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn, typically a few TrelloTool calls, to run concurrently
+        with other queued work. Returns a future.
+        """
+        return self.scheduler.submit(fn, *args, **kwargs)
+
+    def retry_delay(self, response, attempt):
+        """
+        Seconds to wait before the next attempt. Trello's own hints win
+        over the exponential backoff, but no wait is longer than
+        max_backoff: every caller is held back for it.
+        """
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        if response is None:
+            return delay
+
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                return delay
+
+        for remaining, interval in TrelloTool.RATE_LIMIT_HEADERS:
+            if (response.headers.get(remaining) == '0' and
+                    response.headers.get(interval)):
+                return min(max(delay, int(response.headers[interval]) / 1000),
+                           self.max_backoff)
+        return delay
+
+    def count(self, name, amount=1):
+        """ Add to one of the request counters. """
+        with self.lock:
+            self.counts[name] += amount
+
+    def stats(self):
+        """
+        Request, retry and failure counts, along with how many TCP
+        connections were opened and how many requests reused one.
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        pooled_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+
+        with self.lock:
+            stats = dict(self.counts)
+        stats['connections'] = connections
+        stats['reused_connections'] = max(pooled_requests - connections, 0)
+        return stats
 
     def get_boards(self):
         """ Get information on boards and their lists. """
         parameters = {
-            'fields': 'name',
+            'fields': 'name,dateLastActivity',
             'lists': 'all',
             'key': self.key,
             'token': self.token
         }
 
-        req = requests.get(
-            TrelloTool.TRELLO_ENDPOINTS.get('get_boards'),
+        req = self.request(
+            'get', self.endpoint('get_boards'), 'get_boards',
             params=parameters)
 
         return req
 
-    def get_list(self, list_id):
+    def get_member(self):
+        """ Get the id and username of the member the token belongs to. """
+        parameters = {
+            'fields': 'id,username',
+            'key': self.key,
+            'token': self.token
+        }
+        return self.request('get', self.endpoint('get_member'), 'get_member',
+                            params=parameters)
+
+    def get_list(self, list_id, stream=False):
         """ Get detailed information on a list, including cards and their labels. """
         parameters = {
-            'fields': 'name,desc,labels',
+            'fields': TrelloTool.CARD_FIELDS,
+            'key': self.key,
+            'token': self.token
+        }
+
+        req = self.request('get', self.endpoint('get_list', list_id),
+                           'get_list', params=parameters, stream=stream)
+
+        return req
+
+    def iter_list_cards(self, list_id):
+        """
+        Yield the cards of a list one at a time, as they are read off the
+        connection. Raises if the request fails.
+        """
+        req = self.get_list(list_id, stream=True)
+        try:
+            req.raise_for_status()
+            for path, card in stream.iter_values(self.counted(
+                    req.iter_content(TrelloTool.CHUNK_SIZE), 'get_list')):
+                yield card
+        finally:
+            req.close()
+
+    def get_board_cards(self, board_id):
+        """ Get the cards of every list on a board in one request. """
+        parameters = {
+            'fields': TrelloTool.CARD_FIELDS,
             'key': self.key,
             'token': self.token
         }
 
-        req = requests.get(TrelloTool.TRELLO_ENDPOINTS.get(
-            'get_list').format(list_id), params=parameters)
+        req = self.request('get', self.endpoint('get_board_cards', board_id),
+                           'get_board_cards', params=parameters)
 
         return req
 
+    def batch_get(self, routes, stream=False):
+        """
+        Run up to BATCH_LIMIT GET routes, such as '/boards/{id}/cards',
+        in a single request. The response holds one entry per route.
+        """
+        parameters = {
+            'urls': ','.join(routes),
+            'key': self.key,
+            'token': self.token
+        }
+
+        req = self.request(
+            'get', self.endpoint('batch'), 'batch', params=parameters,
+            stream=stream)
+
+        return req
+
+    def iter_boards_cards(self, board_ids):
+        """
+        Stream the cards of up to BATCH_LIMIT boards from one batch
+        request. Yields (position, card) as each card is read, position
+        being the board's index in board_ids, then (position, IOError)
+        for every board whose route trello answered with an error.
+        """
+        # commas inside a route would split it, so they are escaped
+        query = urlencode({'fields': TrelloTool.CARD_FIELDS})
+        routes = ['/boards/{}/cards?{}'.format(board_id, query)
+                  for board_id in board_ids]
+
+        req = self.batch_get(routes, stream=True)
+        # position -> fields of the error trello sent for that route
+        errors = dict()
+        try:
+            req.raise_for_status()
+            # entries look like {"200": [card, ...]} or an error object
+            for path, value in stream.iter_values(self.counted(
+                    req.iter_content(TrelloTool.CHUNK_SIZE), 'batch'),
+                    depth=3):
+                if len(path) == 3 and path[1] == '200':
+                    yield path[0], value
+                else:
+                    errors.setdefault(path[0], dict())[path[1]] = value
+        finally:
+            req.close()
+
+        for position in sorted(errors):
+            fields = errors[position]
+            yield position, IOError('board {}: {}'.format(
+                board_ids[position], fields.get('message', fields)))
+
     def delete_card_label(self, card_id, label_id):
         """ Delete a label from a card. """
 
@@ -52,9 +323,9 @@ class TrelloTool:
             'token': self.token
         }
 
-        req = requests.delete(
-            TrelloTool.TRELLO_ENDPOINTS.get('delete_label').format(
-                card_id, label_id), params=parameters)
+        req = self.request(
+            'delete', self.endpoint('delete_label', card_id, label_id),
+            'delete_label', params=parameters)
 
         return req
 
@@ -69,7 +340,39 @@ class TrelloTool:
             'value': label_id
         }
 
-        req = requests.post(TrelloTool.TRELLO_ENDPOINTS.get(
-            'post_label').format(card_id), params=parameters, data=payload)
+        req = self.request('post', self.endpoint('post_label', card_id),
+                           'post_label', params=parameters, data=payload)
+
+        return req
+
+    def post_webhook(self, board_id, callback_url):
+        """ Ask trello to post every change on a board to callback_url. """
+
+        parameters = {
+            'key': self.key,
+            'token': self.token
+        }
+        payload = {
+            'idModel': board_id,
+            'callbackURL': callback_url,
+            'description': 'TrelloTags live sync'
+        }
+
+        req = self.request('post', self.endpoint('post_webhook'),
+                           'post_webhook', params=parameters, data=payload)
+
+        return req
+
+    def delete_webhook(self, webhook_id):
+        """ Stop a webhook made by post_webhook. """
+
+        parameters = {
+            'key': self.key,
+            'token': self.token
+        }
+
+        req = self.request(
+            'delete', self.endpoint('delete_webhook', webhook_id),
+            'delete_webhook', params=parameters)
 
         return req
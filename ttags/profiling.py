@@ -0,0 +1,154 @@
+"""
+Profiling of slow commands on real accounts.
+
+Profile runs a function, typically TrelloApp.initialize or the search
+for similar groups behind suggest, and writes what it found next to a
+prefix: PREFIX.pstats for pstats, snakeviz and the like, and
+PREFIX.collapsed, one 'frame;frame;frame count' line per stack, for
+flamegraph.pl or speedscope. It also reports the hottest functions.
+
+There are two modes. cprofile traces every call in the calling thread,
+which is exact but slows pure python code down noticeably. sample looks
+at the stacks of every thread every few milliseconds instead, which costs
+far less and also sees the threads lists and boards are fetched on, but
+only gives estimates and no pstats file. Both collect the collapsed
+stacks by sampling. Work done in other processes, such as the parallel
+engine's scoring, is not seen by either.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+MODES = ('cprofile', 'sample')
+# Seconds between two looks at the stacks.
+SAMPLE_INTERVAL = 0.005
+# Functions listed in the report.
+TOP = 15
+
+
+def frame_name(code):
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class Sampler:
+    """
+    Records the stack of every thread but its own at a fixed interval,
+    counting how often each stack was seen.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # (outermost frame name, ..., innermost frame name) -> samples
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+
+    def collapsed(self):
+        """ Lines of the collapsed stack format, heaviest first. """
+        return ['{} {}'.format(';'.join(stack), count)
+                for stack, count in self.stacks.most_common()]
+
+    def top(self, count=TOP):
+        """
+        (function, samples in it, samples in it or what it called) for
+        the functions most often on top of a stack.
+        """
+        own = Counter()
+        total = Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            for name in set(stack):
+                total[name] += samples
+        return [(name, samples, total[name])
+                for name, samples in own.most_common(count)]
+
+
+class Profile:
+    """ Runs functions under one of the MODES, writing to prefix. """
+
+    def __init__(self, mode='cprofile', prefix='ttags-profile', top=TOP,
+                 interval=SAMPLE_INTERVAL):
+        if mode not in MODES:
+            raise ValueError('unknown profiling mode {}, pick one of '
+                             '{}'.format(mode, ', '.join(MODES)))
+        self.mode = mode
+        self.prefix = prefix
+        self.top = top
+        self.sampler = Sampler(interval)
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else None
+        # files written by the last run
+        self.paths = []
+
+    def run(self, fn, *args, **kwargs):
+        """ Call fn under the profiler, write the results, return fn's. """
+        self.sampler.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.sampler.stop()
+            self.write()
+
+    def write(self):
+        self.paths = []
+        if self.profiler is not None:
+            path = self.prefix + '.pstats'
+            self.profiler.dump_stats(path)
+            self.paths.append(path)
+        path = self.prefix + '.collapsed'
+        with open(path, 'w') as out:
+            for line in self.sampler.collapsed():
+                out.write(line + '\n')
+        self.paths.append(path)
+
+    def report(self):
+        """ Lines naming the files written and the hottest functions. """
+        lines = ['Wrote {}.'.format(', '.join(self.paths))]
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler).stats
+            # (file, line, name) -> (primitive calls, calls, own time,
+            # cumulative time, callers)
+            hottest = sorted(stats.items(), key=lambda item: item[1][2],
+                             reverse=True)[:self.top]
+            lines.append('{:>10} {:>10} {:>9}  {}'.format(
+                'own (s)', 'total (s)', 'calls', 'function'))
+            for (path, line, name), (_, calls, own, total, _) in hottest:
+                lines.append('{:>10.3f} {:>10.3f} {:>9}  {} ({}:{})'.format(
+                    own, total, calls, name, os.path.basename(path), line))
+        else:
+            samples = sum(self.sampler.stacks.values()) or 1
+            lines.append('{:>7} {:>7}  {}'.format('own', 'total',
+                                                  'function'))
+            for name, own, total in self.sampler.top(self.top):
+                lines.append('{:>6.1%} {:>6.1%}  {}'.format(
+                    own / samples, total / samples, name))
+        return lines
@@ -0,0 +1,112 @@
+"""
+Compact in-memory model of boards, lists and cards.
+
+Records use __slots__ instead of a dict per object. Labels are interned
+in a LabelTable: each label id gets a small integer handle, and cards
+hold a tuple of handles instead of a list of {'name', 'id'} dicts, so a
+label's name and id are stored once however many cards carry it.
+"""
+from threading import Lock
+
+
+class LabelTable:
+    """ Interns labels by id and name. Handles index into ids and names. """
+
+    def __init__(self):
+        # (label id, name) -> handle
+        self.handles = dict()
+        # handle -> label id
+        self.ids = []
+        # handle -> label name
+        self.names = []
+        # cards are extracted on the loader's worker threads
+        self.lock = Lock()
+
+    def intern(self, label_id, name):
+        """ The handle for a label, added on first use. """
+        key = (label_id, name)
+        handle = self.handles.get(key)
+        if handle is not None:
+            return handle
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is None:
+                handle = len(self.ids)
+                self.ids.append(label_id)
+                self.names.append(name)
+                self.handles[key] = handle
+            return handle
+
+    def label(self, handle):
+        """ The label as a {'name', 'id'} dict, as trello sends it. """
+        return {'name': self.names[handle], 'id': self.ids[handle]}
+
+
+# One table for the whole process, shared by every card.
+LABELS = LabelTable()
+
+
+class Record:
+    """ Base for slotted records, compared and printed field by field. """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field)
+            for field in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(field, getattr(self, field))
+            for field in self.__slots__))
+
+
+class BoardList(Record):
+    __slots__ = ('name', 'id')
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+
+class Board(Record):
+    __slots__ = ('name', 'id', 'lists', 'last_activity')
+
+    def __init__(self, name, id, lists, last_activity=None):
+        self.name = name
+        self.id = id
+        self.lists = lists
+        self.last_activity = last_activity
+
+
+class Card(Record):
+    __slots__ = ('name', 'id', 'list_id', 'labels')
+
+    def __init__(self, name, id, labels=(), list_id=None):
+        self.name = name
+        self.id = id
+        self.list_id = list_id
+        # tuple of LABELS handles
+        self.labels = tuple(labels)
+
+    def label_ids(self):
+        return [LABELS.ids[handle] for handle in self.labels]
+
+    def label_dicts(self):
+        return [LABELS.label(handle) for handle in self.labels]
+
+    def to_json(self):
+        """ The card in the shape trello sends it, for storing. """
+        return {'name': self.name, 'id': self.id, 'idList': self.list_id,
+                'labels': self.label_dicts()}
+
+    @classmethod
+    def from_json(cls, card):
+        """ Build a card from trello's json, keeping only what is used. """
+        return cls(card.get('name'), card.get('id'),
+                   [LABELS.intern(label.get('id'), label.get('name'))
+                    for label in card.get('labels')],
+                   card.get('idList'))
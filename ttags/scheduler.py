@@ -0,0 +1,143 @@
+"""
+Request scheduling within Trello's rate limits.
+
+Trello allows 300 requests per 10 seconds for each API key and 100 per
+10 seconds for each token. Every request TrelloTool makes waits for its
+turn in a token bucket for its key and one for its token, and work queued
+with Scheduler.submit runs concurrently as fast as those buckets allow.
+A bucket's burst and its refill over a window add up to the limit, so no
+window of 10 seconds ever holds more requests than trello allows.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# (requests, seconds) trello allows per API key and per token
+KEY_LIMIT = (300, 10)
+TOKEN_LIMIT = (100, 10)
+
+# Buckets are shared by every TrelloTool using the same key or token.
+shared_buckets = dict()
+shared_buckets_lock = Lock()
+
+
+class TokenBucket:
+    """
+    Hands out at most limit requests in any window of interval seconds:
+    bursts of up to burst, a tenth of the limit by default, and the rest
+    spread evenly over the window. The rate is halved each time trello
+    pushes back and creeps back up as requests succeed.
+    """
+
+    def __init__(self, limit, interval, burst=None, clock=time.monotonic):
+        if burst is None:
+            burst = max(limit // 10, 1)
+        if burst >= limit:
+            raise ValueError('a burst of {} leaves nothing of a limit of '
+                             '{} to refill'.format(burst, limit))
+        self.capacity = burst
+        self.max_rate = (limit - burst) / interval
+        self.rate = self.max_rate
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+        self.lock = Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds to wait before using it.
+        Tokens may be taken ahead of time, so waiting callers queue up in
+        the order they asked.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def slow_down(self):
+        """ Halve the rate, never below a sixteenth of the limit. """
+        with self.lock:
+            self.refill()
+            self.rate = max(self.rate / 2, self.max_rate / 16)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        """ Win back a little of the rate lost to slow_down. """
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.refill()
+                self.rate = min(self.rate + self.max_rate / 32,
+                                self.max_rate)
+
+
+def shared_bucket(name, limit, clock=time.monotonic):
+    """ The bucket for name, created on first use. """
+    with shared_buckets_lock:
+        if name not in shared_buckets:
+            shared_buckets[name] = TokenBucket(*limit, clock=clock)
+        return shared_buckets[name]
+
+
+class Scheduler:
+    """
+    Sits between callers and HTTP. wait_turn blocks until every bucket
+    allows another request, pause holds back every caller after a rate
+    limited response, and submit queues work on a thread pool.
+    """
+
+    def __init__(self, buckets, workers=8, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.buckets = buckets
+        self.workers = workers
+        self.pool = None
+        self.clock = clock
+        self.sleep = sleep
+        self.paused_until = 0
+        self.lock = Lock()
+
+    @classmethod
+    def for_credentials(cls, key, token, workers=8):
+        """ A scheduler sharing buckets with others on the same key/token. """
+        return cls([shared_bucket(('key', key), KEY_LIMIT),
+                    shared_bucket(('token', token), TOKEN_LIMIT)],
+                   workers=workers)
+
+    def wait_turn(self):
+        """ Block until a request may be sent. """
+        pause = self.paused_until - self.clock()
+        if pause > 0:
+            self.sleep(pause)
+        delay = max([bucket.reserve() for bucket in self.buckets] + [0])
+        if delay > 0:
+            self.sleep(delay)
+
+    def pause(self, seconds):
+        """
+        Trello rejected a request. Hold every caller back for seconds and
+        slow the buckets down.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    self.clock() + seconds)
+        for bucket in self.buckets:
+            bucket.slow_down()
+
+    def succeeded(self):
+        """ A request went through, let the rate recover. """
+        for bucket in self.buckets:
+            bucket.speed_up()
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queue fn to run on the scheduler's threads. Returns a future. """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self.pool.submit(fn, *args, **kwargs)
@@ -1,7 +1,13 @@
 """
-HTTP request handler to get the OAUTH redirect from Trello.
+HTTP request handler to get the OAUTH redirect from Trello, and a server
+receiving trello's webhook callbacks.
 """
+import base64
+import hashlib
+import hmac
+import json
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -21,3 +27,76 @@ class RequestHandler(BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         """ Redefined to silence logging. """
         return
+
+
+def webhook_signature(secret, body, callback_url):
+    """
+    The X-Trello-Webhook header trello signs a callback with: the base64
+    HMAC-SHA1 of the body followed by the callback URL, keyed with the
+    application's secret.
+    """
+    digest = hmac.new(secret.encode(), body + callback_url.encode(),
+                      hashlib.sha1).digest()
+    return base64.b64encode(digest).decode()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """ Handles trello's webhook callbacks for a WebhookServer. """
+
+    def do_HEAD(self):
+        """ Trello checks that the callback URL answers before using it. """
+        self.answer(200)
+
+    def do_POST(self):
+        """ Hand the action of a correctly signed callback on. """
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        expected = webhook_signature(self.server.secret, body,
+                                     self.server.callback_url)
+        signature = self.headers.get('X-Trello-Webhook', '')
+        if not hmac.compare_digest(signature.encode(), expected.encode()):
+            return self.answer(401)
+        try:
+            action = json.loads(body.decode()).get('action')
+        except (ValueError, AttributeError):
+            return self.answer(400)
+        if action:
+            self.server.on_action(action)
+        self.answer(200)
+
+    def answer(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """ Redefined to silence logging. """
+        return
+
+
+class WebhookServer(HTTPServer):
+    """
+    Receives webhook callbacks on port, on a background thread, and hands
+    the action of every one correctly signed to on_action. callback_url
+    is the public URL trello posts to, which forwards to port, and is
+    part of the signature.
+    """
+
+    def __init__(self, port, secret, callback_url, on_action,
+                 host='localhost'):
+        super(WebhookServer, self).__init__((host, port), WebhookHandler)
+        self.secret = secret
+        self.callback_url = callback_url
+        self.on_action = on_action
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
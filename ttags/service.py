@@ -0,0 +1,453 @@
+"""
+Long running service for many users.
+
+Service keeps a session per user, each with its own TrelloApp, behind a
+small JSON API on localhost. What users have in common is shared: the
+cards of a board are fetched once and served to every session whose
+boards include it, for as long as the board's dateLastActivity stays the
+same, and label similarity scores go through one shared score cache.
+Sessions only ever ask for boards trello listed for their own token, so
+nobody is served a board they cannot see. Concurrent fetches of the same
+board, by one session or several, are coalesced into one request.
+
+    POST   /sessions               {"key", "token"} -> {"session"}
+    DELETE /sessions/ID
+    POST   /sessions/ID/reload     fetch the boards again
+    GET    /sessions/ID/suggest    groups of similar labels, ?new=1 for
+                                   only those that changed
+    POST   /sessions/ID/merge      {"labels", "into", "dry_run"}
+    POST   /sessions/ID/resume     finish merges cut short
+    GET    /stats                  metrics and sharing, ?format=prometheus
+"""
+import app
+import hashlib
+import json
+import metrics
+import records
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+
+class ApiError(Exception):
+    """ A request the API refuses, with the HTTP status to answer. """
+
+    def __init__(self, status, message):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+class Flight:
+    """ One call of a SingleFlight and the callers waiting on it. """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a function once for all callers asking for the same key at the
+    same time. Those arriving while it runs wait and share its result.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # key -> Flight, for calls running now
+        self.flights = dict()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def copy_cards(cards):
+    """ Cards of one's own, merges patch cards in place. """
+    return [records.Card(card.name, card.id, card.labels, card.list_id)
+            for card in cards]
+
+
+class SharedBoards:
+    """
+    In-memory board cache with BoardCache's interface, shared by every
+    session. A board's cards are good until its activity date changes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # board id -> (last activity, cards)
+        self.boards = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def cards(self, board, counted=True):
+        """
+        Copies of the cards shared for board, or None. Only counted
+        lookups go into hits and misses, so a board is counted once.
+        """
+        if board.last_activity is None:
+            return None
+        with self.lock:
+            entry = self.boards.get(board.id)
+            if entry is None or entry[0] != board.last_activity:
+                if counted:
+                    self.misses += 1
+                return None
+            if counted:
+                self.hits += 1
+        return copy_cards(entry[1])
+
+    def store(self, board, cards):
+        if board.last_activity is None:
+            return
+        cards = copy_cards(cards)
+        with self.lock:
+            self.boards[board.id] = (board.last_activity, cards)
+
+    def clear(self):
+        with self.lock:
+            self.boards = dict()
+
+
+class SharedScores:
+    """ A cache.ScoreCache that sessions can use at the same time. """
+
+    def __init__(self, scores):
+        self.scores = scores
+        self.lock = Lock()
+
+    def score(self, first, second, compute):
+        with self.lock:
+            return self.scores.score(first, second, compute)
+
+    def save(self):
+        with self.lock:
+            self.scores.save()
+
+
+class SessionApp(app.TrelloApp):
+    """
+    A TrelloApp whose fetches go through the service's SingleFlight, one
+    board at a time, so sessions loading the same board wait for a single
+    request instead of each making their own.
+    """
+
+    def __init__(self, flights, **kwargs):
+        super(SessionApp, self).__init__(**kwargs)
+        self.flights = flights
+
+    def fetch_board(self, board):
+        """
+        Fetch one board and share it right away. Another session may have
+        shared it since this one found it missing, then that is used.
+        """
+        cards = None
+        if self.cache is not None:
+            # load_stale already counted the board as a miss
+            cards = self.cache.cards(board, counted=False)
+        if cards is not None:
+            return {board.id: cards}, set()
+        loaded, failed = app.TrelloApp.fetch_boards(self, [board])
+        if self.cache is not None and not failed:
+            self.cache.store(board, loaded[board.id])
+        return loaded, failed
+
+    def fetch_boards(self, boards):
+        def fetch(board):
+            return self.flights.do((board.id, board.last_activity),
+                                   lambda: self.fetch_board(board))
+
+        loaded = dict()
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for board, (board_cards, board_failed) in zip(
+                    boards, pool.map(fetch, boards)):
+                loaded[board.id] = copy_cards(board_cards[board.id])
+                if board_failed:
+                    failed.add(board.id)
+                    # the session that fetched it has the list errors
+                    if not any(_list in board.lists
+                               for _list, error in self.failed_lists):
+                        self.failed_lists += [
+                            (_list, IOError('board could not be loaded'))
+                            for _list in board.lists]
+        return loaded, failed
+
+
+class Session:
+
+    def __init__(self, session_id, the_app):
+        self.id = session_id
+        self.app = the_app
+        # one request at a time per session
+        self.lock = Lock()
+
+
+class Service:
+    """
+    Sessions and everything they share. make_engine(scores) builds a
+    clustering engine scoring through scores, a new one per session.
+    """
+
+    def __init__(self, make_engine, scores=None, journal_dir=None,
+                 service_metrics=None):
+        self.make_engine = make_engine
+        self.scores = SharedScores(scores) if scores is not None else None
+        self.boards = SharedBoards()
+        self.flights = SingleFlight()
+        self.metrics = service_metrics or metrics.Metrics()
+        # where each user's merge journal goes, None for no journals
+        self.journal_dir = journal_dir
+        self.lock = Lock()
+        # session id -> Session, and hash of the token -> session id
+        self.sessions = dict()
+        self.users = dict()
+
+    def handle(self, method, parts, query, body):
+        """ (status, answer) for a request, split into its path's parts. """
+        if parts == ['stats'] and method == 'GET':
+            return self.stats(query)
+        if parts == ['sessions'] and method == 'POST':
+            return self.open_session(body)
+        if len(parts) < 2 or parts[0] != 'sessions':
+            raise ApiError(404, 'no such route')
+        session = self.sessions.get(parts[1])
+        if session is None:
+            raise ApiError(404, 'no such session')
+
+        route = (method, tuple(parts[2:]))
+        if route == ('DELETE', ()):
+            return self.close_session(session)
+        actions = {
+            ('POST', ('reload',)): self.reload,
+            ('GET', ('suggest',)): self.suggest,
+            ('POST', ('merge',)): self.merge,
+            ('POST', ('resume',)): self.resume
+        }
+        if route not in actions:
+            raise ApiError(404, 'no such route')
+        with session.lock:
+            return actions[route](session, query, body)
+
+    def open_session(self, body):
+        """ The session of the user with these credentials, made if new. """
+        if not body.get('key') or not body.get('token'):
+            raise ApiError(400, 'key and token are needed')
+        user = hashlib.sha256(
+            '{}:{}'.format(body['key'], body['token']).encode()).hexdigest()
+        with self.lock:
+            session_id = self.users.get(user)
+            if session_id is not None:
+                return 200, {'session': session_id}
+
+        # each member's merges are journaled in journal_dir, see connect
+        the_app = SessionApp(
+            self.flights,
+            engine=self.make_engine(self.scores), cache=self.boards,
+            app_metrics=self.metrics, journal_dir=self.journal_dir)
+        try:
+            the_app.connect({'key': body['key'], 'token': body['token']},
+                            base_url=body.get('base_url'))
+        except Exception as error:
+            raise ApiError(502, 'could not reach trello: {}'.format(error))
+        session = Session(secrets.token_urlsafe(16), the_app)
+        with session.lock:
+            self.load(session)
+
+        with self.lock:
+            if user in self.users:
+                # opened by a request racing this one, keep the first
+                return 200, {'session': self.users[user]}
+            self.users[user] = session.id
+            self.sessions[session.id] = session
+        return 201, {'session': session.id}
+
+    def close_session(self, session):
+        with self.lock:
+            self.sessions.pop(session.id, None)
+            for user, session_id in list(self.users.items()):
+                if session_id == session.id:
+                    del self.users[user]
+        return 200, {'closed': session.id}
+
+    def load(self, session):
+        try:
+            session.app.initialize()
+        except Exception as error:
+            raise ApiError(502, 'could not load from trello: {}'.format(
+                error))
+
+    def prepare(self, session):
+        """
+        Get a session's data ready, reloading it if a failed merge left it
+        out of step with trello. Returns its label index.
+        """
+        try:
+            return session.app.prepare()
+        except Exception as error:
+            raise ApiError(502, 'could not load from trello: {}'.format(
+                error))
+
+    def describe_load(self, session):
+        the_app = session.app
+        return {'session': session.id,
+                'boards': [{'id': board.id, 'name': board.name}
+                           for board in the_app.Boards],
+                'cards': len(the_app.Cards),
+                'labels': len(the_app.index.names()),
+                'failed_lists': [_list.id
+                                 for _list, error in the_app.failed_lists]}
+
+    def reload(self, session, query, body):
+        self.load(session)
+        return 200, self.describe_load(session)
+
+    def suggest(self, session, query, body):
+        changed_only = query.get('new', ['0'])[0] not in ('0', '')
+        return 200, {'groups': session.app.similar_groups(
+            changed_only, self.prepare(session))}
+
+    def merge(self, session, query, body):
+        """ Merge labels into one, or with dry_run only plan it. """
+        labels = body.get('labels')
+        into = body.get('into')
+        the_app = session.app
+        if not isinstance(labels, list) or not into:
+            raise ApiError(400, 'labels and into are needed')
+        if not isinstance(into, str) or not all(
+                isinstance(label, str) for label in labels):
+            raise ApiError(400, 'labels and into must be label names')
+        self.prepare(session)
+        if not the_app.index.ids_for(into):
+            raise ApiError(400, 'no label called {}'.format(into))
+
+        plan = the_app.plan_merge(labels, into)
+        answer = {'cards': len(plan.updates),
+                  'operations': plan.operation_count(),
+                  'skipped': len(plan.skipped)}
+        if body.get('dry_run'):
+            card_names = dict((card_id, card.name) for card_id, card in
+                              the_app.card_map.items())
+            answer['plan'] = plan.describe(card_names)
+            return 200, answer
+        answer['failures'] = [{'card': update.card_id, 'error': str(error)}
+                              for update, error in the_app.run_merge(plan)]
+        return 200, answer
+
+    def resume(self, session, query, body):
+        self.prepare(session)
+        failures = session.app.resume_merges()
+        return 200, {'failures': [{'card': update.card_id,
+                                   'error': str(error)}
+                                  for update, error in failures]}
+
+    def stats(self, query):
+        if query.get('format', [''])[0] == 'prometheus':
+            return 200, self.metrics.to_prometheus()
+        with self.boards.lock:
+            boards = {'cached': len(self.boards.boards),
+                      'hits': self.boards.hits,
+                      'misses': self.boards.misses}
+        return 200, {'sessions': len(self.sessions),
+                     'boards': boards,
+                     'coalesced_fetches': self.flights.coalesced,
+                     'metrics': json.loads(self.metrics.to_json())}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length).decode() or '{}')
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            return self.send(400, {'error': 'the body must be a JSON object'})
+        try:
+            status, answer = self.server.service.handle(
+                method, parts, parse_qs(url.query), body)
+        except ApiError as error:
+            status, answer = error.status, {'error': str(error)}
+        except Exception as error:
+            # answer rather than drop the connection
+            status, answer = 500, {'error': '{}: {}'.format(
+                type(error).__name__, error)}
+        self.send(status, answer)
+
+    def send(self, status, answer):
+        if isinstance(answer, str):
+            data = answer.encode()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            data = json.dumps(answer).encode()
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """ Redefined to silence logging. """
+        return
+
+
+class ServiceServer(ThreadingHTTPServer):
+    """ Serves a Service on localhost, a thread per request. """
+    daemon_threads = True
+
+    def __init__(self, service, port=0, host='localhost'):
+        super(ServiceServer, self).__init__((host, port), ServiceHandler)
+        self.service = service
+        self.thread = None
+
+    def start(self):
+        """ Serve on a background thread. """
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
@@ -0,0 +1,152 @@
+"""
+Incremental parsing of large JSON responses.
+
+Trello answers with one JSON array holding every card of a list or a
+board. iter_values reads such a document a chunk at a time, as it comes
+off the socket, and hands back the values nested at a given depth one by
+one. Only the value being read is ever held in memory, never the whole
+response body or its decoded text.
+"""
+import codecs
+import json
+import re
+
+# characters that matter outside of strings
+STRUCTURE = re.compile(r'["\[\]{},:]')
+# characters that matter inside of strings
+STRING_END = re.compile(r'["\\]')
+
+
+class ValueSplitter:
+    """
+    Pushes text through a small state machine tracking the open arrays
+    and objects. Values depth containers deep are collected whole and
+    parsed with json.loads. Scalars nested less deep are parsed too, so
+    callers can see small fields such as error messages.
+    """
+
+    def __init__(self, depth=1):
+        self.depth = depth
+        # per open container: [is object, index or key, expecting key]
+        self.stack = []
+        # pieces of the value being collected at depth, or None
+        self.value = None
+        # how many containers are open inside the value being collected
+        self.nesting = 0
+        # pieces of a scalar or key being read less deep
+        self.token = []
+        self.in_string = False
+        self.escaped = False
+
+    def path(self):
+        return tuple(entry[1] for entry in self.stack)
+
+    def append(self, text):
+        if self.value is not None:
+            self.value.append(text)
+        else:
+            self.token.append(text)
+
+    def finish_token(self, found):
+        token = ''.join(self.token).strip()
+        self.token = []
+        if token:
+            found.append((self.path(), json.loads(token)))
+
+    def finish_value(self, found):
+        found.append((self.path(), json.loads(''.join(self.value))))
+        self.value = None
+
+    def feed(self, text):
+        """ Read more of the document. Returns the (path, value) found. """
+        found = []
+        pos = 0
+        end = len(text)
+        while pos < end:
+            if self.in_string:
+                if self.escaped:
+                    self.append(text[pos])
+                    self.escaped = False
+                    pos += 1
+                    continue
+                match = STRING_END.search(text, pos)
+                if match is None:
+                    self.append(text[pos:])
+                    break
+                stop = match.end()
+                self.append(text[pos:stop])
+                pos = stop
+                if match.group() == '\\':
+                    self.escaped = True
+                    continue
+                self.in_string = False
+                if self.value is not None and self.nesting == 0:
+                    self.finish_value(found)
+                continue
+
+            match = STRUCTURE.search(text, pos)
+            if match is None:
+                self.append(text[pos:])
+                break
+            self.append(text[pos:match.start()])
+            pos = match.end()
+            char = match.group()
+
+            if self.value is not None:
+                self.value.append(char)
+                if char == '"':
+                    self.in_string = True
+                elif char in '[{':
+                    self.nesting += 1
+                elif char in ']}':
+                    self.nesting -= 1
+                    if self.nesting == 0:
+                        self.finish_value(found)
+                continue
+
+            expecting_key = self.stack and self.stack[-1][2]
+            if char == '"':
+                self.in_string = True
+                if len(self.stack) == self.depth and not expecting_key:
+                    self.value = ['"']
+                else:
+                    self.token.append('"')
+            elif char in '[{':
+                if len(self.stack) == self.depth:
+                    self.value = [char]
+                    self.nesting = 1
+                else:
+                    is_object = char == '{'
+                    self.stack.append(
+                        [is_object, None if is_object else 0, is_object])
+            elif char == ':':
+                self.stack[-1][1] = json.loads(''.join(self.token))
+                self.stack[-1][2] = False
+                self.token = []
+            elif char == ',':
+                self.finish_token(found)
+                if self.stack[-1][0]:
+                    self.stack[-1][2] = True
+                else:
+                    self.stack[-1][1] += 1
+            else:
+                self.finish_token(found)
+                self.stack.pop()
+        return found
+
+
+def iter_values(chunks, depth=1):
+    """
+    Parse a JSON document arriving as chunks of bytes and yield a (path,
+    value) pair for each value depth arrays or objects deep, and for
+    each scalar less deep. path holds the index or key of every
+    enclosing container, so the cards of a list come out as ((0,), card),
+    ((1,), card) and so on.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    splitter = ValueSplitter(depth)
+    for chunk in chunks:
+        for item in splitter.feed(decoder.decode(chunk)):
+            yield item
+    for item in splitter.feed(decoder.decode(b'', final=True)):
+        yield item